@@ -1,15 +1,45 @@
 import os
 import re
+import sys
 import io
 import csv
 import json
 import time
 import asyncio
+import bisect
 import logging
+import mimetypes
+import sqlite3
+import hmac
+import hashlib
+import signal
+import secrets
+import struct
+import threading
+from array import array
 import traceback
-from contextlib import contextmanager
-from telegram import Update, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
-from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, filters, ContextTypes
+try:
+    import fcntl
+except ImportError:  # ويندوز: يكتفى بالقفل داخل العملية
+    fcntl = None
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from telegram import (Update, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove,
+                      InputMediaAudio, InputMediaDocument, InputMediaVideo)
+from telegram.request import HTTPXRequest
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+from telegram.ext import ApplicationBuilder, BasePersistence, BaseUpdateProcessor, CommandHandler, MessageHandler, PersistenceInput, filters, ContextTypes
+try:
+    from telethon import TelegramClient
+    from telethon.tl.functions.upload import SaveBigFilePartRequest, SaveFilePartRequest
+    from telethon.tl.types import InputFile, InputFileBig
+except ImportError:  # بدون Telethon يتعطل رفع التسجيلات الكبيرة فقط
+    TelegramClient = None
+try:
+    from gtts import gTTS
+except ImportError:  # بدون gTTS تتعطل الملخصات الصوتية فقط
+    gTTS = None
 
 # ------------------ الإعدادات والملفات ------------------
 TOKEN = os.getenv("BOT_TOKEN")
@@ -17,14 +47,20 @@ OWNER_ID = 5524792549  # المالك الوحيد الذي لا يُحذف ول
 
 CODES_FILE = "codes.json"
 LOGGED_FILE = "logged_users.txt"
-ALL_USERS_FILE = "all_users.txt"
+ALL_USERS_FILE = "all_users.txt"      # السجل القديم (يُرحّل إلى AUDIENCE_FILE)
+AUDIENCE_FILE = "audience.bin"         # جمهور البث: مصفوفات IDs مرتبة بدون تكرار
 BOT_FILES_JSON = "bot_files.json"
 STATS_FILE = "stats.json"
 ADMINS_FILE = "admins.json"            # يحتوي قائمة الأدمنز (IDs فقط باستثناء المالك)
 ADMIN_PERMS_FILE = "admin_perms.json"  # يحتوي صلاحيات كل أدمن
 SUSPENDED_FILE = "suspended.json"
 COMPLAINTS_FILE = "complaints.json"
+BROADCAST_JOBS_FILE = "broadcast_jobs.json"
+BROADCAST_DIR = "broadcasts"             # لكل بث: قائمة المستلمين (.rcpt) وسجل النتائج إضافة فقط (.log)
+TTS_CACHE_FILE = "tts_cache.json"        # بصمة نص الملخص -> file_id للصوت المرفوع
+FILE_META_FILE = "file_meta.json"        # file_id -> {uid (file_unique_id), size, mime}
 USERS_FILE = "users.json"              # سجل المستخدمين (id -> {name, username, code})
+USER_DATA_FILE = "user_data.jsonl"     # حالة التنقل لكل مستخدم (سجل إضافة فقط)
 
 # أنواع الملفات وحجمها
 ALLOWED_EXTS = {".pdf", ".ppt", ".pptx", ".mp3", ".wav", ".ogg", ".m4a", ".mp4", ".avi", ".mkv", ".mov"}
@@ -35,9 +71,20 @@ MAX_UPLOAD_SIZE = 3 * 1024 * 1024 * 1024  # 3GB
 BACK_BTN = "⬅️ رجوع للخلف"
 MAIN_BTN = "🏠 القائمة الرئيسية"
 CANCEL_UPLOAD_BTN = "❌ إلغاء الرفع"
+LARGE_UPLOAD_BTN = "🎬 رفع تسجيل كبير من الخادم"
+TTS_SUMMARY_BTN = "🔊 ملخص صوتي من نص"
+DUPLICATES_REPORT_BTN = "🧮 تقرير الملفات المكررة"
 CANCEL_ACTION_BTN = "❌ إلغاء الأمر"
 CONFIRM_DELETE_BTN = "✅ تأكيد الحذف"
 CONFIRM_SEND_BTN = "✅ تأكيد الإرسال"
+AUDIENCE_ALL_BTN = "👥 كل المستخدمين"
+AUDIENCE_LOGGED_IN_BTN = "🔐 المسجلون حالياً"
+AUDIENCE_CODE_PREFIX_BTN = "🎓 دفعة (بداية الكود)"
+AUDIENCE_ACTIVE_BTN = "⏱ النشطون آخر N يوم"
+BROADCAST_JOBS_BTN = "📋 مهام البث"
+PAUSE_BROADCAST_BTN = "⏸ إيقاف البث مؤقتاً"
+RESUME_BROADCAST_BTN = "▶️ استئناف البث"
+CANCEL_BROADCAST_BTN = "🛑 إلغاء البث"
 ADMIN_PANEL_BTN = "🛠️ خصائص الأدمن"
 SEND_SUGGEST_BTN = "📝 ارسال مقترح او شكوي لادارة الكلية"
 ADMIN_VIEW_COMPLAINTS_BTN = "📬 عرض المقترحات والشكاوي"
@@ -60,6 +107,8 @@ ADMIN_SUSPEND_STUDENT_BTN = "⏸️ إيقاف/إلغاء إيقاف حساب"
 
 SELECT_BY_CODE_BTN = "🔢 إدخال الكود"
 SELECT_FROM_LIST_BTN = "📋 عرض جميع الطلاب"
+SEND_ALL_FILES_BTN = "📦 تحميل كل ملفات المحاضرة"
+SEARCH_STUDENT_BTN = "🔍 بحث بالاسم أو الكود"
 EDIT_NAME_BTN = "✏️ تعديل الاسم"
 EDIT_CODE_BTN = "🔢 تعديل الكود"
 UNSUSPEND_BTN = "✅ إلغاء الإيقاف"
@@ -87,6 +136,14 @@ PREV_BTN = "◀️ السابق"
 PAGE_SIZE = 10
 STUDENTS_PAGE_SIZE = 10
 
+# البث
+BROADCAST_WORKERS = 8             # عدد المرسلين المتزامنين
+BROADCAST_RATE = 25               # رسالة/ثانية لكل البوت (حد تيليجرام ~30)
+WORKER_COUNT = max(1, int(os.getenv("WORKER_COUNT", "1")))  # عدد عمليات البوت على نفس التوكن
+BROADCAST_MAX_RETRIES = 5         # محاولات إعادة الإرسال بعد RetryAfter
+BROADCAST_PROGRESS_INTERVAL = 5.0 # ثوانٍ بين تحديثات التقدم للأدمن
+BROADCAST_OUTCOME_BATCH = 10      # نتائج الإرسال تُحفظ كل 10 رسائل (أقصى ما يُعاد إرساله بعد انهيار)
+
 # مفاتيح الصلاحيات
 PERM_KEYS = [
     ("content", "1- اضافة محاضرات"),               # إضافة/حذف/إعادة تسمية مواد/محاضرات/عناصر
@@ -102,36 +159,155 @@ PERM_KEYS = [
 logging.basicConfig(level=logging.INFO, format="%(asctime)s | %(levelname)s | %(name)s | %(message)s")
 logger = logging.getLogger(__name__)
 
+# ------------------ قياس الأداء ------------------
+# عينات زمنية (بالثواني) لآخر PERF_WINDOW استدعاء لكل مفتاح: route.* / storage.* / api.* / lock.*
+# التسجيل مجرد append على deque، والنسب المئوية تُحسب فقط عند طلب /perf.
+PERF_ENABLED = os.getenv("PERF_ENABLED", "1") != "0"
+PERF_WINDOW = 512
+
+# حدود الـ histogram التراكمي (للتصدير بصيغة Prometheus)
+PERF_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_perf_samples = {}  # key -> deque
+_perf_counts = {}   # key -> العدد الكلي منذ التشغيل
+_perf_hist = {}     # key -> [عدد كل bucket ..., +Inf, المجموع]
+
+def perf_record(key, seconds):
+    if not PERF_ENABLED:
+        return
+    samples = _perf_samples.get(key)
+    if samples is None:
+        samples = _perf_samples[key] = deque(maxlen=PERF_WINDOW)
+        _perf_hist[key] = [0] * (len(PERF_BUCKETS) + 1) + [0.0]
+    samples.append(seconds)
+    _perf_counts[key] = _perf_counts.get(key, 0) + 1
+    hist = _perf_hist[key]
+    hist[bisect.bisect_left(PERF_BUCKETS, seconds)] += 1
+    hist[-1] += seconds
+
+@contextmanager
+def perf_timer(key):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        perf_record(key, time.perf_counter() - started)
+
+def perf_percentiles(key, qs=(0.5, 0.95, 0.99)):
+    data = sorted(_perf_samples.get(key, ()))
+    if not data:
+        return tuple(0.0 for _ in qs)
+    return tuple(data[min(len(data) - 1, int(q * len(data)))] for q in qs)
+
+def perf_report(limit=30):
+    rows = []
+    for key in _perf_samples:
+        p50, p95, p99 = perf_percentiles(key)
+        rows.append((p95, key, p50, p99))
+    rows.sort(reverse=True)
+    lines = ["⏱ الأداء (ms) — p50 / p95 / p99 (العدد)"]
+    for p95, key, p50, p99 in rows[:limit]:
+        lines.append(f"{key}: {p50 * 1000:.1f} / {p95 * 1000:.1f} / {p99 * 1000:.1f} ({_perf_counts[key]})")
+    if len(lines) == 1:
+        lines.append("لا توجد بيانات بعد.")
+    return "\n".join(lines)
+
+# عدادات بسيطة: (name, labels tuple) -> قيمة
+_metric_counters = {}
+
+def metric_inc(name, labels=(), value=1):
+    key = (name, labels)
+    _metric_counters[key] = _metric_counters.get(key, 0) + value
+
+class TimedRequest(HTTPXRequest):
+    """HTTPXRequest يسجّل زمن وأخطاء كل استدعاء لـ Bot API باسم الدالة (api.sendMessage ...)."""
+
+    async def post(self, url, *args, **kwargs):
+        method = url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        try:
+            return await super().post(url, *args, **kwargs)
+        except Exception as e:
+            metric_inc("bot_api_errors_total", (("method", method), ("error", type(e).__name__)))
+            if isinstance(e, RetryAfter):
+                metric_inc("bot_api_retry_after_total", (("method", method),))
+            raise
+        finally:
+            perf_record("api." + method, time.perf_counter() - started)
+
 # ------------------ أدوات تخزين آمنة ------------------
-def atomic_write_json(path, data):
+def atomic_write_text(path, text):
     tmp = path + ".tmp"
     with open(tmp, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=4)
+        f.write(text)
     os.replace(tmp, path)
 
-@contextmanager
-def file_lock(base_path: str, timeout: float = 10.0, poll: float = 0.05):
-    lock_path = base_path + ".lock"
-    start = time.time()
-    fd = None
+def atomic_write_bytes(path, data):
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+def atomic_write_json(path, data):
+    atomic_write_text(path, json.dumps(data, ensure_ascii=False, indent=4))
+
+_async_locks = {}  # path -> asyncio.Lock (داخل العملية)
+
+def _get_async_lock(path):
+    lock = _async_locks.get(path)
+    if lock is None:
+        lock = _async_locks[path] = asyncio.Lock()
+    return lock
+
+def _acquire_flock(lock_path, timeout, poll=0.05):
+    # يعمل داخل thread وليس في الـ event loop. قفل flock يحرره النظام تلقائياً
+    # إذا توقفت العملية، لذلك لا يبقى ملف .lock "عالق" بعد أي انهيار.
+    fd = os.open(lock_path, os.O_CREAT | os.O_RDWR, 0o644)
+    if fcntl is None:
+        return fd
+    start = time.monotonic()
     while True:
         try:
-            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_RDWR)
-            break
-        except FileExistsError:
-            if time.time() - start > timeout:
-                raise TimeoutError(f"Timeout acquiring lock for {base_path}")
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return fd
+        except BlockingIOError:
+            if time.monotonic() - start > timeout:
+                os.close(fd)
+                raise TimeoutError(f"Timeout acquiring lock for {lock_path}")
             time.sleep(poll)
+
+def _release_flock(fd):
     try:
-        yield
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_UN)
     finally:
+        os.close(fd)
+
+def _release_abandoned_flock(acquire):
+    # المنتظر أُلغي لكن الـ thread أكمل أخذ القفل: لا أحد سيحرره غيرنا
+    if not acquire.cancelled() and acquire.exception() is None:
+        _release_flock(acquire.result())
+
+@asynccontextmanager
+async def file_lock(base_path: str, timeout: float = 10.0):
+    started = time.perf_counter()
+    async with _get_async_lock(base_path):
+        # الـ thread لا يمكن إيقافه: عند إلغاء المنتظر نتركه يكمل ونحرر القفل عند وصوله
+        acquire = asyncio.ensure_future(asyncio.to_thread(_acquire_flock, base_path + ".lock", timeout))
         try:
-            if fd is not None:
-                os.close(fd)
-            if os.path.exists(lock_path):
-                os.unlink(lock_path)
-        except Exception:
-            pass
+            fd = await asyncio.shield(acquire)
+        except asyncio.CancelledError:
+            acquire.add_done_callback(_release_abandoned_flock)
+            raise
+        perf_record("lock.file", time.perf_counter() - started)
+        try:
+            yield
+        finally:
+            _release_flock(fd)
+
+def append_bytes(path, data):
+    with open(path, "ab") as f:
+        f.write(data)
 
 def append_line_safe(path, line):
     os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
@@ -144,6 +320,965 @@ def append_line_safe(path, line):
                 f.write(b"\n")
         f.write((line + "\n").encode("utf-8"))
 
+# ------------------ طبقة التخزين ------------------
+# STORAGE_BACKEND=json (افتراضي): ملف لكل نوع بيانات كما في السابق.
+# STORAGE_BACKEND=sqlite: قاعدة SQLite واحدة (WAL) بجداول مفهرسة، ويتم ترحيل
+# الملفات الحالية إليها تلقائياً عند أول تشغيل.
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json").strip().lower()
+SQLITE_DB_FILE = os.getenv("SQLITE_DB_FILE", "bot.db")
+
+STATE_FILES = {
+    "users": (USERS_FILE, dict),
+    "codes": (CODES_FILE, list),
+    "suspended": (SUSPENDED_FILE, dict),
+    "bot_files": (BOT_FILES_JSON, dict),
+    "stats": (STATS_FILE, dict),
+    "complaints": (COMPLAINTS_FILE, list),
+    "admins": (ADMINS_FILE, list),
+    "admin_perms": (ADMIN_PERMS_FILE, dict),
+    "broadcast_jobs": (BROADCAST_JOBS_FILE, dict),
+    "tts_cache": (TTS_CACHE_FILE, dict),
+    "file_meta": (FILE_META_FILE, dict),
+}
+
+SESSIONS_COMPACT_MIN = 200  # أقل عدد سطور زائدة قبل ضغط سجل الجلسات
+
+# ملفات JSON التي يُلتقط تعديلها من خارج العملية (تعديل يدوي أو أداة أخرى)
+JSON_WATCHED_FILES = ("admins", "admin_perms", "codes", "bot_files", "suspended")
+
+def _mtime_ns(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+# دمج ثلاثي لبيانات JSON: base آخر نسخة مشتركة، local تعديلنا، external ما كتبه غيرنا بعدها.
+# القواميس تُدمج مفتاحاً مفتاحاً، والقوائم تأخذ ترتيب external مع حذف/إضافة ما غيّرناه نحن،
+# وعند تعارض قيمة واحدة يفوز تعديلنا.
+_MISSING = object()
+
+def _merge_key(item):
+    return json.dumps(item, ensure_ascii=False, sort_keys=True)
+
+def merge3(base, local, external):
+    if local == base:
+        return external
+    if external == base or external is _MISSING:
+        return local
+    if isinstance(local, dict) and isinstance(external, dict):
+        base = base if isinstance(base, dict) else {}
+        merged = {}
+        for key in list(external) + [k for k in local if k not in external]:
+            value = merge3(base.get(key, _MISSING), local.get(key, _MISSING), external.get(key, _MISSING))
+            if value is not _MISSING:
+                merged[key] = value
+        return merged
+    if isinstance(local, list) and isinstance(external, list):
+        base_keys = {_merge_key(x) for x in base} if isinstance(base, list) else set()
+        local_keys = {_merge_key(x) for x in local}
+        external_keys = {_merge_key(x) for x in external}
+        merged = [x for x in external if _merge_key(x) in local_keys or _merge_key(x) not in base_keys]
+        merged += [x for x in local if _merge_key(x) not in base_keys and _merge_key(x) not in external_keys]
+        return merged
+    return local if local is not _MISSING else external
+
+class JsonStorage:
+    kind = "json"
+
+    def __init__(self):
+        self.sessions_journal_lines = 0
+        self.user_data_journal_lines = 0
+        self._mtimes = {}  # name -> mtime_ns عند آخر قراءة/كتابة لنا
+        self._base = {}    # name -> نص آخر نسخة قرأناها/كتبناها (ملفات JSON_WATCHED_FILES فقط)
+
+    # read يقرأ فقط، و adopt يعتمد ما قُرئ كآخر نسخة نعرفها (المزامنة قد تتخلى عنه)
+    def read(self, name):
+        path, factory = STATE_FILES[name]
+        if name == "stats":
+            return load_json_safe(path, factory()), None
+        if not os.path.exists(path):
+            atomic_write_json(path, factory())
+        mtime = _mtime_ns(path)
+        with open(path, "r", encoding="utf-8") as f:
+            text = f.read()
+        try:
+            return json.loads(text), (mtime, text)
+        except ValueError:
+            # نسجل الـ mtime رغم الفشل (ملف معدّل يدوياً بشكل خاطئ) كي لا نعيد المحاولة كل دورة
+            self._mtimes[name] = mtime
+            raise
+
+    def adopt(self, name, data, token):
+        if token is not None:
+            self._mtimes[name] = token[0]
+            if name in JSON_WATCHED_FILES:
+                self._base[name] = token[1]
+
+    def load(self, name):
+        data, token = self.read(name)
+        self.adopt(name, data, token)
+        return data
+
+    async def save(self, name, data):
+        # التسلسل داخل الـ loop (لقطة ثابتة)، والكتابة نفسها في thread تحت القفل
+        # ترجع None، أو (ما أرسلناه, الناتج المدموج) إذا دُمج تعديلنا مع تعديل خارجي
+        path, _ = STATE_FILES[name]
+        text = json.dumps(data, ensure_ascii=False, indent=4)
+        async with file_lock(path):
+            return await asyncio.to_thread(self._write, name, path, text)
+
+    def _write(self, name, path, text):
+        # ملف إعدادات عُدّل من خارج البوت بعد آخر قراءة لنا ولم تلتقطه المزامنة بعد
+        # (لدينا تعديل معلق عليه): نطبق تعديلنا فوق نسخته بدل الكتابة عليها
+        sent = merged = None
+        if name in self._base and _mtime_ns(path) != self._mtimes.get(name):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    external = json.load(f)
+            except (OSError, ValueError):
+                logger.warning("%s changed outside the bot but cannot be read; overwriting it", path)
+            else:
+                sent = json.loads(text)
+                merged = merge3(json.loads(self._base[name]), sent, external)
+                text = json.dumps(merged, ensure_ascii=False, indent=4)
+        atomic_write_text(path, text)
+        self._mtimes[name] = _mtime_ns(path)
+        if name in JSON_WATCHED_FILES:
+            self._base[name] = text
+        return (sent, merged) if merged is not None else None
+
+    # الجلسات: LOGGED_FILE سجل إضافة فقط، "uid|name" للدخول و "-uid|" للخروج
+    def load_sessions(self):
+        if os.path.exists(LOGGED_FILE):
+            with open(LOGGED_FILE, "r", encoding="utf-8") as f:
+                entries = re.findall(r"(-?\d+)\|([^\n\r]*)", f.read())
+        else:
+            entries = []
+        sessions = {}
+        for uid, name in entries:
+            if uid.startswith("-"):
+                sessions.pop(uid[1:], None)
+            else:
+                sessions[uid] = name
+        self.sessions_journal_lines = len(entries)
+        return sessions
+
+    async def save_sessions(self, changes):
+        # changes: {uid: الاسم أو None للخروج}
+        text = "\n".join(f"{uid}|{name}" if name is not None else f"-{uid}|" for uid, name in changes.items())
+        async with file_lock(LOGGED_FILE):
+            await asyncio.to_thread(append_line_safe, LOGGED_FILE, text)
+        self.sessions_journal_lines += len(changes)
+
+    async def compact_sessions(self, sessions):
+        text = "".join(f"{uid}|{name}\n" for uid, name in sessions.items())
+        async with file_lock(LOGGED_FILE):
+            await asyncio.to_thread(atomic_write_text, LOGGED_FILE, text)
+        self.sessions_journal_lines = len(sessions)
+
+    async def maybe_compact_sessions(self, sessions):
+        garbage = self.sessions_journal_lines - len(sessions)
+        if garbage > max(SESSIONS_COMPACT_MIN, len(sessions)):
+            await self.compact_sessions(sessions)
+
+    # user_data: USER_DATA_FILE سطر JSON لكل تغيير {"u": id, "d": {...}}، وبدون "d" للحذف
+    def load_user_data(self):
+        blobs = {}
+        lines = 0
+        if os.path.exists(USER_DATA_FILE):
+            with open(USER_DATA_FILE, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        uid = int(entry["u"])
+                    except (ValueError, KeyError, TypeError):
+                        continue
+                    lines += 1
+                    if "d" in entry:
+                        blobs[uid] = json.dumps(entry["d"], ensure_ascii=False, separators=(",", ":"), sort_keys=True)
+                    else:
+                        blobs.pop(uid, None)
+        self.user_data_journal_lines = lines
+        return blobs
+
+    async def save_user_data(self, changes, snapshot):
+        # changes: {uid: blob أو None}، snapshot: كل البيانات بعد التغيير (للضغط عند الحاجة)
+        garbage = self.user_data_journal_lines + len(changes) - len(snapshot)
+        if garbage > max(SESSIONS_COMPACT_MIN, len(snapshot)):
+            text = "".join(f'{{"u":{uid},"d":{blob}}}\n' for uid, blob in snapshot.items())
+            async with file_lock(USER_DATA_FILE):
+                await asyncio.to_thread(atomic_write_text, USER_DATA_FILE, text)
+            self.user_data_journal_lines = len(snapshot)
+            return
+        text = "".join(f'{{"u":{uid},"d":{blob}}}\n' if blob is not None else f'{{"u":{uid}}}\n'
+                       for uid, blob in changes.items())
+        async with file_lock(USER_DATA_FILE):
+            await asyncio.to_thread(append_line_safe, USER_DATA_FILE, text.rstrip("\n"))
+        self.user_data_journal_lines += len(changes)
+
+    def changed_names(self, busy=()):
+        # ملفات الإعدادات التي قد تُعدّل من خارج البوت: نقارن الـ mtime فقط (stat لكل ملف كل دورة)
+        changed = set()
+        for name in JSON_WATCHED_FILES:
+            if name in self._mtimes and name not in busy and _mtime_ns(STATE_FILES[name][0]) != self._mtimes[name]:
+                changed.add(name)
+        return changed
+
+    def get_session(self, uid):
+        return None
+
+    def get_user_data(self, uid):
+        return None
+
+    # كل من سجّل دخول ولو مرة (جمهور البث) + من لا يمكن الوصول إليهم
+    def load_audience(self):
+        if os.path.exists(AUDIENCE_FILE):
+            with open(AUDIENCE_FILE, "rb") as f:
+                return unpack_audience(f.read())
+        ids = set()
+        if os.path.exists(ALL_USERS_FILE):
+            with open(ALL_USERS_FILE, "r", encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if line.isdigit():
+                        ids.add(int(line))
+        atomic_write_bytes(AUDIENCE_FILE, pack_audience(ids, set()))
+        return ids, set()
+
+    async def save_audience(self, ids, unreachable, added, status):
+        # الملف صغير (8 بايت لكل مستخدم) فيُعاد كتابته كاملاً
+        data = pack_audience(ids, unreachable)
+        async with file_lock(AUDIENCE_FILE):
+            await asyncio.to_thread(atomic_write_bytes, AUDIENCE_FILE, data)
+
+    # مستلمو البث: .rcpt مصفوفة int64 تُكتب مرة واحدة، و.log سجلات (index uint32, نتيجة uint8) تُضاف فقط
+    def _broadcast_paths(self, job_id):
+        base = os.path.join(BROADCAST_DIR, str(job_id))
+        return base + ".rcpt", base + ".log"
+
+    def _next_broadcast_id(self, path, floor):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                last = int(f.read().strip() or 0)
+        except (OSError, ValueError):
+            last = 0
+        job_id = max(last, floor) + 1
+        atomic_write_text(path, str(job_id))
+        return job_id
+
+    async def allocate_broadcast_id(self, floor=0):
+        # رقم المهمة من عداد على القرص تحت القفل، لا من نسخة الذاكرة (قد لا تكون آخر ما كُتب)
+        path = os.path.join(BROADCAST_DIR, "last_id")
+        os.makedirs(BROADCAST_DIR, exist_ok=True)
+        async with file_lock(path):
+            return await asyncio.to_thread(self._next_broadcast_id, path, floor)
+
+    async def create_broadcast_recipients(self, job_id, recipients):
+        rcpt, log = self._broadcast_paths(job_id)
+        data = pack_int64(recipients)
+        os.makedirs(BROADCAST_DIR, exist_ok=True)
+        async with file_lock(rcpt):
+            await asyncio.to_thread(atomic_write_bytes, rcpt, data)
+            if os.path.exists(log):
+                await asyncio.to_thread(os.remove, log)
+
+    def _read_broadcast(self, job_id):
+        rcpt, log = self._broadcast_paths(job_id)
+        with open(rcpt, "rb") as f:
+            recipients = unpack_int64(f.read())
+        outcomes = bytearray(len(recipients))
+        if os.path.exists(log):
+            with open(log, "rb") as f:
+                data = f.read()
+            # سجل ناقص في النهاية (انقطاع أثناء الكتابة) يُتجاهل
+            for i, outcome in struct.iter_unpack("<IB", data[:len(data) - len(data) % 5]):
+                if i < len(outcomes):
+                    outcomes[i] = outcome
+        return recipients, outcomes
+
+    async def load_broadcast_progress(self, job_id):
+        return await asyncio.to_thread(self._read_broadcast, job_id)
+
+    async def append_broadcast_outcomes(self, job_id, entries):
+        _, log = self._broadcast_paths(job_id)
+        data = b"".join(struct.pack("<IB", i, outcome) for i, outcome in entries)
+        async with file_lock(log):
+            await asyncio.to_thread(append_bytes, log, data)
+
+    async def drop_broadcast(self, job_id):
+        for path in self._broadcast_paths(job_id):
+            for p in (path, path + ".lock"):
+                if os.path.exists(p):
+                    await asyncio.to_thread(os.remove, p)
+
+AUDIENCE_MAGIC = b"AUD1"
+
+def pack_int64(values):
+    a = array("q", values)
+    if sys.byteorder != "little":
+        a.byteswap()
+    return a.tobytes()
+
+def unpack_int64(data):
+    a = array("q")
+    a.frombytes(data[:len(data) - len(data) % 8])
+    if sys.byteorder != "little":
+        a.byteswap()
+    return a.tolist()
+
+def pack_audience(ids, unreachable):
+    # AUD1 | عدد الكل | عدد غير القابلين للوصول | int64 مرتبة (little-endian)
+    a = array("q", sorted(ids))
+    b = array("q", sorted(unreachable))
+    if sys.byteorder != "little":
+        a.byteswap()
+        b.byteswap()
+    return AUDIENCE_MAGIC + struct.pack("<II", len(a), len(b)) + a.tobytes() + b.tobytes()
+
+def unpack_audience(data):
+    if data[:4] != AUDIENCE_MAGIC:
+        raise ValueError("Bad audience file")
+    n, m = struct.unpack_from("<II", data, 4)
+    a = array("q")
+    b = array("q")
+    a.frombytes(data[12:12 + 8 * n])
+    b.frombytes(data[12 + 8 * n:12 + 8 * (n + m)])
+    if sys.byteorder != "little":
+        a.byteswap()
+        b.byteswap()
+    return set(a), set(b)
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS codes (key TEXT PRIMARY KEY, code TEXT NOT NULL, name TEXT NOT NULL DEFAULT '');
+CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY, name TEXT, username TEXT, code TEXT);
+CREATE INDEX IF NOT EXISTS idx_users_username ON users(username COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS idx_users_code ON users(code);
+CREATE TABLE IF NOT EXISTS sessions (user_id INTEGER PRIMARY KEY, name TEXT NOT NULL DEFAULT '');
+CREATE TABLE IF NOT EXISTS audience (user_id INTEGER PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS unreachable (user_id INTEGER PRIMARY KEY, ts INTEGER);
+CREATE TABLE IF NOT EXISTS suspended (code TEXT PRIMARY KEY, reason TEXT, by_id INTEGER, ts INTEGER);
+CREATE TABLE IF NOT EXISTS complaints (id INTEGER PRIMARY KEY, user_id INTEGER, name TEXT, username TEXT, text TEXT, ts INTEGER);
+CREATE INDEX IF NOT EXISTS idx_complaints_user ON complaints(user_id);
+CREATE TABLE IF NOT EXISTS file_downloads (key TEXT PRIMARY KEY, count INTEGER NOT NULL DEFAULT 0);
+CREATE TABLE IF NOT EXISTS user_activity (user_id INTEGER PRIMARY KEY, ts INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS user_data (user_id INTEGER PRIMARY KEY, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS broadcast_jobs (id INTEGER PRIMARY KEY, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS broadcast_recipients (job_id INTEGER NOT NULL, idx INTEGER NOT NULL, user_id INTEGER NOT NULL,
+                                                 outcome INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (job_id, idx));
+CREATE TABLE IF NOT EXISTS generations (name TEXT PRIMARY KEY, gen INTEGER NOT NULL DEFAULT 0);
+"""
+
+# table -> (عمود المفتاح, باقي الأعمدة)
+SQLITE_TABLES = {
+    "codes": ("key", ("code", "name")),
+    "users": ("user_id", ("name", "username", "code")),
+    "suspended": ("code", ("reason", "by_id", "ts")),
+    "complaints": ("id", ("user_id", "name", "username", "text", "ts")),
+    "file_downloads": ("key", ("count",)),
+    "user_activity": ("user_id", ("ts",)),
+    "kv": ("key", ("value",)),
+    "user_data": ("user_id", ("data",)),
+    "broadcast_jobs": ("id", ("data",)),
+}
+
+# جداول العدادات: تُكتب كزيادات (delta) تُجمع داخل SQLite حتى لا تضيع زيادات العمليات الأخرى
+SQLITE_MERGE_SQL = {
+    "file_downloads": "INSERT INTO file_downloads (key, count) VALUES (?, ?) "
+                      "ON CONFLICT(key) DO UPDATE SET count = count + excluded.count",
+    "user_activity": "INSERT INTO user_activity (user_id, ts) VALUES (?, ?) "
+                     "ON CONFLICT(user_id) DO UPDATE SET ts = MAX(ts, excluded.ts)",
+    "kv_counter": "INSERT INTO kv (key, value) VALUES (?, ?) "
+                  "ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + CAST(excluded.value AS INTEGER)",
+}
+
+# بيانات صغيرة يقرؤها/يكتبها الأدمن فقط تُخزن كمستند JSON واحد في kv
+SQLITE_KV_DOCS = {"bot_files", "admins", "admin_perms", "tts_cache", "file_meta"}
+
+def _sqlite_rows(name, data):
+    # تحويل بيانات الذاكرة إلى صفوف: {table: {key: (cols...)}}
+    if name in SQLITE_KV_DOCS:
+        return {"kv": {name: (json.dumps(data, ensure_ascii=False),)}}
+    if name == "users":
+        return {"users": {int(uid): (i.get("name"), i.get("username"), i.get("code")) for uid, i in data.items()}}
+    if name == "codes":
+        # الكود ليس فريداً دائماً (نفس الكود لطالبين في codes.json)، فالتكرار الثاني يُخزن بمفتاح "code#2"
+        rows = {}
+        for it in data:
+            code = str(it.get("code", ""))
+            key, n = code, 2
+            while key in rows:
+                key, n = f"{code}#{n}", n + 1
+            rows[key] = (code, str(it.get("name", "")))
+        return {"codes": rows}
+    if name == "suspended":
+        return {"suspended": {c: (i.get("reason"), i.get("by"), i.get("ts")) for c, i in data.items()}}
+    if name == "complaints":
+        return {"complaints": {int(c["id"]): (c.get("user_id"), c.get("name"), c.get("username"), c.get("text"), c.get("ts")) for c in data}}
+    if name == "broadcast_jobs":
+        return {"broadcast_jobs": {int(k): (json.dumps(j, ensure_ascii=False, separators=(",", ":")),) for k, j in data.items()}}
+    if name == "stats":
+        return {
+            "file_downloads": {k: (int(v),) for k, v in data.get("file_downloads", {}).items()},
+            "user_activity": {int(uid): (int(ts),) for uid, ts in data.get("user_activity", {}).items()},
+            "kv": {"downloads_total": (json.dumps(int(data.get("downloads_total", 0))),)},
+        }
+    raise KeyError(name)
+
+def _sqlite_data(name, conn):
+    if name in SQLITE_KV_DOCS:
+        row = conn.execute("SELECT value FROM kv WHERE key = ?", (name,)).fetchone()
+        return json.loads(row[0]) if row else STATE_FILES[name][1]()
+    if name == "users":
+        res = {}
+        for uid, n, un, code in conn.execute("SELECT user_id, name, username, code FROM users"):
+            entry = {k: v for k, v in (("name", n), ("username", un), ("code", code)) if v is not None}
+            res[str(uid)] = entry
+        return res
+    if name == "codes":
+        return [{"code": c, "name": n} for c, n in conn.execute("SELECT code, name FROM codes ORDER BY rowid")]
+    if name == "suspended":
+        return {c: {"reason": r, "by": b, "ts": ts} for c, r, b, ts in conn.execute("SELECT code, reason, by_id, ts FROM suspended")}
+    if name == "complaints":
+        cols = ("id", "user_id", "name", "username", "text", "ts")
+        return [dict(zip(cols, r)) for r in conn.execute("SELECT id, user_id, name, username, text, ts FROM complaints ORDER BY id")]
+    if name == "broadcast_jobs":
+        return {str(i): json.loads(d) for i, d in conn.execute("SELECT id, data FROM broadcast_jobs ORDER BY id")}
+    if name == "stats":
+        row = conn.execute("SELECT value FROM kv WHERE key = 'downloads_total'").fetchone()
+        return {
+            "downloads_total": json.loads(row[0]) if row else 0,
+            "file_downloads": dict(conn.execute("SELECT key, count FROM file_downloads")),
+            "user_activity": {str(u): ts for u, ts in conn.execute("SELECT user_id, ts FROM user_activity")},
+        }
+    raise KeyError(name)
+
+def _sqlite_upsert_sql(table):
+    key, cols = SQLITE_TABLES[table]
+    all_cols = (key,) + cols
+    updates = ", ".join(f"{c} = excluded.{c}" for c in cols)
+    return (f"INSERT INTO {table} ({', '.join(all_cols)}) VALUES ({', '.join('?' * len(all_cols))}) "
+            f"ON CONFLICT({key}) DO UPDATE SET {updates}")
+
+def _stats_deltas(table, upserts, old_rows):
+    # يحوّل صفوف الإحصائيات المتغيرة إلى زيادات، ولا يحذف شيئاً
+    if table == "file_downloads":
+        return table, {k: (v[0] - (old_rows[k][0] if k in old_rows else 0),) for k, v in upserts.items()}, []
+    if table == "kv":
+        deltas = {}
+        for k, v in upserts.items():
+            old = json.loads(old_rows[k][0]) if k in old_rows else 0
+            deltas[k] = (str(int(json.loads(v[0])) - int(old)),)
+        return "kv_counter", deltas, []
+    return table, upserts, []
+
+class SqliteStorage:
+    kind = "sqlite"
+
+    def __init__(self, path):
+        self.path = path
+        self._db_lock = threading.Lock()  # للكتابة على self.conn فقط
+        self._readers = threading.local()
+        self._saved = {}  # name -> آخر صفوف تمت كتابتها (لحساب الفرق فقط)
+        self._gens = {}   # name -> آخر generation نعرفه (قرأناه أو كتبناه)
+        self._stale = set()  # أسماء كتبت عليها عملية أخرى قبل كتابتنا مباشرة
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SQLITE_SCHEMA)
+        self._upgrade_schema()
+        self.migrate_from_json()
+
+    def _upgrade_schema(self):
+        # قواعد أقدم: جدول codes بمفتاح code فقط (كان يسقط الأكواد المكررة)
+        cols = [r[1] for r in self.conn.execute("PRAGMA table_info(codes)")]
+        if "key" in cols:
+            return
+        with self.conn:
+            self.conn.execute("ALTER TABLE codes RENAME TO codes_old")
+            self.conn.execute("CREATE TABLE codes (key TEXT PRIMARY KEY, code TEXT NOT NULL, name TEXT NOT NULL DEFAULT '')")
+            self.conn.execute("INSERT INTO codes (key, code, name) SELECT code, code, name FROM codes_old ORDER BY rowid")
+            self.conn.execute("DROP TABLE codes_old")
+        logger.info("Upgraded codes table in %s to allow duplicate codes", self.path)
+
+    def _apply(self, changes, bump=None):
+        # changes: [(table, upserts{key: row}, deletes[keys])] في transaction واحدة
+        # bump: اسم البيانات التي تُزاد generation الخاصة بها في نفس الـ transaction
+        with self._db_lock, self.conn:
+            for table, upserts, deletes in changes:
+                if upserts:
+                    sql = SQLITE_MERGE_SQL.get(table) or _sqlite_upsert_sql(table)
+                    self.conn.executemany(sql, [(k,) + v for k, v in upserts.items()])
+                if deletes:
+                    key = SQLITE_TABLES[table][0]
+                    self.conn.executemany(f"DELETE FROM {table} WHERE {key} = ?", [(k,) for k in deletes])
+            if bump:
+                self._bump(bump)
+
+    def _bump(self, name):
+        # يُستدعى داخل transaction. إذا لم تكن الـ generation الحالية هي التي نعرفها
+        # فقد كتبت عملية أخرى بعد آخر قراءة لنا، فنعيد التحميل في المزامنة التالية.
+        row = self.conn.execute("SELECT gen FROM generations WHERE name = ?", (name,)).fetchone()
+        current = row[0] if row else 0
+        self.conn.execute("INSERT INTO generations (name, gen) VALUES (?, ?) "
+                          "ON CONFLICT(name) DO UPDATE SET gen = excluded.gen", (name, current + 1))
+        if current != self._gens.get(name, 0):
+            self._stale.add(name)
+        self._gens[name] = current + 1
+
+    @contextmanager
+    def _snapshot(self):
+        # القراءة على اتصال خاص بكل thread وبدون _db_lock: في وضع WAL لا ينتظر القارئ
+        # الكاتب، فقراءات الـ loop (get_session / get_user_data مع كل تحديث) لا تقف خلف
+        # transaction طويلة في thread آخر. BEGIN يجعل كل استعلامات القراءة من نفس اللقطة.
+        conn = getattr(self._readers, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, isolation_level=None)
+            conn.execute("PRAGMA query_only=ON")
+            self._readers.conn = conn
+        conn.execute("BEGIN")
+        try:
+            yield conn
+        finally:
+            conn.execute("COMMIT")
+
+    def _read_gen(self, name, conn):
+        row = conn.execute("SELECT gen FROM generations WHERE name = ?", (name,)).fetchone()
+        self._gens[name] = row[0] if row else 0
+        self._stale.discard(name)
+
+    def changed_names(self, busy=()):
+        # ما غيّرته عمليات أخرى منذ آخر قراءة/كتابة لنا (استعلام واحد صغير)
+        # busy: أسماء لدينا تغييرات معلقة عليها، تبقى للمرة القادمة
+        with self._snapshot() as conn:
+            gens = dict(conn.execute("SELECT name, gen FROM generations"))
+        # الاسم يبقى في _stale حتى نعتمد نسخة أحدث منه (adopt / _read_gen)
+        changed = {n for n, g in gens.items() if g != self._gens.get(n, 0)} | self._stale
+        return changed - set(busy)
+
+    def migrate_from_json(self):
+        row = self.conn.execute("SELECT value FROM kv WHERE key = 'migrated_at'").fetchone()
+        if row:
+            return
+        src = JsonStorage()
+        codes = [str(it.get("code", "")) for it in src.load("codes")]
+        dups = sorted({c for c in codes if codes.count(c) > 1})
+        if dups:
+            logger.warning("codes.json has duplicate codes (all rows are kept): %s", ", ".join(dups))
+        changes = []
+        for name in STATE_FILES:
+            for table, rows in _sqlite_rows(name, src.load(name)).items():
+                changes.append((table, rows, []))
+        changes.append(("kv", {"migrated_at": (json.dumps(int(time.time())),)}, []))
+        with self._db_lock, self.conn:
+            for table, rows, _ in changes:
+                if rows:
+                    self.conn.executemany(_sqlite_upsert_sql(table), [(k,) + v for k, v in rows.items()])
+            self.conn.executemany("INSERT OR REPLACE INTO sessions (user_id, name) VALUES (?, ?)",
+                                  [(int(u), n) for u, n in src.load_sessions().items()])
+            ids, unreachable = src.load_audience()
+            self.conn.executemany("INSERT OR IGNORE INTO audience (user_id) VALUES (?)", [(u,) for u in ids])
+            self.conn.executemany("INSERT OR IGNORE INTO unreachable (user_id, ts) VALUES (?, NULL)",
+                                  [(u,) for u in unreachable])
+            self.conn.executemany("INSERT OR REPLACE INTO user_data (user_id, data) VALUES (?, ?)",
+                                  list(src.load_user_data().items()))
+        logger.info("Migrated JSON data into %s", self.path)
+
+    def read(self, name):
+        with self._snapshot() as conn:
+            row = conn.execute("SELECT gen FROM generations WHERE name = ?", (name,)).fetchone()
+            return _sqlite_data(name, conn), row[0] if row else 0
+
+    def adopt(self, name, data, gen):
+        self._gens[name] = gen
+        self._saved[name] = _sqlite_rows(name, data)
+        self._stale.discard(name)
+
+    def load(self, name):
+        data, gen = self.read(name)
+        self.adopt(name, data, gen)
+        return data
+
+    def _save_doc(self, name, text):
+        # مستند kv يُكتب كاملاً، فالكتابة CAS على الـ generation: داخل BEGIN IMMEDIATE
+        # (لا كاتب آخر حتى الـ commit) إن لم تكن الـ generation هي التي نعرفها فقد كتب
+        # worker آخر بعد آخر قراءة لنا، فنقرأ نسخته وندمج تعديلنا فوقها بدل استبدالها.
+        sent = merged = None
+        with self._db_lock, self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            row = self.conn.execute("SELECT gen FROM generations WHERE name = ?", (name,)).fetchone()
+            current = row[0] if row else 0
+            if current != self._gens.get(name, 0):
+                external = _sqlite_data(name, self.conn)
+                base = json.loads(self._saved[name]["kv"][name][0]) if name in self._saved else STATE_FILES[name][1]()
+                sent = json.loads(text)
+                merged = merge3(base, sent, external)
+                text = json.dumps(merged, ensure_ascii=False)
+            self.conn.execute("INSERT INTO kv (key, value) VALUES (?, ?) "
+                              "ON CONFLICT(key) DO UPDATE SET value = excluded.value", (name, text))
+            self.conn.execute("INSERT INTO generations (name, gen) VALUES (?, ?) "
+                              "ON CONFLICT(name) DO UPDATE SET gen = excluded.gen", (name, current + 1))
+            self._gens[name] = current + 1
+        self._saved[name] = {"kv": {name: (text,)}}
+        self._stale.discard(name)
+        return (sent, merged) if merged is not None else None
+
+    async def save(self, name, data):
+        # نكتب فقط الصفوف التي تغيرت منذ آخر حفظ (حساب الفرق داخل الـ loop)
+        # ترجع None، أو (ما أرسلناه, الناتج المدموج) إذا دُمج تعديلنا مع كتابة خارجية
+        rows = _sqlite_rows(name, data)
+        old = self._saved.get(name, {})
+        if name in SQLITE_KV_DOCS:
+            if rows != old:
+                return await asyncio.to_thread(self._save_doc, name, rows["kv"][name][0])
+            return None
+        changes = []
+        for table, new_rows in rows.items():
+            old_rows = old.get(table, {})
+            upserts = {k: v for k, v in new_rows.items() if old_rows.get(k) != v}
+            deletes = [k for k in old_rows if k not in new_rows]
+            if name == "stats":
+                table, upserts, deletes = _stats_deltas(table, upserts, old_rows)
+            if upserts or deletes:
+                changes.append((table, upserts, deletes))
+        if changes:
+            await asyncio.to_thread(self._apply, changes, name)
+        self._saved[name] = rows
+
+    def load_sessions(self):
+        with self._snapshot() as conn:
+            self._read_gen("sessions", conn)
+            return {str(u): n for u, n in conn.execute("SELECT user_id, name FROM sessions")}
+
+    def get_session(self, uid):
+        with self._snapshot() as conn:
+            row = conn.execute("SELECT name FROM sessions WHERE user_id = ?", (int(uid),)).fetchone()
+        return row[0] if row else None
+
+    def _apply_sessions(self, changes):
+        with self._db_lock, self.conn:
+            self.conn.executemany("INSERT INTO sessions (user_id, name) VALUES (?, ?) "
+                                  "ON CONFLICT(user_id) DO UPDATE SET name = excluded.name",
+                                  [(int(u), n) for u, n in changes.items() if n is not None])
+            self.conn.executemany("DELETE FROM sessions WHERE user_id = ?",
+                                  [(int(u),) for u, n in changes.items() if n is None])
+            self._bump("sessions")
+
+    async def save_sessions(self, changes):
+        await asyncio.to_thread(self._apply_sessions, changes)
+
+    async def compact_sessions(self, sessions):
+        pass
+
+    async def maybe_compact_sessions(self, sessions):
+        pass
+
+    def load_user_data(self):
+        with self._snapshot() as conn:
+            return dict(conn.execute("SELECT user_id, data FROM user_data"))
+
+    def get_user_data(self, uid):
+        with self._snapshot() as conn:
+            row = conn.execute("SELECT data FROM user_data WHERE user_id = ?", (int(uid),)).fetchone()
+        return row[0] if row else None
+
+    async def save_user_data(self, changes, snapshot):
+        upserts = {uid: (blob,) for uid, blob in changes.items() if blob is not None}
+        deletes = [uid for uid, blob in changes.items() if blob is None]
+        await asyncio.to_thread(self._apply, [("user_data", upserts, deletes)])
+
+    def load_audience(self):
+        with self._snapshot() as conn:
+            self._read_gen("audience", conn)
+            ids = {u for (u,) in conn.execute("SELECT user_id FROM audience")}
+            unreachable = {u for (u,) in conn.execute("SELECT user_id FROM unreachable")}
+        return ids, unreachable
+
+    def _apply_audience(self, added, status):
+        now = int(time.time())
+        with self._db_lock, self.conn:
+            self.conn.executemany("INSERT OR IGNORE INTO audience (user_id) VALUES (?)", [(u,) for u in added])
+            self.conn.executemany("INSERT OR REPLACE INTO unreachable (user_id, ts) VALUES (?, ?)",
+                                  [(u, now) for u, bad in status.items() if bad])
+            self.conn.executemany("DELETE FROM unreachable WHERE user_id = ?",
+                                  [(u,) for u, bad in status.items() if not bad])
+            self._bump("audience")
+
+    async def save_audience(self, ids, unreachable, added, status):
+        # نكتب الفرق فقط: المضافون الجدد وتغيرات حالة الوصول
+        await asyncio.to_thread(self._apply_audience, added, status)
+
+    # مستلمو البث ونتائجهم صف لكل مستلم، وكل دفعة نتائج تحدّث صفوفها فقط
+    def _broadcast_sql(self, sql, rows):
+        with self._db_lock, self.conn:
+            self.conn.executemany(sql, rows)
+
+    async def create_broadcast_recipients(self, job_id, recipients):
+        await asyncio.to_thread(self._broadcast_sql, "INSERT OR REPLACE INTO broadcast_recipients (job_id, idx, user_id, outcome) VALUES (?, ?, ?, 0)",
+                                [(job_id, i, uid) for i, uid in enumerate(recipients)])
+
+    def _next_broadcast_id(self, floor):
+        # العداد في kv يُزاد داخل BEGIN IMMEDIATE، فلا يأخذ workerان نفس الرقم
+        with self._db_lock, self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            row = self.conn.execute("SELECT value FROM kv WHERE key = 'broadcast_job_seq'").fetchone()
+            top = self.conn.execute("SELECT MAX(id) FROM broadcast_jobs").fetchone()[0]
+            job_id = max(int(row[0]) if row else 0, top or 0, floor) + 1
+            self.conn.execute("INSERT INTO kv (key, value) VALUES ('broadcast_job_seq', ?) "
+                              "ON CONFLICT(key) DO UPDATE SET value = excluded.value", (str(job_id),))
+        return job_id
+
+    async def allocate_broadcast_id(self, floor=0):
+        return await asyncio.to_thread(self._next_broadcast_id, floor)
+
+    def _read_broadcast(self, job_id):
+        with self._snapshot() as conn:
+            rows = conn.execute("SELECT user_id, outcome FROM broadcast_recipients WHERE job_id = ? ORDER BY idx", (job_id,)).fetchall()
+        return [u for u, _ in rows], bytearray(o for _, o in rows)
+
+    async def load_broadcast_progress(self, job_id):
+        return await asyncio.to_thread(self._read_broadcast, job_id)
+
+    async def append_broadcast_outcomes(self, job_id, entries):
+        await asyncio.to_thread(self._broadcast_sql, "UPDATE broadcast_recipients SET outcome = ? WHERE job_id = ? AND idx = ?",
+                                [(outcome, job_id, i) for i, outcome in entries])
+
+    async def drop_broadcast(self, job_id):
+        await asyncio.to_thread(self._broadcast_sql, "DELETE FROM broadcast_recipients WHERE job_id = ?", [(job_id,)])
+
+class TimedStorage:
+    """غلاف يسجّل زمن كل استدعاء لطبقة التخزين (storage.load, storage.save ...)."""
+
+    def __init__(self, inner):
+        self._inner = inner
+
+    def __getattr__(self, name):
+        attr = getattr(self._inner, name)
+        if not callable(attr):
+            return attr
+        key = "storage." + name
+        if asyncio.iscoroutinefunction(attr):
+            async def timed(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await attr(*args, **kwargs)
+                finally:
+                    perf_record(key, time.perf_counter() - started)
+        else:
+            def timed(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return attr(*args, **kwargs)
+                finally:
+                    perf_record(key, time.perf_counter() - started)
+        setattr(self, name, timed)
+        return timed
+
+_storage = None
+
+def get_storage():
+    global _storage
+    if _storage is None:
+        if STORAGE_BACKEND == "sqlite":
+            _storage = SqliteStorage(SQLITE_DB_FILE)
+        else:
+            _storage = JsonStorage()
+        if PERF_ENABLED:
+            _storage = TimedStorage(_storage)
+    return _storage
+
+# ------------------ مخزن الحالة في الذاكرة ------------------
+# كل البيانات تُقرأ مرة واحدة عند التشغيل وتبقى في الذاكرة.
+# دوال load_* ترجع نفس الكائن المخزن (بدون نسخ)، ودوال save_* تحدّثه وتعلّمه
+# كـ "متغير"، ثم يكتبه المُفرِّغ الخلفي عبر طبقة التخزين كل STATE_FLUSH_INTERVAL ثانية.
+STATE_FLUSH_INTERVAL = 2.0
+
+_state = {}         # name -> data
+_state_dirty = set()
+_flush_lock = asyncio.Lock()
+
+def state_get(name):
+    if name not in _state:
+        _state[name] = get_storage().load(name)
+    return _state[name]
+
+def state_set(name, data):
+    _state[name] = data
+    _state_dirty.add(name)
+
+def load_state():
+    for name in STATE_FILES:
+        state_get(name)
+
+async def flush_state():
+    async with _flush_lock:
+        names = list(_state_dirty)
+        _state_dirty.clear()
+        with perf_timer("flush.state"):
+            for name in names:
+                try:
+                    merged = await get_storage().save(name, _state[name])
+                except Exception:
+                    logger.exception("State flush failed for %s", name)
+                    _state_dirty.add(name)
+                    continue
+                if merged:
+                    adopt_merged_state(name, *merged)
+
+def adopt_merged_state(name, sent, merged):
+    # الكتابة دمجت تعديلنا مع تعديل خارجي: نعتمد الناتج، وأي تعديل محلي حدث أثناء
+    # الكتابة يُدمج فوقه ويبقى معلّماً للكتابة التالية
+    logger.warning("%s was changed outside this process; merged our changes into it", name)
+    old = _state[name]
+    _state[name] = merge3(sent, old, merged) if name in _state_dirty else merged
+    hook = STATE_RELOAD_HOOKS.get(name)
+    if hook:
+        hook(old)
+
+async def state_flusher():
+    while True:
+        await asyncio.sleep(STATE_FLUSH_INTERVAL)
+        try:
+            await sync_state()
+        except Exception:
+            logger.exception("State sync failed")
+        if _sessions_dirty:
+            await asyncio.shield(flush_sessions())
+        await asyncio.shield(maybe_compact_sessions())
+        maybe_merge_pending_stats()
+        if _user_data_dirty:
+            await asyncio.shield(flush_user_data())
+        if _audience_added or _audience_status:
+            await asyncio.shield(flush_audience())
+        if _state_dirty:
+            # shield: الإلغاء عند الإغلاق لا يقطع كتابة جارية
+            await asyncio.shield(flush_state())
+
+# ------------------ حفظ user_data (حالة التنقل) ------------------
+# PTB يسلّمنا كل USER_DATA_UPDATE_INTERVAL ثانية نسخة من user_data لكل مستخدم تعامل مع البوت،
+# ونحن نحوّلها للقطة JSON مضغوطة ولا نعلّم كمتغير إلا من تغيّرت لقطته فعلاً؛
+# ثم يكتب state_flusher المتغيرين فقط على دفعة واحدة عبر طبقة التخزين.
+USER_DATA_UPDATE_INTERVAL = 5.0
+
+_user_data_saved = {}  # user_id -> آخر لقطة مكتوبة
+_user_data_dirty = {}  # user_id -> لقطة جديدة أو None للحذف
+_user_data_lock = asyncio.Lock()
+
+def user_data_snapshot(data):
+    # نحذف القيم الفارغة، والمستخدم الموجود في القائمة الرئيسية بدون أي حالة لا يُخزَّن أصلاً
+    compact = {k: v for k, v in data.items() if v not in (None, "", [], {})}
+    if not compact or compact == {"current_menu": "main"}:
+        return None
+    return json.dumps(compact, ensure_ascii=False, separators=(",", ":"), sort_keys=True)
+
+def mark_user_data(user_id, blob):
+    if blob == _user_data_saved.get(user_id):
+        _user_data_dirty.pop(user_id, None)
+    else:
+        _user_data_dirty[user_id] = blob
+
+async def flush_user_data():
+    async with _user_data_lock:
+        if not _user_data_dirty:
+            return
+        changes = dict(_user_data_dirty)
+        _user_data_dirty.clear()
+        snapshot = dict(_user_data_saved)
+        for uid, blob in changes.items():
+            if blob is None:
+                snapshot.pop(uid, None)
+            else:
+                snapshot[uid] = blob
+        try:
+            await get_storage().save_user_data(changes, snapshot)
+        except Exception:
+            logger.exception("user_data flush failed")
+            for uid, blob in changes.items():
+                _user_data_dirty.setdefault(uid, blob)
+            return
+        _user_data_saved.clear()
+        _user_data_saved.update(snapshot)
+
+class StoragePersistence(BasePersistence):
+    """يحفظ user_data فقط عبر طبقة التخزين الحالية (json أو sqlite)."""
+
+    def __init__(self, update_interval=USER_DATA_UPDATE_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+
+    async def get_user_data(self):
+        blobs = get_storage().load_user_data()
+        _user_data_saved.clear()
+        _user_data_saved.update(blobs)
+        result = {}
+        for uid, blob in blobs.items():
+            try:
+                result[uid] = json.loads(blob)
+            except ValueError:
+                logger.warning("Ignoring corrupt user_data for %s", uid)
+        return result
+
+    async def update_user_data(self, user_id, data):
+        try:
+            blob = user_data_snapshot(data)
+        except (TypeError, ValueError):
+            logger.warning("user_data for %s is not JSON serializable; not persisted", user_id)
+            return
+        mark_user_data(user_id, blob)
+
+    async def drop_user_data(self, user_id):
+        mark_user_data(user_id, None)
+
+    async def refresh_user_data(self, user_id, user_data):
+        # مع أكثر من worker: إذا كتب worker آخر حالة أحدث لهذا المستخدم نأخذها
+        if user_id in _user_data_dirty:
+            return
+        blob = get_storage().get_user_data(user_id)
+        if blob is None or blob == _user_data_saved.get(user_id):
+            return
+        user_data.clear()
+        user_data.update(json.loads(blob))
+        _user_data_saved[user_id] = blob
+
+    async def flush(self):
+        await flush_user_data()
+
+    # باقي أنواع البيانات غير مستخدمة في هذا البوت
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return {}
+
+    async def update_conversation(self, name, key, new_state):
+        pass
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
 # ------------------ دوال مساعدة ------------------
 def normalize_code(code: str) -> str:
     arabic_to_english = str.maketrans("٠١٢٣٤٥٦٧٨٩", "0123456789")
@@ -153,14 +1288,11 @@ def normalize_code(code: str) -> str:
 
 # --------- سجل مستخدمين عام ----------
 def load_users():
-    if not os.path.exists(USERS_FILE):
-        atomic_write_json(USERS_FILE, {})
-    with open(USERS_FILE, "r", encoding="utf-8") as f:
-        return json.load(f)
+    return state_get("users")
 
 def save_users(data):
-    with file_lock(USERS_FILE):
-        atomic_write_json(USERS_FILE, data)
+    state_set("users", data)
+    invalidate_code_index()
 
 def update_user_registry_from_update(update: Update):
     if not update or not update.effective_user:
@@ -168,8 +1300,13 @@ def update_user_registry_from_update(update: Update):
     u = update.effective_user
     users = load_users()
     entry = users.get(str(u.id), {})
-    entry["name"] = (u.full_name or "").strip()
-    entry["username"] = (u.username or "")
+    name = (u.full_name or "").strip()
+    username = (u.username or "")
+    # لا داعي للكتابة إذا لم يتغير شيء (الحالة الغالبة مع كل رسالة)
+    if str(u.id) in users and entry.get("name") == name and entry.get("username") == username:
+        return
+    entry["name"] = name
+    entry["username"] = username
     users[str(u.id)] = entry
     save_users(users)
 
@@ -204,20 +1341,17 @@ _admin_perms = {}    # str(admin_id) -> dict(perms)
 
 def load_admins():
     global _admins_set
-    if not os.path.exists(ADMINS_FILE):
-        atomic_write_json(ADMINS_FILE, [])
     try:
-        with open(ADMINS_FILE, "r", encoding="utf-8") as f:
-            ids = json.load(f)
-            _admins_set = set(int(x) for x in ids if str(x).isdigit())
+        ids = state_get("admins")
+        _admins_set = set(int(x) for x in ids if str(x).isdigit())
     except Exception:
         _admins_set = set()
+        _state["admins"] = []
 
 def save_admins():
     # لا نخزن المالك في الملف
     to_save = sorted([i for i in _admins_set if i != OWNER_ID])
-    with file_lock(ADMINS_FILE):
-        atomic_write_json(ADMINS_FILE, to_save)
+    state_set("admins", to_save)
 
 
 def is_admin(user_id: int) -> bool:
@@ -232,21 +1366,18 @@ def get_admin_ids():
 
 def load_admin_perms():
     global _admin_perms
-    if not os.path.exists(ADMIN_PERMS_FILE):
-        atomic_write_json(ADMIN_PERMS_FILE, {})
     try:
-        with open(ADMIN_PERMS_FILE, "r", encoding="utf-8") as f:
-            _admin_perms = json.load(f)
+        _admin_perms = state_get("admin_perms")
     except Exception:
         _admin_perms = {}
+        _state["admin_perms"] = _admin_perms
 
 def save_admin_perms(perms=None):
     if perms is not None:
         data = perms
     else:
         data = _admin_perms
-    with file_lock(ADMIN_PERMS_FILE):
-        atomic_write_json(ADMIN_PERMS_FILE, data)
+    state_set("admin_perms", data)
 
 def ensure_admin_perms_entry(admin_id: int):
     sid = str(admin_id)
@@ -268,24 +1399,88 @@ def get_admins_with_perm(perm: str):
 
 # --------- الأكواد (الطلاب) ----------
 def load_codes():
-    if not os.path.exists(CODES_FILE):
-        atomic_write_json(CODES_FILE, [])
-    with open(CODES_FILE, "r", encoding="utf-8") as f:
-        return json.load(f)
+    return state_get("codes")
 
 def save_codes(codes_list):
-    with file_lock(CODES_FILE):
-        atomic_write_json(CODES_FILE, codes_list)
+    state_set("codes", codes_list)
+    invalidate_roster()
+
+# توحيد النص العربي للبحث: حذف التشكيل والتطويل وتوحيد أشكال الألف والياء والتاء المربوطة
+ARABIC_DIACRITICS_RE = re.compile("[\u0610-\u061a\u064b-\u065f\u0670\u06d6-\u06ed\u0640]")
+ARABIC_LETTERS_MAP = str.maketrans({"أ": "ا", "إ": "ا", "آ": "ا", "ٱ": "ا", "ى": "ي", "ئ": "ي", "ة": "ه", "ؤ": "و", "ی": "ي", "ک": "ك"})
+
+def normalize_arabic(text: str) -> str:
+    return ARABIC_DIACRITICS_RE.sub("", str(text)).translate(ARABIC_LETTERS_MAP).lower()
+
+# فهرس الطلاب: يُبنى مرة واحدة من codes ولا يُعاد بناؤه إلا بعد save_codes
+_roster = None
+
+def get_roster():
+    global _roster
+    if _roster is None:
+        code_map = {}
+        for it in load_codes():
+            c = normalize_code(str(it.get("code", "")))
+            n = str(it.get("name", "")).strip()
+            if c:
+                code_map[c] = n
+        labels = []
+        label_to_code = {}
+        code_rank = {}    # code -> ترتيبه في labels
+        token_index = {}  # كلمة موحّدة من الاسم -> set(codes)
+        for c, n in sorted(code_map.items(), key=lambda kv: (kv[1], kv[0])):
+            label = f"👤 {n} | {c}"
+            code_rank[c] = len(labels)
+            labels.append(label)
+            label_to_code[label] = c
+            for tok in normalize_arabic(n).split():
+                token_index.setdefault(tok, set()).add(c)
+        _roster = {
+            "code_map": code_map,
+            "labels": labels,
+            "label_to_code": label_to_code,
+            "code_rank": code_rank,
+            "sorted_codes": sorted(code_map),
+            "token_index": token_index,
+            "sorted_tokens": sorted(token_index),
+        }
+    return _roster
+
+def _prefix_matches(sorted_keys, prefix):
+    i = bisect.bisect_left(sorted_keys, prefix)
+    while i < len(sorted_keys) and sorted_keys[i].startswith(prefix):
+        yield sorted_keys[i]
+        i += 1
+
+def search_students(query, limit=STUDENTS_PAGE_SIZE):
+    # كود (أو بدايته) أو كلمات من الاسم (كل كلمة تطابق بداية كلمة في الاسم)
+    # ترجع (labels, عدد النتائج الكلي)
+    roster = get_roster()
+    q = query.strip()
+    if not q:
+        return [], 0
+    if re.fullmatch(r"[\d٠-٩\s]+", q):
+        matches = set(_prefix_matches(roster["sorted_codes"], normalize_code(q)))
+    else:
+        matches = None
+        for tok in normalize_arabic(q).split():
+            found = set()
+            for key in _prefix_matches(roster["sorted_tokens"], tok):
+                found |= roster["token_index"][key]
+            matches = found if matches is None else (matches & found)
+            if not matches:
+                break
+        matches = matches or set()
+    ranked = sorted(matches, key=roster["code_rank"].get)
+    return [roster["labels"][roster["code_rank"][c]] for c in ranked[:limit]], len(ranked)
+
+def invalidate_roster():
+    global _roster
+    _roster = None
 
 def get_code_map():
-    data = load_codes()
-    res = {}
-    for it in data:
-        c = normalize_code(str(it.get("code", "")))
-        n = str(it.get("name", "")).strip()
-        if c:
-            res[c] = n
-    return res
+    # للقراءة فقط: نفس القاموس المشترك داخل الفهرس
+    return get_roster()["code_map"]
 
 def check_code(student_code):
     user_code = normalize_code(student_code)
@@ -298,14 +1493,10 @@ def check_code(student_code):
 
 # --------- إيقاف مؤقت ----------
 def load_suspended():
-    if not os.path.exists(SUSPENDED_FILE):
-        atomic_write_json(SUSPENDED_FILE, {})
-    with open(SUSPENDED_FILE, "r", encoding="utf-8") as f:
-        return json.load(f)
+    return state_get("suspended")
 
 def save_suspended(data):
-    with file_lock(SUSPENDED_FILE):
-        atomic_write_json(SUSPENDED_FILE, data)
+    state_set("suspended", data)
 
 def is_code_suspended(code):
     data = load_suspended()
@@ -329,25 +1520,123 @@ def unsuspend_code(code):
 
 # --------- ملفات المحاضرات ----------
 def load_bot_files():
-    if not os.path.exists(BOT_FILES_JSON):
-        atomic_write_json(BOT_FILES_JSON, {})
-    with open(BOT_FILES_JSON, "r", encoding="utf-8") as f:
-        return json.load(f)
+    return state_get("bot_files")
 
 def save_bot_files(bot_files):
-    with file_lock(BOT_FILES_JSON):
-        atomic_write_json(BOT_FILES_JSON, bot_files)
+    state_set("bot_files", bot_files)
+    invalidate_dedupe_index()
+
+# --------- بيانات الملفات وفهرس المحتوى ----------
+# bot_files يبقى {اسم: file_id}، وبيانات كل ملف (file_unique_id، الحجم، النوع) محفوظة في file_meta.
+# فهرس المحتوى يجمع كل مواضع نفس الملف (نفس file_unique_id) في الكتالوج، فيُكتشف الرفع المكرر فوراً.
+def load_file_meta():
+    return state_get("file_meta")
+
+def save_file_meta(meta):
+    state_set("file_meta", meta)
+    invalidate_dedupe_index()
+
+def file_meta_from(file_obj, **extra):
+    info = {"uid": getattr(file_obj, "file_unique_id", None), "size": getattr(file_obj, "file_size", None), "mime": getattr(file_obj, "mime_type", None)}
+    info.update(extra)
+    return {k: v for k, v in info.items() if v is not None}
+
+def content_key(file_id, meta):
+    # الملفات القديمة بدون بيانات تُجمع بالـ file_id نفسه
+    return meta.get(file_id, {}).get("uid") or file_id
+
+_dedupe_index = None  # content_key -> [(subject, lecture, name, file_id)]
+
+def invalidate_dedupe_index():
+    global _dedupe_index
+    _dedupe_index = None
+
+def get_dedupe_index():
+    global _dedupe_index
+    if _dedupe_index is None:
+        meta = load_file_meta()
+        index = {}
+        for subject, lectures in load_bot_files().items():
+            for lecture, files in lectures.items():
+                for name, file_id in files.items():
+                    index.setdefault(content_key(file_id, meta), []).append((subject, lecture, name, file_id))
+        _dedupe_index = index
+    return _dedupe_index
+
+def prune_file_meta(file_ids):
+    # بعد الحذف: بيانات file_id لم يعد أي عنصر في الكتالوج يشير إليه تُحذف، فلا يعيد
+    # find_source_upload ربط ملف محذوف (نفس file_id قد يكون مربوطاً في محاضرة أخرى فيبقى)
+    meta = load_file_meta()
+    referenced = {fid for lectures in load_bot_files().values() for files in lectures.values() for fid in files.values()}
+    gone = [fid for fid in set(file_ids) if fid in meta and fid not in referenced]
+    for fid in gone:
+        del meta[fid]
+    if gone:
+        save_file_meta(meta)
+
+def find_source_upload(src):
+    # ملف من الخادم سبق رفعه (نفس الاسم والحجم): نرجع file_id بدل رفعه من جديد
+    for file_id, info in load_file_meta().items():
+        if info.get("src") == src:
+            return file_id
+    return None
+
+def format_size(n):
+    for unit in ("B", "KB", "MB", "GB"):
+        if n < 1024 or unit == "GB":
+            return f"{n:.0f} {unit}" if unit == "B" else f"{n:.1f} {unit}"
+        n /= 1024
+
+TELEGRAM_TEXT_LIMIT = 4096     # أقصى طول لرسالة تيليجرام النصية
+DUPLICATES_REPORT_PLACES = 5   # أقصى عدد مواضع يُعرض لكل مجموعة في تقرير المكررات
+
+def format_duplicates_report(top=10):
+    meta = load_file_meta()
+    index = get_dedupe_index()
+    entries = sum(len(v) for v in index.values())
+    catalog_bytes = unique_bytes = unknown = 0
+    groups = []
+    for key, places in index.items():
+        size = max((meta.get(fid, {}).get("size", 0) for _, _, _, fid in places), default=0)
+        if not size:
+            unknown += len(places)
+        catalog_bytes += size * len(places)
+        unique_bytes += size
+        if len(places) > 1:
+            groups.append((size * (len(places) - 1), size, places))
+    groups.sort(key=lambda g: (-g[0], -len(g[2])))
+    lines = [
+        "🧮 تقرير الملفات المكررة:",
+        f"- عناصر الكتالوج: {entries} | ملفات فريدة: {len(index)}",
+        f"- الحجم الكلي: {format_size(catalog_bytes)} | بدون تكرار: {format_size(unique_bytes)}",
+        f"- حجم مكرر: {format_size(catalog_bytes - unique_bytes)} في {len(groups)} ملف",
+    ]
+    if unknown:
+        lines.append(f"- {unknown} عنصر بدون حجم معروف (رُفع قبل تسجيل بيانات الملفات)")
+    # الرسالة تبقى تحت حد تيليجرام: مواضع محدودة لكل مجموعة، ونتوقف قبل تجاوز الحد
+    length = len("\n".join(lines))
+    shown = 0
+    for wasted, size, places in groups[:top]:
+        block = [f"\n♻️ {len(places)} نسخ × {format_size(size) if size else 'حجم غير معروف'}:"]
+        block.extend(f"  • {s} > {l} > {n}" for s, l, n, _ in places[:DUPLICATES_REPORT_PLACES])
+        if len(places) > DUPLICATES_REPORT_PLACES:
+            block.append(f"  … (+{len(places) - DUPLICATES_REPORT_PLACES})")
+        block_len = len("\n".join(block)) + 1
+        if length + block_len > TELEGRAM_TEXT_LIMIT - 100:
+            break
+        lines.extend(block)
+        length += block_len
+        shown += 1
+    if shown < min(top, len(groups)):
+        lines.append(f"\n… و {min(top, len(groups)) - shown} مجموعة أخرى لم تُعرض")
+    return "\n".join(lines)
 
 # --------- الشكاوى/المقترحات ----------
 def load_complaints():
-    if not os.path.exists(COMPLAINTS_FILE):
-        atomic_write_json(COMPLAINTS_FILE, [])
-    with open(COMPLAINTS_FILE, "r", encoding="utf-8") as f:
-        return json.load(f)
+    return state_get("complaints")
 
 def save_complaints(lst):
-    with file_lock(COMPLAINTS_FILE):
-        atomic_write_json(COMPLAINTS_FILE, lst)
+    state_set("complaints", lst)
 
 def append_complaint(user_id, name, username, text):
     lst = load_complaints()
@@ -364,55 +1653,143 @@ def append_complaint(user_id, name, username, text):
     save_complaints(lst)
     return record
 
-# --------- سجل الدخول (إصلاح اللزق) ----------
-def _read_logged_entries():
-    if not os.path.exists(LOGGED_FILE):
-        return []
-    with open(LOGGED_FILE, "r", encoding="utf-8") as f:
-        content = f.read()
-    return re.findall(r"(\d+)\|([^\n\r]*)", content)
-
-def _write_logged_entries(entries):
-    dedup = {}
-    for uid, name in entries:
-        dedup[str(uid)] = name
-    with open(LOGGED_FILE, "w", encoding="utf-8") as f:
-        for uid, name in dedup.items():
-            f.write(f"{uid}|{name}\n")
-
-def fix_logged_file():
-    entries = _read_logged_entries()
-    _write_logged_entries(entries)
+# --------- سجل الدخول (فهرس الجلسات) ----------
+# الجلسات محفوظة في الذاكرة (user_id -> الاسم)، والتغييرات تُكتب على دفعات مع state_flusher
+# (خارج الـ event loop وتحت قفل الملف) بدل كتابة مع كل دخول/خروج.
+_sessions = None  # str(user_id) -> name
+_sessions_dirty = {}  # str(user_id) -> الاسم أو None (خروج) منذ آخر كتابة
+_sessions_lock = asyncio.Lock()
+
+def load_sessions():
+    global _sessions
+    _sessions = get_storage().load_sessions()
+    return _sessions
+
+def get_sessions():
+    if _sessions is None:
+        load_sessions()
+    return _sessions
+
+async def flush_sessions():
+    async with _sessions_lock:
+        if not _sessions_dirty:
+            return
+        changes = dict(_sessions_dirty)
+        _sessions_dirty.clear()
+        try:
+            await get_storage().save_sessions(changes)
+        except Exception:
+            logger.exception("Sessions flush failed")
+            for uid, name in changes.items():
+                _sessions_dirty.setdefault(uid, name)
+
+async def compact_sessions():
+    async with _sessions_lock:
+        await get_storage().compact_sessions(dict(get_sessions()))
+
+async def maybe_compact_sessions():
+    if _sessions is not None:
+        async with _sessions_lock:
+            await get_storage().maybe_compact_sessions(dict(_sessions))
 
 def is_logged_in(user_id):
     uid = str(user_id)
-    for u, _ in _read_logged_entries():
-        if u == uid:
-            return True
+    sessions = get_sessions()
+    if uid in sessions:
+        return True
+    # مع أكثر من worker ربما سجّل دخوله للتو في عملية أخرى
+    name = get_storage().get_session(uid)
+    if name is not None:
+        sessions[uid] = name
+        return True
     return False
 
 def log_user(user_id, student_name, student_code=None):
     uid = str(user_id)
-    entries = _read_logged_entries()
-    entries = [(u, n) for (u, n) in entries if u != uid]
-    entries.append((uid, student_name))
-    _write_logged_entries(entries)
-    append_line_safe(ALL_USERS_FILE, uid)
+    sessions = get_sessions()
+    if sessions.get(uid) != student_name:
+        sessions[uid] = student_name
+        _sessions_dirty[uid] = student_name
+    audience_add(user_id)
     if student_code:
         update_user_code(user_id, student_code)
 
 def logout_user(user_id):
     uid = str(user_id)
-    entries = _read_logged_entries()
-    entries = [(u, n) for (u, n) in entries if u != uid]
-    _write_logged_entries(entries)
+    sessions = get_sessions()
+    if uid in sessions:
+        del sessions[uid]
+        _sessions_dirty[uid] = None
 
 def get_logged_name(user_id):
-    uid = str(user_id)
-    for u, name in _read_logged_entries():
-        if u == uid:
-            return name
-    return None
+    return get_sessions().get(str(user_id))
+
+# --------- جمهور البث ----------
+# مجموعة في الذاكرة (فحص وإضافة O(1))، والتغييرات تُكتب على دفعات مع state_flusher.
+# "غير قابل للوصول" = حظر البوت أو حذف حسابه؛ يُستبعد من البث حتى يراسل البوت من جديد.
+_audience = None           # set(user_id)
+_audience_unreachable = set()
+_audience_added = set()    # أضيفوا منذ آخر كتابة
+_audience_status = {}      # user_id -> True (أصبح غير قابل للوصول) / False (عاد)
+_audience_lock = asyncio.Lock()
+
+def load_audience():
+    global _audience, _audience_unreachable
+    _audience, _audience_unreachable = get_storage().load_audience()
+    return _audience
+
+def get_audience():
+    if _audience is None:
+        load_audience()
+    return _audience
+
+def audience_add(user_id):
+    uid = int(user_id)
+    audience = get_audience()
+    if uid not in audience:
+        audience.add(uid)
+        _audience_added.add(uid)
+
+def audience_mark_unreachable(user_id):
+    uid = int(user_id)
+    get_audience()
+    if uid not in _audience_unreachable:
+        _audience_unreachable.add(uid)
+        _audience_status[uid] = True
+
+def audience_mark_reachable(user_id):
+    # يُستدعى مع كل رسالة، لذلك الحالة الغالبة مجرد فحص في set
+    uid = int(user_id)
+    get_audience()
+    if uid in _audience_unreachable:
+        _audience_unreachable.discard(uid)
+        _audience_status[uid] = False
+
+def audience_reachable_ids():
+    return get_audience() - _audience_unreachable
+
+def audience_unreachable_count():
+    get_audience()
+    return len(_audience_unreachable)
+
+async def flush_audience():
+    async with _audience_lock:
+        if not (_audience_added or _audience_status):
+            return
+        added = set(_audience_added)
+        status = dict(_audience_status)
+        _audience_added.clear()
+        _audience_status.clear()
+        try:
+            await get_storage().save_audience(set(_audience), set(_audience_unreachable), added, status)
+        except Exception:
+            logger.exception("Audience flush failed")
+            _audience_added.update(added)
+            for uid, bad in status.items():
+                _audience_status.setdefault(uid, bad)
+
+def load_all_user_ids():
+    return get_audience()
 
 # --------- إحصائيات ---------
 def load_json_safe(path, default):
@@ -425,38 +1802,57 @@ def load_json_safe(path, default):
         return default
 
 def load_stats():
-    stats = load_json_safe(STATS_FILE, {})
+    stats = state_get("stats")
     stats.setdefault("downloads_total", 0)
     stats.setdefault("file_downloads", {})
     stats.setdefault("user_activity", {})
     return stats
 
 def save_stats(stats):
-    atomic_write_json(STATS_FILE, stats)
+    state_set("stats", stats)
+
+# العدادات تتجمع في الذاكرة وتُدمج في stats دفعة واحدة كل STATS_FLUSH_INTERVAL ثانية
+# (وعند الإغلاق)، فأقصى ما يُفقد عند انهيار مفاجئ هو هذه النافذة فقط.
+STATS_FLUSH_INTERVAL = 30.0
+
+_pending_downloads = {}  # "subject|lecture|file" -> count
+_pending_activity = {}   # str(user_id) -> ts
+_stats_merged_at = 0.0
 
 def update_user_activity(user_id):
-    stats = load_stats()
-    stats["user_activity"][str(user_id)] = int(time.time())
-    save_stats(stats)
+    _pending_activity[str(user_id)] = int(time.time())
 
 def inc_download_count(subject, lecture, filename):
     key = f"{subject}|{lecture}|{filename}"
+    _pending_downloads[key] = _pending_downloads.get(key, 0) + 1
+
+def inc_download_counts(subject, lecture, filenames):
+    for filename in filenames:
+        inc_download_count(subject, lecture, filename)
+
+def merge_pending_stats():
+    global _stats_merged_at
+    _stats_merged_at = time.monotonic()
+    if not _pending_downloads and not _pending_activity:
+        return
     stats = load_stats()
-    stats["downloads_total"] = int(stats.get("downloads_total", 0)) + 1
-    file_downloads = stats.get("file_downloads", {})
-    file_downloads[key] = int(file_downloads.get(key, 0)) + 1
-    stats["file_downloads"] = file_downloads
+    file_downloads = stats["file_downloads"]
+    for key, cnt in _pending_downloads.items():
+        file_downloads[key] = int(file_downloads.get(key, 0)) + cnt
+        stats["downloads_total"] = int(stats.get("downloads_total", 0)) + cnt
+    stats["user_activity"].update(_pending_activity)
+    update_activity_index(_pending_activity)
+    _pending_downloads.clear()
+    _pending_activity.clear()
     save_stats(stats)
 
+def maybe_merge_pending_stats():
+    if time.monotonic() - _stats_merged_at >= STATS_FLUSH_INTERVAL:
+        merge_pending_stats()
+
 def get_stats_summary():
-    users = set()
-    if os.path.exists(ALL_USERS_FILE):
-        with open(ALL_USERS_FILE, "r", encoding="utf-8") as f:
-            for line in f:
-                line = line.strip()
-                if line.isdigit():
-                    users.add(int(line))
-    total_users = len(users)
+    merge_pending_stats()
+    total_users = len(load_all_user_ids())
     stats = load_stats()
     now = time.time()
     active_7d = sum(1 for ts in stats["user_activity"].values() if now - int(ts) <= 7*24*3600)
@@ -473,6 +1869,7 @@ def get_stats_summary():
         top_lines.append(f"- {subj} > {lect} > {fname}: {cnt}")
     return {
         "total_users": total_users,
+        "unreachable_users": audience_unreachable_count(),
         "active_7d": active_7d,
         "downloads_total": downloads_total,
         "files_with_downloads": files_with_downloads,
@@ -555,6 +1952,20 @@ async def render_current_menu(update: Update, context: ContextTypes.DEFAULT_TYPE
             await show_subjects_menu(update, context)
     elif menu == "admin_panel":
         await show_admin_panel(update, context)
+    elif menu == "add_item_file":
+        await show_add_item_prompt_file(update, context, context.user_data.get("selected_subject"), context.user_data.get("selected_lecture"))
+    elif menu == "add_item_large":
+        await show_large_upload_menu(update, context)
+    elif menu == "add_item_tts":
+        await show_tts_summary_prompt(update, context)
+    elif menu == "broadcast_jobs":
+        await show_broadcast_jobs(update, context)
+    elif menu == "admin_broadcast_audience":
+        await show_broadcast_audience_menu(update, context)
+    elif menu == "admin_broadcast_code_prefix":
+        await show_broadcast_prefix_prompt(update, context)
+    elif menu == "admin_broadcast_active_days":
+        await show_broadcast_days_prompt(update, context)
     elif menu == "admin_complaints_list":
         await show_admin_complaints_list(update, context, context.user_data.get("complaints_page", 0))
     elif menu == "delete_student_list":
@@ -658,10 +2069,82 @@ async def show_files_menu(update, context, selected_subject, selected_lecture):
     context.user_data["selected_lecture"] = selected_lecture
     enter_menu(context, "view_files")
     keyboard = [[KeyboardButton(f)] for f in files.keys()]
+    if len(files) > 1:
+        keyboard.insert(0, [KeyboardButton(SEND_ALL_FILES_BTN)])
     keyboard.append([KeyboardButton(BACK_BTN)])
     keyboard.append([KeyboardButton(MAIN_BTN)])
     await update.message.reply_text(f"{breadcrumbs(context)}\nاختر الملف الذي تريد تحميله في {selected_lecture}:", reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True))
 
+# --------- إرسال المحاضرة كاملة (media groups) ---------
+# نوع الملف من mime المحفوظ في file_meta، وللملفات القديمة بدون بيانات من امتداد الاسم
+MIME_KINDS = {"audio": "audio", "video": "video"}
+MEDIA_GROUP_MAX = 10
+# تيليجرام لا يسمح بخلط المستندات أو الصوتيات مع غيرها في نفس المجموعة
+MEDIA_GROUP_FAMILY = {"document": "document", "audio": "audio", "video": "visual"}
+INPUT_MEDIA = {"document": InputMediaDocument, "audio": InputMediaAudio, "video": InputMediaVideo}
+
+def file_kind(name, file_id, meta):
+    # تخمين: ملف صوتي أُرسل كمستند له file_id مستند، فيرفضه تيليجرام كصوت ونرسله كمستند
+    mime = meta.get(file_id, {}).get("mime") or mimetypes.guess_type(name)[0] or ""
+    return MIME_KINDS.get(mime.split("/")[0], "document")
+
+def plan_lecture_bundle(files, meta):
+    # ترجع دفعات [(family أو None, [(name, file_id, kind)])] بترتيب الملفات قدر الإمكان
+    groups = {}
+    singles = []
+    for name, file_id in files.items():
+        kind = file_kind(name, file_id, meta)
+        family = MEDIA_GROUP_FAMILY.get(kind)
+        if family:
+            groups.setdefault(family, []).append((name, file_id, kind))
+        else:
+            singles.append((None, [(name, file_id, kind)]))
+    batches = []
+    for family, items in groups.items():
+        for i in range(0, len(items), MEDIA_GROUP_MAX):
+            chunk = items[i:i + MEDIA_GROUP_MAX]
+            batches.append((family if len(chunk) > 1 else None, chunk))
+    return batches + singles
+
+async def send_single_file(message, name, file_id, kind):
+    try:
+        if kind == "audio":
+            return await message.reply_audio(audio=file_id, caption=name)
+        if kind == "video":
+            return await message.reply_video(video=file_id, caption=name)
+    except BadRequest as e:
+        # نوع مستنتج خطأ: المستند يقبل أي file_id
+        logger.warning("Sending %s as %s failed, sending it as a document: %s", name, kind, e)
+    return await message.reply_document(document=file_id, caption=name)
+
+async def send_retrying(send):
+    # RetryAfter يعني أن تيليجرام لم يرسل شيئاً: ننتظر المدة المطلوبة ونعيد (كما في البث)
+    attempts = 0
+    while True:
+        try:
+            return await send()
+        except RetryAfter as e:
+            attempts += 1
+            if attempts > BROADCAST_MAX_RETRIES:
+                raise
+            await asyncio.sleep(retry_after_seconds(e))
+
+async def send_lecture_bundle(message, files, sent):
+    # تضيف إلى sent أسماء الملفات التي أُرسلت أولاً بأول، فيبقى صحيحاً لو انقطع الإرسال في المنتصف
+    for family, items in plan_lecture_bundle(files, load_file_meta()):
+        if family:
+            media = [INPUT_MEDIA[kind](media=file_id, caption=name) for name, file_id, kind in items]
+            try:
+                await send_retrying(lambda: message.reply_media_group(media=media))
+                sent.extend(name for name, _, _ in items)
+                continue
+            except BadRequest as e:
+                # نوع مستنتج خطأ مثلاً: نرسل الملفات فرادى
+                logger.warning("Media group failed, sending files one by one: %s", e)
+        for name, file_id, kind in items:
+            await send_retrying(lambda: send_single_file(message, name, file_id, kind))
+            sent.append(name)
+
 # ------------------ لوحة الأدمن (ديناميكية حسب الصلاحيات) ------------------
 def build_admin_panel_keyboard(user_id: int):
     rows = []
@@ -673,6 +2156,7 @@ def build_admin_panel_keyboard(user_id: int):
         rows.append([KeyboardButton("➕ إضافة مادة جديدة"), KeyboardButton("➕ إضافة محاضرة جديدة")])
         rows.append([KeyboardButton("➕ إضافة عنصر جديد")])
         rows.append([KeyboardButton(RENAME_MENU_BTN), KeyboardButton(DELETE_MENU_BTN)])
+        rows.append([KeyboardButton(DUPLICATES_REPORT_BTN)])
     # إدارة الطلاب
     if can_admin(user_id, "student_add_delete") or can_admin(user_id, "student_edit") or can_admin(user_id, "suspend"):
         subrow = []
@@ -696,6 +2180,7 @@ def build_admin_panel_keyboard(user_id: int):
     last = []
     if can_admin(user_id, "broadcast"):
         last.append(KeyboardButton(BROADCAST_BTN))
+        last.append(KeyboardButton(BROADCAST_JOBS_BTN))
     if can_admin(user_id, "stats"):
         last.append(KeyboardButton(STATS_BTN))
     if last:
@@ -839,8 +2324,8 @@ async def show_add_item_prompt_file(update, context, selected_subject, selected_
     context.user_data["selected_subject"] = selected_subject
     context.user_data["selected_lecture"] = selected_lecture
     enter_menu(context, "add_item_file")
-    keyboard = [[KeyboardButton(CANCEL_UPLOAD_BTN)], [KeyboardButton(BACK_BTN)], [KeyboardButton(MAIN_BTN)]]
-    await update.message.reply_text("📎 أرسل الملف الذي تريد رفعه:", reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True))
+    keyboard = [[KeyboardButton(LARGE_UPLOAD_BTN)], [KeyboardButton(TTS_SUMMARY_BTN)], [KeyboardButton(CANCEL_UPLOAD_BTN)], [KeyboardButton(BACK_BTN)], [KeyboardButton(MAIN_BTN)]]
+    await update.message.reply_text("📎 أرسل الملفات التي تريد رفعها (يمكن إرسال أو إعادة توجيه عدة ملفات متتالية):", reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True))
 
 def is_allowed_upload(file_obj):
     name = getattr(file_obj, "file_name", "") or ""
@@ -852,6 +2337,400 @@ def is_allowed_upload(file_obj):
         return False
     return True
 
+# --------- طابور استقبال الملفات ---------
+# الأدمن قد يعيد توجيه عشرات الملفات متتالية: كل ملف يُضاف لدفعة الأدمن فقط، وبعد هدوء
+# INGEST_DEBOUNCE ثانية تُكتب الدفعة كلها في bot_files مرة واحدة ويصله رد واحد بالنتيجة.
+INGEST_DEBOUNCE = 2.0
+INGEST_SUMMARY_NAMES = 10  # أقصى عدد أسماء يُعرض لكل فئة في الملخص
+
+_ingest_batches = {}  # chat_id -> الدفعة الجارية
+_ingest_summaries = set()  # مهام إرسال ملخصات الدفعات المكتوبة (نحتفظ بمرجعها حتى تنتهي)
+
+def queue_ingest(bot, chat_id, subject, lecture, file_obj):
+    batch = _ingest_batches.get(chat_id)
+    if batch and (batch["subject"], batch["lecture"]) != (subject, lecture):
+        # تغيّرت المحاضرة أثناء الدفعة: نكتب السابقة فوراً، والرد وحده يُرسل في الخلفية
+        batch["task"].cancel()
+        result = commit_ingest_batch(_ingest_batches.pop(chat_id))
+        task = asyncio.create_task(send_ingest_summary(bot, chat_id, batch, result))
+        _ingest_summaries.add(task)
+        task.add_done_callback(_ingest_summaries.discard)
+        batch = None
+    if batch is None:
+        batch = _ingest_batches[chat_id] = {"subject": subject, "lecture": lecture, "items": {}, "rejected": [], "repeated": 0, "task": None}
+    file_id = file_obj.file_id
+    name = getattr(file_obj, "file_name", None) or f"{subject}-{lecture}-{file_id}"
+    unique_id = getattr(file_obj, "file_unique_id", None) or file_id
+    if not is_allowed_upload(file_obj):
+        batch["rejected"].append(name)
+    elif unique_id in batch["items"]:
+        batch["repeated"] += 1
+    else:
+        batch["items"][unique_id] = (name, file_id, file_meta_from(file_obj))
+    if batch["task"]:
+        batch["task"].cancel()
+    batch["task"] = asyncio.create_task(_ingest_after_quiet(bot, chat_id))
+
+async def _ingest_after_quiet(bot, chat_id):
+    await asyncio.sleep(INGEST_DEBOUNCE)
+    # بعد سحب الدفعة لا يلغي أي ملف جديد هذه المهمة (الملف الجديد يبدأ دفعة جديدة)
+    await finish_ingest_batch(bot, chat_id, _ingest_batches.pop(chat_id))
+
+def commit_ingest_batch(batch):
+    subject, lecture = batch["subject"], batch["lecture"]
+    index = get_dedupe_index()
+    bot_files = load_bot_files()
+    meta = load_file_meta()
+    result = {"added": [], "linked": [], "duplicate": [], "conflict": [], "rejected": batch["rejected"], "dropped": False}
+    lecture_files = bot_files.get(subject, {}).get(lecture)
+    if lecture_files is None:
+        # حُذفت المادة أو المحاضرة خلال مهلة الهدوء: لا نعيد إنشاءها، والدفعة كلها تُسقط
+        result["dropped"] = True
+        return result
+    existing_ids = set(lecture_files.values())
+    meta_changed = False
+    for unique_id, (name, file_id, info) in batch["items"].items():
+        places = index.get(unique_id, [])
+        if file_id in existing_ids or any(s == subject and l == lecture for s, l, _, _ in places):
+            result["duplicate"].append(name)
+        elif name in lecture_files:
+            result["conflict"].append(name)
+        elif places:
+            # نفس المحتوى موجود في محاضرة أخرى: نربط بنفس file_id بدل تخزين نسخة جديدة
+            s, l, n, existing_id = places[0]
+            lecture_files[name] = existing_id
+            existing_ids.add(existing_id)
+            result["linked"].append(f"{name} ← {s} > {l} > {n}")
+        else:
+            lecture_files[name] = file_id
+            existing_ids.add(file_id)
+            if info.get("uid"):
+                meta[file_id] = info
+                meta_changed = True
+            result["added"].append(name)
+    if result["added"] or result["linked"]:
+        save_bot_files(bot_files)
+    if meta_changed:
+        save_file_meta(meta)
+    return result
+
+def format_ingest_summary(batch, result):
+    def names(lst):
+        shown = "، ".join(lst[:INGEST_SUMMARY_NAMES])
+        return shown + (f" … (+{len(lst) - INGEST_SUMMARY_NAMES})" if len(lst) > INGEST_SUMMARY_NAMES else "")
+    received = len(batch["items"]) + batch["repeated"] + len(batch["rejected"])
+    if result["dropped"]:
+        return (f"❌ حُذفت {batch['subject']} > {batch['lecture']} أثناء الرفع، فلم يُحفظ أي من الـ {received} ملف.\n"
+                "اختر محاضرة موجودة وأعد إرسال الملفات.")
+    lines = [f"📥 تم استلام {received} ملف لـ {batch['subject']} > {batch['lecture']}:"]
+    lines.append(f"✅ أضيف {len(result['added'])}" + (f": {names(result['added'])}" if result["added"] else ""))
+    if result["linked"]:
+        lines.append(f"🔗 مرتبط بملف موجود في الكتالوج: {names(result['linked'])}")
+    repeated = len(result["duplicate"]) + batch["repeated"]
+    if repeated:
+        lines.append(f"♻️ مكرر (موجود بالفعل): {repeated}")
+    if result["conflict"]:
+        lines.append(f"⚠️ اسم مستخدم لملف آخر: {names(result['conflict'])}")
+    if result["rejected"]:
+        lines.append(f"❌ نوع أو حجم غير مسموح: {names(result['rejected'])}\n(للتسجيلات الكبيرة على الخادم استخدم زر \"{LARGE_UPLOAD_BTN}\")")
+    lines.append("يمكنك إرسال ملفات أخرى أو الرجوع.")
+    return "\n".join(lines)
+
+async def send_ingest_summary(bot, chat_id, batch, result):
+    try:
+        await bot.send_message(chat_id=chat_id, text=format_ingest_summary(batch, result))
+    except Exception:
+        logger.exception("Sending upload summary to %s failed", chat_id)
+
+async def finish_ingest_batch(bot, chat_id, batch):
+    result = commit_ingest_batch(batch)
+    await send_ingest_summary(bot, chat_id, batch, result)
+
+def commit_pending_ingests():
+    # عند الإغلاق: الدفعات المعلقة تُكتب بدون انتظار مهلة الهدوء
+    for chat_id, batch in list(_ingest_batches.items()):
+        batch["task"].cancel()
+        result = commit_ingest_batch(batch)
+        if result["dropped"]:
+            logger.warning("Dropped pending upload batch for %s: %s > %s no longer exists", chat_id, batch["subject"], batch["lecture"])
+        else:
+            logger.info("Committed pending upload batch for %s: %d added", chat_id, len(result["added"]))
+    _ingest_batches.clear()
+
+# ------------------ رفع التسجيلات الكبيرة عبر MTProto ------------------
+# التسجيلات الموضوعة على الخادم في LARGE_UPLOAD_DIR تُرفع عبر Telethon (بنفس توكن البوت) بأجزاء متوازية.
+# الأجزاء المرفوعة تُحفظ في LARGE_UPLOADS_FILE فيكمل الرفع بعد أي انقطاع من حيث توقف،
+# ثم نعيد توجيه الرسالة عبر Bot API لنحصل على file_id يُحفظ في bot_files ويُعاد استخدامه.
+TELEGRAM_API_ID = int(os.getenv("TELEGRAM_API_ID", "0") or 0)
+TELEGRAM_API_HASH = os.getenv("TELEGRAM_API_HASH", "")
+TELETHON_SESSION = os.getenv("TELETHON_SESSION", "mtproto_bot")
+LARGE_UPLOAD_DIR = os.getenv("LARGE_UPLOAD_DIR", "uploads")
+LARGE_UPLOAD_EXTS = {".mp4", ".mkv", ".m4a"}
+LARGE_UPLOADS_FILE = "large_uploads.json"
+LARGE_UPLOAD_PART_SIZE = 512 * 1024            # أقصى حجم للجزء في upload.saveBigFilePart
+LARGE_UPLOAD_MAX_PARTS = 4000                  # حد تيليجرام لعدد الأجزاء (~2GB للملف)
+LARGE_UPLOAD_BIG_THRESHOLD = 10 * 1024 * 1024  # الملفات الأكبر يجب رفعها كـ "big file"
+LARGE_UPLOAD_WORKERS = int(os.getenv("LARGE_UPLOAD_WORKERS", "4"))
+LARGE_UPLOAD_RETRIES = 3
+LARGE_UPLOAD_SAVE_EVERY = 32                   # حفظ التقدم كل 32 جزءاً (16MB)
+LARGE_UPLOAD_RESUME_TTL = 6 * 3600             # تيليجرام لا يحتفظ بالأجزاء غير المكتملة طويلاً
+
+class TelethonUploader:
+    # خط الرفع يستخدم save_part/send/close فقط، فأي كائن بنفس الدوال يصلح بديلاً (مثلاً عميل وهمي في الاختبار)
+    def __init__(self, client):
+        self.client = client
+
+    async def save_part(self, upload_id, index, total, data, big):
+        if big:
+            ok = await self.client(SaveBigFilePartRequest(upload_id, index, total, data))
+        else:
+            ok = await self.client(SaveFilePartRequest(upload_id, index, data))
+        if not ok:
+            raise RuntimeError(f"part {index} was not saved")
+
+    async def send(self, chat_id, upload_id, total, name, big, caption):
+        handle = InputFileBig(upload_id, total, name) if big else InputFile(upload_id, total, name, "")
+        message = await self.client.send_file(chat_id, handle, caption=caption, supports_streaming=True)
+        return message.id
+
+    async def close(self):
+        await self.client.disconnect()
+
+_mtproto_uploader = None
+_mtproto_lock = asyncio.Lock()  # إنشاء عميل Telethon مرة واحدة
+_large_upload_tasks = {}  # اسم الملف -> asyncio.Task
+
+def set_mtproto_uploader(uploader):
+    global _mtproto_uploader
+    _mtproto_uploader = uploader
+
+async def get_mtproto_uploader():
+    global _mtproto_uploader
+    if _mtproto_uploader is None and TelegramClient is not None and TELEGRAM_API_ID and TELEGRAM_API_HASH:
+        async with _mtproto_lock:
+            if _mtproto_uploader is None:
+                client = TelegramClient(TELETHON_SESSION, TELEGRAM_API_ID, TELEGRAM_API_HASH)
+                await client.start(bot_token=os.getenv("BOT_TOKEN") or TOKEN)
+                _mtproto_uploader = TelethonUploader(client)
+    return _mtproto_uploader
+
+def list_large_uploads():
+    if not os.path.isdir(LARGE_UPLOAD_DIR):
+        return []
+    return sorted(
+        name for name in os.listdir(LARGE_UPLOAD_DIR)
+        if os.path.splitext(name)[1].lower() in LARGE_UPLOAD_EXTS and os.path.isfile(os.path.join(LARGE_UPLOAD_DIR, name))
+    )
+
+def large_upload_key(path, st):
+    # تعديل الملف على القرص يبدأ رفعاً جديداً بدل خلط أجزاء قديمة وجديدة
+    return f"{os.path.abspath(path)}|{st.st_size}|{st.st_mtime_ns}"
+
+_large_uploads = None  # key -> حالة الرفع، نسخة واحدة يشترك فيها كل رفع جارٍ
+
+def load_large_uploads():
+    global _large_uploads
+    if _large_uploads is None:
+        _large_uploads = load_json_safe(LARGE_UPLOADS_FILE, {})
+    return _large_uploads
+
+async def save_large_uploads():
+    # اللقطة تؤخذ بعد أخذ القفل، فآخر كتابة تحمل تقدم كل الرفعات المتزامنة
+    async with file_lock(LARGE_UPLOADS_FILE):
+        text = json.dumps(load_large_uploads(), ensure_ascii=False)
+        await asyncio.to_thread(atomic_write_text, LARGE_UPLOADS_FILE, text)
+
+async def upload_large_file(uploader, path, chat_id, caption=None, progress=None):
+    # ترجع message_id لرسالة الملف في محادثة chat_id
+    st = os.stat(path)
+    total = max(1, -(-st.st_size // LARGE_UPLOAD_PART_SIZE))
+    if total > LARGE_UPLOAD_MAX_PARTS:
+        raise ValueError(f"{path} is larger than {LARGE_UPLOAD_MAX_PARTS * LARGE_UPLOAD_PART_SIZE} bytes")
+    big = st.st_size > LARGE_UPLOAD_BIG_THRESHOLD
+    key = large_upload_key(path, st)
+    now = time.time()
+    uploads = load_large_uploads()
+    for k in [k for k, e in uploads.items() if now - e["updated"] > LARGE_UPLOAD_RESUME_TTL]:
+        del uploads[k]
+    entry = uploads.get(key)
+    if entry is None or entry["part_size"] != LARGE_UPLOAD_PART_SIZE:
+        entry = uploads[key] = {"upload_id": secrets.randbits(63), "part_size": LARGE_UPLOAD_PART_SIZE, "total": total, "done": [], "updated": now}
+    done = set(entry["done"])
+    queue = deque(i for i in range(total) if i not in done)
+
+    async def persist():
+        entry["done"] = sorted(done)
+        entry["updated"] = time.time()
+        await save_large_uploads()
+        if progress:
+            await progress(len(done), total)
+
+    def read_part(f, index):
+        f.seek(index * LARGE_UPLOAD_PART_SIZE)
+        return f.read(LARGE_UPLOAD_PART_SIZE)
+
+    async def worker():
+        with open(path, "rb") as f:
+            while queue:
+                index = queue.popleft()
+                data = await asyncio.to_thread(read_part, f, index)
+                for attempt in range(LARGE_UPLOAD_RETRIES):
+                    try:
+                        await uploader.save_part(entry["upload_id"], index, total, data, big)
+                        break
+                    except Exception as e:
+                        if attempt == LARGE_UPLOAD_RETRIES - 1:
+                            raise
+                        # FloodWaitError يحمل مدة الانتظار في seconds
+                        await asyncio.sleep(getattr(e, "seconds", None) or 2 ** attempt)
+                done.add(index)
+                if len(done) % LARGE_UPLOAD_SAVE_EVERY == 0:
+                    await persist()
+
+    workers = [asyncio.create_task(worker()) for _ in range(min(LARGE_UPLOAD_WORKERS, len(queue)))]
+    try:
+        await asyncio.gather(*workers)
+    except BaseException:
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        raise
+    finally:
+        # الأجزاء المكتملة تبقى محفوظة حتى لو فشل الرفع أو أُلغي
+        await persist()
+    message_id = await uploader.send(chat_id, entry["upload_id"], total, os.path.basename(path), big, caption)
+    uploads.pop(key, None)
+    await save_large_uploads()
+    return message_id
+
+def large_upload_source(path):
+    return f"{os.path.basename(path)}|{os.path.getsize(path)}"
+
+async def publish_large_upload(bot, chat_id, message_id):
+    # file_id الخاص بـ Bot API يظهر فقط في رسالة يراها البوت عبر Bot API، فنعيد توجيهها ثم نحذف النسخة
+    forwarded = await bot.forward_message(chat_id=chat_id, from_chat_id=chat_id, message_id=message_id)
+    media = forwarded.video or forwarded.audio or forwarded.document
+    try:
+        await bot.delete_message(chat_id=chat_id, message_id=forwarded.message_id)
+    except BadRequest:
+        pass
+    return media
+
+async def run_large_upload(bot, uploader, chat_id, subject, lecture, name):
+    path = os.path.join(LARGE_UPLOAD_DIR, name)
+    last = [0]
+
+    async def progress(done, total):
+        percent = done * 100 // total
+        if percent - last[0] >= 10:
+            last[0] = percent
+            await bot.send_message(chat_id=chat_id, text=f"⏳ {name}: {percent}%")
+
+    try:
+        message_id = await upload_large_file(uploader, path, chat_id, caption=name, progress=progress)
+        media = await publish_large_upload(bot, chat_id, message_id)
+        file_id = media.file_id
+        bot_files = load_bot_files()
+        lecture_files = bot_files.setdefault(subject, {}).setdefault(lecture, {})
+        if name in lecture_files:
+            await bot.send_message(chat_id=chat_id, text=f"❌ يوجد ملف بنفس الاسم بالفعل: {name}")
+            return
+        lecture_files[name] = file_id
+        save_bot_files(bot_files)
+        # بيانات الملف (ومعها مصدره src) تُحفظ فقط بعد أن يصبح الملف في الكتالوج
+        meta = load_file_meta()
+        meta[file_id] = file_meta_from(media, src=large_upload_source(path))
+        save_file_meta(meta)
+        await bot.send_message(chat_id=chat_id, text=f"✅ تم رفع الملف: {name}")
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        logger.exception("Large upload of %s failed", path)
+        await bot.send_message(chat_id=chat_id, text=f"❌ تعذر رفع {name}. أعد اختياره لاستكمال الرفع من حيث توقف.")
+    finally:
+        _large_upload_tasks.pop(name, None)
+
+async def show_large_upload_menu(update, context):
+    names = list_large_uploads()
+    if not names:
+        await update.message.reply_text(f"❌ لا توجد تسجيلات ({', '.join(sorted(LARGE_UPLOAD_EXTS))}) في مجلد {LARGE_UPLOAD_DIR} على الخادم.")
+        return
+    enter_menu(context, "add_item_large")
+    keyboard = [[KeyboardButton(n)] for n in names]
+    keyboard.append([KeyboardButton(BACK_BTN)])
+    keyboard.append([KeyboardButton(MAIN_BTN)])
+    await update.message.reply_text("🎬 اختر التسجيل الذي تريد رفعه:", reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True))
+
+# ------------------ الملخصات الصوتية (gTTS) ------------------
+# التحويل يتم في مجموعة خيوط منفصلة حتى لا يوقف حلقة الأحداث، والنتيجة تُخزن في tts_cache
+# ببصمة sha256 للنص واللغة: نفس النص لا يُحوّل ولا يُرفع مرتين، ويُعاد استخدام file_id مباشرة.
+TTS_LANG = os.getenv("TTS_LANG", "ar")
+TTS_WORKERS = int(os.getenv("TTS_WORKERS", "2"))
+TTS_MAX_CHARS = 5000
+
+def gtts_synthesize(text, lang):
+    buf = io.BytesIO()
+    gTTS(text=text, lang=lang).write_to_fp(buf)
+    return buf.getvalue()
+
+_tts_backend = gtts_synthesize if gTTS is not None else None  # (text, lang) -> bytes بصيغة mp3
+_tts_executor = None
+_tts_inflight = {}  # بصمة -> asyncio.Task (طلبان متزامنان لنفس النص يشتركان في تحويل واحد)
+
+def set_tts_backend(backend):
+    global _tts_backend
+    _tts_backend = backend
+
+def tts_text_hash(text, lang):
+    text = " ".join(text.split())
+    return hashlib.sha256(f"{lang}\n{text}".encode("utf-8")).hexdigest()
+
+def load_tts_cache():
+    return state_get("tts_cache")
+
+def save_tts_cache(cache):
+    state_set("tts_cache", cache)
+
+def tts_summary_name(lecture):
+    return f"🔊 ملخص صوتي - {lecture}"
+
+async def synthesize_speech(text, lang):
+    global _tts_executor
+    if _tts_executor is None:
+        _tts_executor = ThreadPoolExecutor(max_workers=TTS_WORKERS, thread_name_prefix="tts")
+    with perf_timer("tts.synthesize"):
+        return await asyncio.get_running_loop().run_in_executor(_tts_executor, _tts_backend, text, lang)
+
+async def _synthesize_and_upload(bot, chat_id, text, lang, title, key):
+    audio = await synthesize_speech(text, lang)
+    message = await bot.send_audio(chat_id=chat_id, audio=audio, filename=f"{title}.mp3", title=title)
+    meta = load_file_meta()
+    meta[message.audio.file_id] = file_meta_from(message.audio)
+    save_file_meta(meta)
+    cache = load_tts_cache()
+    cache[key] = {"file_id": message.audio.file_id, "ts": int(time.time())}
+    save_tts_cache(cache)
+    return message.audio.file_id
+
+async def tts_summary_file_id(bot, chat_id, text, title, lang=TTS_LANG):
+    # ترجع (file_id, من الذاكرة؟)
+    key = tts_text_hash(text, lang)
+    hit = load_tts_cache().get(key)
+    if hit:
+        return hit["file_id"], True
+    task = _tts_inflight.get(key)
+    if task is None:
+        task = _tts_inflight[key] = asyncio.create_task(_synthesize_and_upload(bot, chat_id, text, lang, title, key))
+        task.add_done_callback(lambda _: _tts_inflight.pop(key, None))
+    return await asyncio.shield(task), False
+
+async def show_tts_summary_prompt(update, context):
+    if _tts_backend is None:
+        await update.message.reply_text("❌ الملخصات الصوتية غير مفعّلة (يتطلب تثبيت gTTS).")
+        return
+    enter_menu(context, "add_item_tts")
+    await update.message.reply_text(f"✍️ أرسل نص ملخص المحاضرة (حتى {TTS_MAX_CHARS} حرف) أو ملف .txt:", reply_markup=nav_keyboard())
+
 # ------------------ إعادة التسمية ------------------
 async def rename_subject_start(update, context):
     bot_files = load_bot_files()
@@ -1068,19 +2947,17 @@ async def delete_file_confirm(update, context, selected_subject, selected_lectur
 
 # ------------------ إدارة الطلاب ------------------
 def build_students_labels():
-    code_map = get_code_map()
-    items = []
-    for c, n in sorted(code_map.items(), key=lambda kv: (kv[1], kv[0])):
-        label = f"👤 {n} | {c}"
-        items.append(label)
-    return items
+    return get_roster()["labels"]
 
 def parse_code_from_label(label):
+    code = get_roster()["label_to_code"].get(label.strip())
+    if code:
+        return code
     m = re.search(r"(\d+)$", label.strip())
     return m.group(1) if m else None
 
-async def show_students_list_for_delete(update, context, page=0):
-    enter_menu(context, "delete_student_list")
+async def show_students_page(update, context, menu, title, page=0):
+    enter_menu(context, menu)
     labels = build_students_labels()
     total = len(labels)
     if total == 0:
@@ -1100,53 +2977,16 @@ async def show_students_list_for_delete(update, context, page=0):
     keyboard.append([KeyboardButton(BACK_BTN)])
     keyboard.append([KeyboardButton(MAIN_BTN)])
     context.user_data["students_page"] = page
-    await update.message.reply_text(f"🗑️ اختر الطالب للحذف (صفحة {page+1}/{((total-1)//STUDENTS_PAGE_SIZE)+1}):", reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True))
+    await update.message.reply_text(f"{title} (صفحة {page+1}/{((total-1)//STUDENTS_PAGE_SIZE)+1}):", reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True))
+
+async def show_students_list_for_delete(update, context, page=0):
+    await show_students_page(update, context, "delete_student_list", "🗑️ اختر الطالب للحذف", page)
 
 async def show_students_list_for_edit(update, context, page=0):
-    enter_menu(context, "edit_student_list")
-    labels = build_students_labels()
-    total = len(labels)
-    if total == 0:
-        await update.message.reply_text("لا يوجد طلاب.")
-        return
-    start = page * STUDENTS_PAGE_SIZE
-    end = start + STUDENTS_PAGE_SIZE
-    page_items = labels[start:end]
-    keyboard = [[KeyboardButton(x)] for x in page_items]
-    nav = []
-    if page > 0:
-        nav.append(KeyboardButton(PREV_BTN))
-    if end < total:
-        nav.append(KeyboardButton(NEXT_BTN))
-    if nav:
-        keyboard.append(nav)
-    keyboard.append([KeyboardButton(BACK_BTN)])
-    keyboard.append([KeyboardButton(MAIN_BTN)])
-    context.user_data["students_page"] = page
-    await update.message.reply_text(f"✏️ اختر الطالب للتعديل (صفحة {page+1}/{((total-1)//STUDENTS_PAGE_SIZE)+1}):", reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True))
+    await show_students_page(update, context, "edit_student_list", "✏️ اختر الطالب للتعديل", page)
 
 async def show_students_list_for_suspend(update, context, page=0):
-    enter_menu(context, "suspend_student_list")
-    labels = build_students_labels()
-    total = len(labels)
-    if total == 0:
-        await update.message.reply_text("لا يوجد طلاب.")
-        return
-    start = page * STUDENTS_PAGE_SIZE
-    end = start + STUDENTS_PAGE_SIZE
-    page_items = labels[start:end]
-    keyboard = [[KeyboardButton(x)] for x in page_items]
-    nav = []
-    if page > 0:
-        nav.append(KeyboardButton(PREV_BTN))
-    if end < total:
-        nav.append(KeyboardButton(NEXT_BTN))
-    if nav:
-        keyboard.append(nav)
-    keyboard.append([KeyboardButton(BACK_BTN)])
-    keyboard.append([KeyboardButton(MAIN_BTN)])
-    context.user_data["students_page"] = page
-    await update.message.reply_text(f"⏸️ اختر الطالب لإدارة الإيقاف (صفحة {page+1}/{((total-1)//STUDENTS_PAGE_SIZE)+1}):", reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True))
+    await show_students_page(update, context, "suspend_student_list", "⏸️ اختر الطالب لإدارة الإيقاف", page)
 
 # ------------------ استيراد الأكواد CSV ------------------
 async def import_codes_prompt(update, context):
@@ -1225,48 +3065,460 @@ async def admin_broadcast_collect(update, context, msg):
     else:
         await update.message.reply_text("❌ لم يتم التقاط محتوى للإرسال. أعد المحاولة.")
         return
+    await show_broadcast_audience_menu(update, context)
+
+async def show_broadcast_audience_menu(update, context):
+    enter_menu(context, "admin_broadcast_audience")
+    keyboard = [
+        [KeyboardButton(AUDIENCE_ALL_BTN), KeyboardButton(AUDIENCE_LOGGED_IN_BTN)],
+        [KeyboardButton(AUDIENCE_CODE_PREFIX_BTN), KeyboardButton(AUDIENCE_ACTIVE_BTN)],
+        [KeyboardButton(CANCEL_ACTION_BTN)], [KeyboardButton(BACK_BTN)], [KeyboardButton(MAIN_BTN)]
+    ]
+    await update.message.reply_text("🎯 إلى من تريد إرسال البث؟", reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True))
+
+async def show_broadcast_prefix_prompt(update, context):
+    enter_menu(context, "admin_broadcast_code_prefix")
+    await update.message.reply_text("🎓 اكتب بداية الكود (مثلاً 18152025):", reply_markup=nav_keyboard())
+
+async def show_broadcast_days_prompt(update, context):
+    enter_menu(context, "admin_broadcast_active_days")
+    await update.message.reply_text("⏱ اكتب عدد الأيام (مثلاً 7):", reply_markup=nav_keyboard())
+
+async def show_broadcast_confirm(update, context, audience):
+    context.user_data["broadcast_audience"] = audience
+    count = len(resolve_broadcast_audience(audience))
     enter_menu(context, "admin_broadcast_confirm")
     keyboard = [[KeyboardButton(CONFIRM_SEND_BTN)], [KeyboardButton(CANCEL_ACTION_BTN)], [KeyboardButton(BACK_BTN)], [KeyboardButton(MAIN_BTN)]]
-    await update.message.reply_text("📤 جاهز للإرسال. اضغط تأكيد للإرسال.", reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True))
+    await update.message.reply_text(f"📤 جاهز للإرسال إلى: {describe_broadcast_audience(audience)} ({count} مستخدم). اضغط تأكيد للإرسال.", reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True))
+
+class TokenBucket:
+    # حد معدل عام مشترك بين كل المرسلين، مع إمكانية إيقافه مؤقتاً عند RetryAfter
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+# الحد لكل البوت وليس لكل عملية: كل worker يأخذ حصة ثابتة BROADCAST_RATE / WORKER_COUNT
+# (بدون تنسيق عبر قاعدة البيانات)، فمجموع الإرسال لا يتجاوز الحد ولو أرسلت كل العمليات معاً
+_broadcast_bucket = TokenBucket(BROADCAST_RATE / WORKER_COUNT, max(1, BROADCAST_RATE / WORKER_COUNT))
+
+def retry_after_seconds(err: RetryAfter) -> float:
+    ra = err.retry_after
+    return ra.total_seconds() if hasattr(ra, "total_seconds") else float(ra)
+
+async def send_broadcast_payload(bot, chat_id, payload):
+    btype = payload.get("type")
+    text = payload.get("text", "")
+    if btype == "photo":
+        await bot.send_photo(chat_id=chat_id, photo=payload["photo_id"], caption=text if text else None)
+    elif btype == "video":
+        await bot.send_video(chat_id=chat_id, video=payload["video_id"], caption=text if text else None)
+    else:
+        await bot.send_message(chat_id=chat_id, text=text)
+
+# أخطاء BadRequest التي تعني أن المحادثة لم تعد موجودة (وليس خطأ في الرسالة نفسها)
+UNREACHABLE_CHAT_ERRORS = ("chat not found", "user not found", "peer_id_invalid", "user is deactivated")
+
+def classify_broadcast_error(err):
+    # "retry_after" | "unreachable" (دائم) | "transient" (شبكة) | "failed"
+    if isinstance(err, RetryAfter):
+        return "retry_after"
+    if isinstance(err, Forbidden):
+        # حظر البوت أو حساب محذوف
+        return "unreachable"
+    if isinstance(err, BadRequest):
+        msg = str(err).lower()
+        return "unreachable" if any(m in msg for m in UNREACHABLE_CHAT_ERRORS) else "failed"
+    if isinstance(err, NetworkError):
+        return "transient"
+    return "failed"
+
+async def deliver_broadcast(bot, chat_id, payload):
+    # ترجع: "sent" | "unreachable" | "failed"
+    attempts = 0
+    while True:
+        await _broadcast_bucket.acquire()
+        try:
+            await send_broadcast_payload(bot, chat_id, payload)
+            return "sent"
+        except Exception as e:
+            kind = classify_broadcast_error(e)
+            if kind == "unreachable":
+                audience_mark_unreachable(chat_id)
+                return "unreachable"
+            if kind == "failed":
+                return "failed"
+            attempts += 1
+            if attempts > BROADCAST_MAX_RETRIES:
+                logger.warning("Broadcast to %s gave up after %d attempts: %s", chat_id, attempts, e)
+                return "failed"
+            if kind == "retry_after":
+                _broadcast_bucket.pause(retry_after_seconds(e))
+            else:
+                await asyncio.sleep(min(2 ** attempts, 30))
+
+def broadcast_progress_text(counts, total, done=False):
+    processed = counts["sent"] + counts["failed"] + counts["unreachable"]
+    head = "✅ انتهى البث." if done else f"📤 جاري البث... {processed}/{total}"
+    text = (f"{head}\n- تم الإرسال: {counts['sent']}\n- أخفق: {counts['failed']}\n"
+            f"- حظر البوت/حساب محذوف (استُبعدوا من البث القادم): {counts['unreachable']}")
+    if done:
+        text += f"\n- إجمالي المستبعدين من البث: {audience_unreachable_count()}"
+    return text
+
+# --------- فئات الجمهور (بث موجّه) ---------
+# فهارس تُبنى عند أول طلب ثم تبقى محدثة:
+# - الأكواد: قائمة (code, user_id) مرتبة من users (بحث ببداية الكود عبر bisect)، تُلغى مع save_users
+# - النشاط: user_id -> يوم آخر نشاط، و يوم -> set(user_id)، تُحدّث تدريجياً مع merge_pending_stats
+_code_index = None
+_activity_day = None      # user_id -> day
+_activity_buckets = None  # day -> set(user_id)
+
+def invalidate_code_index():
+    global _code_index
+    _code_index = None
+
+def get_code_index():
+    global _code_index
+    if _code_index is None:
+        _code_index = sorted((str(i.get("code")), int(uid)) for uid, i in load_users().items() if i.get("code"))
+    return _code_index
+
+def _activity_set(uid, ts):
+    day = int(ts) // 86400
+    old = _activity_day.get(uid)
+    if old == day:
+        return
+    if old is not None:
+        bucket = _activity_buckets.get(old)
+        if bucket is not None:
+            bucket.discard(uid)
+            if not bucket:
+                del _activity_buckets[old]
+    _activity_day[uid] = day
+    _activity_buckets.setdefault(day, set()).add(uid)
+
+def update_activity_index(activity):
+    # activity: {str(user_id): ts} (التحديثات الجديدة فقط)
+    if _activity_day is None:
+        return
+    for uid, ts in activity.items():
+        _activity_set(int(uid), ts)
+
+def get_activity_buckets():
+    global _activity_day, _activity_buckets
+    if _activity_day is None:
+        _activity_day, _activity_buckets = {}, {}
+        update_activity_index(load_stats()["user_activity"])
+    return _activity_buckets
+
+def cohort_code_prefix(prefix):
+    index = get_code_index()
+    i = bisect.bisect_left(index, (prefix, -1))
+    ids = set()
+    while i < len(index) and index[i][0].startswith(prefix):
+        ids.add(index[i][1])
+        i += 1
+    return ids
+
+def cohort_active_days(days):
+    merge_pending_stats()
+    buckets = get_activity_buckets()
+    today = int(time.time()) // 86400
+    ids = set()
+    for day in range(today - days + 1, today + 1):
+        ids |= buckets.get(day, set())
+    return ids
+
+def resolve_broadcast_audience(audience):
+    # audience: {"kind": all|logged_in|code_prefix|active_days, "value": ...}
+    kind = (audience or {}).get("kind", "all")
+    if kind == "logged_in":
+        ids = {int(uid) for uid in get_sessions()}
+    elif kind == "code_prefix":
+        ids = cohort_code_prefix(audience["value"])
+    elif kind == "active_days":
+        ids = cohort_active_days(int(audience["value"]))
+    else:
+        return audience_reachable_ids()
+    return ids - _audience_unreachable
+
+def describe_broadcast_audience(audience):
+    kind = (audience or {}).get("kind", "all")
+    if kind == "logged_in":
+        return "المسجلون حالياً"
+    if kind == "code_prefix":
+        return f"الأكواد التي تبدأ بـ {audience['value']}"
+    if kind == "active_days":
+        return f"النشطون آخر {audience['value']} يوم"
+    return "كل المستخدمين"
+
+# --------- مهام البث (قابلة للاستئناف) ---------
+# كل بث مهمة صغيرة محفوظة في broadcast_jobs: المحتوى، عدد المستلمين، المؤشر والعدادات.
+# قائمة المستلمين ونتيجة كل مستلم (0 لم يُرسل بعد، 1 أُرسل، 2 لا يمكن الوصول إليه، 3 أخفق)
+# محفوظة في طبقة التخزين: القائمة تُكتب مرة واحدة والنتائج تُضاف على دفعات، فلا يُعاد
+# تسلسل آلاف العناصر مع كل كتابة. عند إعادة التشغيل تُستأنف المهام الجارية من أول مستلم لم يُرسل له.
+BROADCAST_OUTCOMES = {"sent": 1, "unreachable": 2, "failed": 3}
+BROADCAST_JOBS_KEEP = 5  # عدد المهام المنتهية التي نحتفظ بها
+BROADCAST_STATUS_LABELS = {"running": "▶️ جارٍ", "paused": "⏸ متوقف مؤقتاً", "cancelled": "🛑 ملغى", "done": "✅ انتهى"}
+
+_broadcast_tasks = {}  # job_id -> asyncio.Task
+
+def load_broadcast_jobs():
+    return state_get("broadcast_jobs")
+
+def save_broadcast_jobs(jobs):
+    state_set("broadcast_jobs", jobs)
+
+def get_broadcast_job(job_id):
+    return load_broadcast_jobs().get(str(job_id))
+
+async def create_broadcast_job(admin_chat_id, payload, ids, audience=None):
+    storage = get_storage()
+    jobs = load_broadcast_jobs()
+    finished = sorted((int(k) for k, j in jobs.items() if j["status"] in ("done", "cancelled")))
+    for k in finished[:max(0, len(finished) - BROADCAST_JOBS_KEEP + 1)]:
+        del jobs[str(k)]
+        await storage.drop_broadcast(k)
+    job_id = await storage.allocate_broadcast_id(max((int(k) for k in jobs), default=0))
+    recipients = sorted(ids)
+    await storage.create_broadcast_recipients(job_id, recipients)
+    job = {
+        "id": job_id,
+        "admin_chat_id": admin_chat_id,
+        "payload": payload,
+        "audience": audience or {"kind": "all"},
+        "status": "running",
+        "created": int(time.time()),
+        "total": len(recipients),
+        "cursor": 0,
+        "counts": {"sent": 0, "failed": 0, "unreachable": 0},
+    }
+    jobs[str(job_id)] = job
+    save_broadcast_jobs(jobs)
+    return job
+
+async def load_broadcast_recipients(job):
+    # ترجع (المستلمون، النتائج) وتعيد حساب المؤشر والعدادات من النتائج المحفوظة
+    storage = get_storage()
+    if "recipients" in job:
+        # مهمة محفوظة بالشكل القديم (القوائم داخل المستند): تُنقل مرة واحدة
+        await storage.create_broadcast_recipients(job["id"], job["recipients"])
+        await storage.append_broadcast_outcomes(job["id"], [(i, o) for i, o in enumerate(job["outcomes"]) if o])
+        job["total"] = len(job.pop("recipients"))
+        job.pop("outcomes")
+    recipients, outcomes = await storage.load_broadcast_progress(job["id"])
+    names = {v: k for k, v in BROADCAST_OUTCOMES.items()}
+    counts = {"sent": 0, "failed": 0, "unreachable": 0}
+    for outcome in outcomes:
+        if outcome:
+            counts[names[outcome]] += 1
+    job["counts"] = counts
+    job["cursor"] = next((i for i, o in enumerate(outcomes) if not o), len(outcomes))
+    return recipients, outcomes
+
+def unfinished_broadcast_jobs():
+    jobs = load_broadcast_jobs()
+    return [jobs[k] for k in sorted(jobs, key=int) if jobs[k]["status"] in ("running", "paused")]
+
+def broadcast_job_label(job):
+    done = sum(job["counts"].values())
+    return f"📢 #{job['id']} | {BROADCAST_STATUS_LABELS.get(job['status'], job['status'])} | {done}/{job.get('total', len(job.get('recipients', ())))}"
+
+def start_broadcast_job(application, job):
+    job["status"] = "running"
+    job["owner"] = WORKER_ID
+    save_broadcast_jobs(load_broadcast_jobs())
+    task = _broadcast_tasks.get(job["id"])
+    if task and not task.done():
+        # استئناف قبل أن يتوقف المرسلون تماماً: نفس المهمة تكمل
+        return
+    _broadcast_tasks[job["id"]] = asyncio.create_task(run_broadcast(application.bot, job))
+
+def resume_broadcast_jobs(application):
+    # كل worker يستأنف المهام التي كان يرسلها هو فقط
+    for job in unfinished_broadcast_jobs():
+        if job["status"] == "running" and job.get("owner", WORKER_ID) == WORKER_ID:
+            start_broadcast_job(application, job)
+
+def merge_reloaded_broadcast_jobs(old):
+    # المهام التي يرسلها هذا الـ worker الآن تبقى كائناتها المحلية (هي الأحدث)،
+    # مع الأخذ بالإيقاف/الإلغاء إذا طلبه أدمن من worker آخر
+    jobs = load_broadcast_jobs()
+    for job_id, task in _broadcast_tasks.items():
+        local = (old or {}).get(str(job_id))
+        if task.done() or local is None:
+            continue
+        remote = jobs.get(str(job_id))
+        if remote and remote["status"] in ("paused", "cancelled"):
+            local["status"] = remote["status"]
+        jobs[str(job_id)] = local
+
+async def run_broadcast(bot, job):
+    recipients, outcomes = await load_broadcast_recipients(job)
+    counts = job["counts"]
+    payload = job["payload"]
+    admin_chat_id = job["admin_chat_id"]
+    total = len(recipients)
+    pending = []  # (index, نتيجة) لم تُكتب بعد
+
+    async def flush_outcomes():
+        if not pending:
+            return
+        batch = pending[:]
+        del pending[:len(batch)]
+        try:
+            await get_storage().append_broadcast_outcomes(job["id"], batch)
+        except Exception:
+            logger.exception("Saving broadcast #%s outcomes failed", job["id"])
+            pending[:0] = batch
+
+    async def broadcast_pass():
+        queue = asyncio.Queue()
+        for i in range(job["cursor"], total):
+            if outcomes[i] == 0:
+                queue.put_nowait(i)
+
+        progress_msg = None
+        try:
+            progress_msg = await bot.send_message(admin_chat_id, broadcast_progress_text(counts, total))
+        except Exception:
+            pass
+
+        async def worker():
+            while job["status"] == "running":
+                try:
+                    i = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                res = await deliver_broadcast(bot, recipients[i], payload)
+                outcomes[i] = BROADCAST_OUTCOMES[res]
+                pending.append((i, outcomes[i]))
+                counts[res] += 1
+                cursor = job["cursor"]
+                while cursor < total and outcomes[cursor]:
+                    cursor += 1
+                job["cursor"] = cursor
+                # النتائج تُحفظ كل دفعة صغيرة، فلا يُعاد بعد انهيار إلا ما لم يُحفظ منها؛ أما
+                # المؤشر والعدادات فتُحسب من النتائج عند الاستئناف فلا يُكتب المستند هنا
+                if len(pending) >= BROADCAST_OUTCOME_BATCH:
+                    await flush_outcomes()
+
+        async def reporter():
+            last = None
+            while True:
+                await asyncio.sleep(BROADCAST_PROGRESS_INTERVAL)
+                await flush_outcomes()
+                txt = broadcast_progress_text(counts, total)
+                if progress_msg and txt != last:
+                    try:
+                        await progress_msg.edit_text(txt)
+                        last = txt
+                    except Exception:
+                        pass
+
+        rep = asyncio.create_task(reporter())
+        try:
+            while True:
+                await asyncio.gather(*[worker() for _ in range(max(1, min(BROADCAST_WORKERS, queue.qsize())))])
+                if job["status"] != "running" or queue.empty():
+                    break
+        finally:
+            rep.cancel()
+            await flush_outcomes()
+        if job["status"] == "running" and not queue.empty():
+            return  # استُؤنف أثناء حفظ النتائج: جولة جديدة
+        if job["status"] == "running":
+            job["status"] = "done"
+            save_broadcast_jobs(load_broadcast_jobs())
+            final = broadcast_progress_text(counts, total, done=True)
+        else:
+            # الإيقاف/الإلغاء حفظه من غيّر الحالة
+            final = f"{BROADCAST_STATUS_LABELS[job['status']]} (البث #{job['id']})\n" + broadcast_progress_text(counts, total).split("\n", 1)[1]
+        try:
+            await bot.send_message(admin_chat_id, final)
+        except Exception:
+            logger.warning("Broadcast finished but report failed: %s", counts)
+
+    # الاستئناف أثناء انتظار التقرير الأخير يجد هذه المهمة لم تنتهِ بعد فلا يبدأ غيرها،
+    # لذا نعيد فحص الحالة بعد كل جولة ونكمل ما بقي إن عادت "running"
+    while True:
+        await broadcast_pass()
+        if job["status"] != "running":
+            return counts
 
 async def admin_broadcast_send(update, context):
     if not can_admin(update.effective_user.id, "broadcast"):
         await update.message.reply_text("❌ ليس لديك صلاحية بث الإشعارات.")
         return
     user_data = context.user_data
-    btype = user_data.get("broadcast_type")
-    text = user_data.get("broadcast_text", "")
-
-    ids = set()
-    if os.path.exists(ALL_USERS_FILE):
-        with open(ALL_USERS_FILE, "r", encoding="utf-8") as f:
-            for line in f:
-                line = line.strip()
-                if line.isdigit():
-                    ids.add(int(line))
-
-    sent = 0
-    fail = 0
-    for uid in ids:
-        try:
-            if btype == "photo":
-                await context.bot.send_photo(chat_id=uid, photo=user_data["broadcast_photo_id"], caption=text if text else None)
-            elif btype == "video":
-                await context.bot.send_video(chat_id=uid, video=user_data["broadcast_video_id"], caption=text if text else None)
-            else:
-                await context.bot.send_message(chat_id=uid, text=text)
-            sent += 1
-            await asyncio.sleep(0.05)
-        except Exception:
-            fail += 1
-            continue
+    payload = {
+        "type": user_data.get("broadcast_type"),
+        "text": user_data.get("broadcast_text", ""),
+        "photo_id": user_data.get("broadcast_photo_id"),
+        "video_id": user_data.get("broadcast_video_id"),
+    }
+    audience = user_data.get("broadcast_audience") or {"kind": "all"}
+    ids = resolve_broadcast_audience(audience)
 
-    for k in ["broadcast_type", "broadcast_text", "broadcast_photo_id", "broadcast_video_id"]:
+    for k in ["broadcast_type", "broadcast_text", "broadcast_photo_id", "broadcast_video_id", "broadcast_audience"]:
         user_data.pop(k, None)
 
-    await update.message.reply_text(f"✅ تم الإرسال إلى {sent} مستخدم. أخفق {fail}.")
+    # المهمة تُكتب فوراً قبل أول إرسال، ثم تعمل في الخلفية حتى لا يتعطل الأدمن أو باقي المستخدمين
+    job = await create_broadcast_job(update.effective_chat.id, payload, ids, audience)
+    await flush_state()
+    start_broadcast_job(context.application, job)
+    skipped = audience_unreachable_count()
+    note = f" (تم تخطي {skipped} لا يمكن الوصول إليهم)" if skipped else ""
+    await update.message.reply_text(f"📤 بدأ البث #{job['id']} في الخلفية إلى {len(ids)} مستخدم - {describe_broadcast_audience(audience)}{note}. ستصلك تحديثات التقدم.")
     await show_admin_panel(update, context)
 
+async def show_broadcast_jobs(update, context):
+    enter_menu(context, "broadcast_jobs")
+    jobs = unfinished_broadcast_jobs()
+    keyboard = [[KeyboardButton(broadcast_job_label(j))] for j in jobs]
+    keyboard.append([KeyboardButton(BACK_BTN)])
+    keyboard.append([KeyboardButton(MAIN_BTN)])
+    msg = "📋 مهام البث الجارية/المتوقفة:" if jobs else "لا توجد مهام بث جارية."
+    await update.message.reply_text(msg, reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True))
+
+async def show_broadcast_job(update, context, job):
+    enter_menu(context, "broadcast_job")
+    context.user_data["selected_broadcast_job"] = job["id"]
+    keyboard = []
+    if job["status"] == "running":
+        keyboard.append([KeyboardButton(PAUSE_BROADCAST_BTN)])
+    elif job["status"] == "paused":
+        keyboard.append([KeyboardButton(RESUME_BROADCAST_BTN)])
+    if job["status"] in ("running", "paused"):
+        keyboard.append([KeyboardButton(CANCEL_BROADCAST_BTN)])
+    keyboard.append([KeyboardButton(BACK_BTN)])
+    keyboard.append([KeyboardButton(MAIN_BTN)])
+    counts = job["counts"]
+    text = (f"{broadcast_job_label(job)}\n- تم الإرسال: {counts['sent']}\n- أخفق: {counts['failed']}\n"
+            f"- لا يمكن الوصول إليهم: {counts['unreachable']}")
+    await update.message.reply_text(text, reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True))
+
 # ------------------ لوحة إدارة الأدمنز (للسوبر أدمن) ------------------
 async def show_manage_admins_menu(update, context):
     enter_menu(context, "manage_admins")
@@ -1343,1087 +3595,1183 @@ def toggle_perm_for_admin(admin_id: int, perm_label_text: str):
             return key, not current
     return None, None
 
-# ------------------ المنطق الرئيسي ------------------
-async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
-    update_user_registry_from_update(update)
-    msg = update.message
+# ------------------ موجّه الرسائل (جدول التوجيه) ------------------
+# كل مسار: (القائمة الحالية أو None، نص الزر أو None) -> (الدالة، الصلاحية).
+# ترتيب البحث: (القائمة، النص) ثم (None، النص) لأزرار عامة ثم (القائمة، None) لإدخال حر.
+# الصلاحية: None للجميع | "admin" لأي أدمن | "super" للمالك | أو مفتاح من PERM_KEYS.
+ROUTES = {}
+
+PERM_DENIED_MSGS = {
+    "content": "❌ ليس لديك صلاحية إدارة المحتوى.",
+    "student_add_delete": "❌ ليس لديك صلاحية إضافة/حذف الطلاب.",
+    "student_edit": "❌ ليس لديك صلاحية تعديل بيانات الطالب.",
+    "suspend": "❌ ليس لديك صلاحية الإيقاف/الإلغاء.",
+    "complaints": "❌ ليس لديك صلاحية عرض الشكاوى.",
+    "stats": "❌ ليس لديك صلاحية الإحصائيات.",
+    "broadcast": "❌ ليس لديك صلاحية بث الإشعارات.",
+}
+
+DEFAULT_REPLY = "من فضلك اختر من القوائم المتاحة أو استخدم أزرار التنقل."
+
+def route(menu=None, text=None, perm=None):
+    texts = text if isinstance(text, (list, tuple, set)) else [text]
+    def deco(fn):
+        for t in texts:
+            ROUTES[(menu, t)] = (fn, perm)
+        return fn
+    return deco
+
+def iter_routes():
+    # لأغراض الاختبار والقياس: ((menu, text), handler, perm)
+    for key, (fn, perm) in ROUTES.items():
+        yield key, fn, perm
+
+def route_visible(user_id, perm):
+    # مسارات الأدمن غير موجودة أصلاً بالنسبة لغير الأدمن
+    if perm is None:
+        return True
+    if perm == "super":
+        return is_super_admin(user_id)
+    return is_admin(user_id)
+
+def resolve_route(user_id, menu, text):
+    for key in ((menu, text), (None, text), (menu, None)):
+        r = ROUTES.get(key)
+        if r and route_visible(user_id, r[1]):
+            return r
+    return None
+
+async def reply_default(update):
+    await update.message.reply_text(DEFAULT_REPLY)
+
+def nav_keyboard():
+    return ReplyKeyboardMarkup([[KeyboardButton(BACK_BTN)], [KeyboardButton(MAIN_BTN)]], resize_keyboard=True)
+
+def confirm_keyboard(confirm_btn):
+    return ReplyKeyboardMarkup([[KeyboardButton(confirm_btn)], [KeyboardButton(CANCEL_ACTION_BTN)], [KeyboardButton(BACK_BTN)], [KeyboardButton(MAIN_BTN)]], resize_keyboard=True)
+
+def student_method_keyboard():
+    return ReplyKeyboardMarkup([[KeyboardButton(SELECT_BY_CODE_BTN)], [KeyboardButton(SELECT_FROM_LIST_BTN)], [KeyboardButton(SEARCH_STUDENT_BTN)], [KeyboardButton(BACK_BTN)], [KeyboardButton(MAIN_BTN)]], resize_keyboard=True)
+
+# ------------------ المنطق الرئيسي ------------------
+async def handle_login(update, context, text):
+    user_id = update.effective_user.id
+    if not text:
+        await update.message.reply_text("من فضلك أدخل كود الطالب:")
+        return
+    user_code = normalize_code(text)
+    if not user_code or not user_code.isdigit() or len(user_code) < 5:
+        await update.message.reply_text("من فضلك اكتب كود الطالب بالأرقام فقط.")
+        return
+    # تحقق من الإيقاف
+    suspension = is_code_suspended(user_code)
+    if suspension:
+        reason = suspension.get("reason", "بدون سبب مذكور")
+        await update.message.reply_text(f"🚫 حسابك موقوف مؤقتًا.\nالسبب: {reason}\nللاستفسار يرجى مراسلة الإدارة.")
+        return
+    student = check_code(user_code)
+    if student:
+        if not student.get("name"):
+            await update.message.reply_text("✅ الكود صحيح لكن لا يوجد اسم مسجّل لهذا الكود. رجاءً حدّث ملف الأكواد.")
+            return
+        log_user(user_id, student["name"], student_code=user_code)
+        await update.message.reply_text(f"✅ تم التحقق من الكود بنجاح! مرحباً {student['name']} 🌟")
+        await show_main_menu(update, context, user_id)
+    else:
+        await update.message.reply_text("❌ كود غير صحيح. حاول مرة أخرى:")
+
+async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    update_user_registry_from_update(update)
+    msg = update.message
     text = msg.text.strip() if (msg and msg.text) else ""
-    user_data = context.user_data
 
     # تتبع النشاط
     update_user_activity(user_id)
+    audience_mark_reachable(user_id)
 
     # تسجيل دخول
     if not is_logged_in(user_id):
-        if not text:
-            await update.message.reply_text("من فضلك أدخل كود الطالب:")
-            return
-        user_code = normalize_code(text)
-        if not user_code or not user_code.isdigit() or len(user_code) < 5:
-            await update.message.reply_text("من فضلك اكتب كود الطالب بالأرقام فقط.")
-            return
-        # تحقق من الإيقاف
-        suspension = is_code_suspended(user_code)
-        if suspension:
-            reason = suspension.get("reason", "بدون سبب مذكور")
-            await update.message.reply_text(f"🚫 حسابك موقوف مؤقتًا.\nالسبب: {reason}\nللاستفسار يرجى مراسلة الإدارة.")
-            return
-        student = check_code(user_code)
-        if student:
-            if not student.get("name"):
-                await update.message.reply_text("✅ الكود صحيح لكن لا يوجد اسم مسجّل لهذا الكود. رجاءً حدّث ملف الأكواد.")
-                return
-            log_user(user_id, student["name"], student_code=user_code)
-            await update.message.reply_text(f"✅ تم التحقق من الكود بنجاح! مرحباً {student['name']} 🌟")
-            await show_main_menu(update, context, user_id)
-        else:
-            await update.message.reply_text("❌ كود غير صحيح. حاول مرة أخرى:")
+        await handle_login(update, context, text)
         return
 
-    # أزرار التنقل
-    if text in {MAIN_BTN, "⬅️ رجوع للقائمة الرئيسية"}:
-        await show_main_menu(update, context, user_id)
+    r = resolve_route(user_id, context.user_data.get("current_menu"), text)
+    if r is None:
+        # رد افتراضي
+        await reply_default(update)
         return
-    if text == BACK_BTN:
-        await go_back(update, context)
+    handler, perm = r
+    if perm in PERM_DENIED_MSGS and not can_admin(user_id, perm):
+        await update.message.reply_text(PERM_DENIED_MSGS[perm])
         return
+    with perf_timer("route." + handler.__name__):
+        await handler(update, context, text)
+
+# --------- التنقل العام ---------
+@route(text=[MAIN_BTN, "⬅️ رجوع للقائمة الرئيسية"])
+async def on_main_menu(update, context, text):
+    await show_main_menu(update, context, update.effective_user.id)
+
+@route(text=BACK_BTN)
+async def on_back(update, context, text):
+    await go_back(update, context)
+
+@route(menu="add_item_file", text=CANCEL_UPLOAD_BTN)
+async def on_cancel_upload(update, context, text):
+    await show_main_menu(update, context, update.effective_user.id)
+
+# قوائم الأزرار فقط (التأكيد واختيار الطريقة): أي نص آخر يُتجاهل بدون رد كما كان سابقاً
+@route(menu="admin_broadcast_confirm", perm="admin")
+@route(menu="admin_delete_student_confirm", perm="admin")
+@route(menu="admin_delete_student_method", perm="admin")
+@route(menu="admin_edit_student_choose_field", perm="admin")
+@route(menu="admin_edit_student_method", perm="admin")
+@route(menu="admin_suspend_method", perm="admin")
+@route(menu="delete_admin_confirm", perm="admin")
+@route(menu="delete_file_confirm", perm="admin")
+@route(menu="delete_lecture_confirm", perm="admin")
+@route(menu="delete_subject_confirm", perm="admin")
+async def on_buttons_only_menu(update, context, text):
+    return
+
+@route(text="🚪 تسجيل الخروج")
+async def on_logout(update, context, text):
+    logout_user(update.effective_user.id)
+    context.user_data.clear()
+    await update.message.reply_text("🚪 تم تسجيل الخروج بنجاح.\nأدخل كود الطالب لتسجيل الدخول من جديد:", reply_markup=ReplyKeyboardRemove())
 
-    # إلغاء أثناء الرفع
-    if user_data.get("current_menu") == "add_item_file" and text == CANCEL_UPLOAD_BTN:
-        await show_main_menu(update, context, user_id)
-        return
+# --------- بياناتي ---------
+@route(text="👤 بياناتي")
+async def on_my_data(update, context, text):
+    await show_my_data(update, context)
 
-    # تسجيل الخروج
-    if text == "🚪 تسجيل الخروج":
-        logout_user(user_id)
-        user_data.clear()
-        await update.message.reply_text("🚪 تم تسجيل الخروج بنجاح.\nأدخل كود الطالب لتسجيل الدخول من جديد:", reply_markup=ReplyKeyboardRemove())
-        return
+@route(menu="my_data", text=["📆 الجدول الدراسي", "🕒 الغياب والحضور"])
+async def on_my_data_soon(update, context, text):
+    await update.message.reply_text("❗ لم يتم إضافة هذه الميزة بعد")
 
-    # بياناتي
-    if text == "👤 بياناتي":
-        await show_my_data(update, context)
-        return
-    if user_data.get("current_menu") == "my_data":
-        if text in ["📆 الجدول الدراسي", "🕒 الغياب والحضور"]:
-            await update.message.reply_text("❗ لم يتم إضافة هذه الميزة بعد")
-        return
+@route(menu="my_data")
+async def on_my_data_other(update, context, text):
+    return
 
-    # إرسال مقترح/شكوى (لكل المستخدمين)
-    if text == SEND_SUGGEST_BTN:
-        await user_suggest_start(update, context)
-        return
-    if user_data.get("current_menu") == "user_suggest_text" and text not in {CANCEL_ACTION_BTN, BACK_BTN, MAIN_BTN}:
+# --------- إرسال مقترح/شكوى (لكل المستخدمين) ---------
+@route(text=SEND_SUGGEST_BTN)
+async def on_suggest(update, context, text):
+    await user_suggest_start(update, context)
+
+@route(menu="user_suggest_text")
+async def on_suggest_text(update, context, text):
+    if text:
         await user_suggest_confirm(update, context, text)
-        return
-    if user_data.get("current_menu") == "user_suggest_confirm":
-        if text == CONFIRM_SEND_BTN:
-            await user_suggest_send(update, context)
-        elif text == CANCEL_ACTION_BTN:
-            await show_main_menu(update, context, user_id)
-        return
+    else:
+        await reply_default(update)
 
-    # قائمة المحاضرات
-    if text == "📚 المحاضرات":
-        await show_subjects_menu(update, context)
-        return
-    if user_data.get("current_menu") == "view_subjects" and text not in {BACK_BTN, MAIN_BTN}:
-        selected_subject = text.strip()
-        bot_files = load_bot_files()
-        if selected_subject not in bot_files:
-            await update.message.reply_text("❌ هذه المادة غير موجودة!")
-            return
-        await show_lectures_menu(update, context, selected_subject)
-        return
-    if user_data.get("current_menu") == "view_lectures" and text not in {BACK_BTN, MAIN_BTN}:
-        selected_lecture = text.strip()
-        selected_subject = user_data.get("selected_subject")
-        bot_files = load_bot_files()
-        if (not selected_subject) or (selected_subject not in bot_files) or (selected_lecture not in bot_files[selected_subject]):
-            await update.message.reply_text("❌ هذه المحاضرة غير موجودة!")
-            return
-        await show_files_menu(update, context, selected_subject, selected_lecture)
-        return
-    if user_data.get("current_menu") == "view_files" and text not in {BACK_BTN, MAIN_BTN}:
-        selected_subject = user_data.get("selected_subject")
-        selected_lecture = user_data.get("selected_lecture")
-        bot_files = load_bot_files()
-        files = bot_files.get(selected_subject, {}).get(selected_lecture, {})
-        if text not in files:
-            await update.message.reply_text("❌ الملف غير موجود! اختر من القائمة.")
-            return
-        file_id = files[text]
-        await update.message.reply_document(document=file_id, filename=text)
-        inc_download_count(selected_subject, selected_lecture, text)
-        return
+@route(menu="user_suggest_text", text=CANCEL_ACTION_BTN)
+@route(menu="user_suggest_confirm", text=CANCEL_ACTION_BTN)
+async def on_suggest_cancel(update, context, text):
+    await show_main_menu(update, context, update.effective_user.id)
 
-    # -------- خصائص الأدمن --------
-    if is_admin(user_id):
-        # لوحة الأدمن
-        if text == ADMIN_PANEL_BTN:
-            await show_admin_panel(update, context)
-            return
+@route(menu="user_suggest_confirm", text=CONFIRM_SEND_BTN)
+async def on_suggest_send(update, context, text):
+    await user_suggest_send(update, context)
 
-        # إدارة الأدمنز (سوبر فقط)
-        if is_super_admin(user_id):
-            if text == MANAGE_ADMINS_BTN:
-                await show_manage_admins_menu(update, context)
-                return
+@route(menu="user_suggest_confirm")
+async def on_suggest_confirm_other(update, context, text):
+    return
 
-            if user_data.get("current_menu") == "manage_admins":
-                if text == LIST_ADMINS_BTN:
-                    await show_admins_list(update, context, 0)
-                    return
-                if text == ADD_ADMIN_BTN:
-                    enter_menu(context, "super_add_admin_method")
-                    keyboard = [
-                        [KeyboardButton(ADD_BY_ID_BTN)],
-                        [KeyboardButton(ADD_BY_USERNAME_BTN)],
-                        [KeyboardButton(ADD_BY_CONTACT_BTN)],
-                        [KeyboardButton(BACK_BTN)],
-                        [KeyboardButton(MAIN_BTN)]
-                    ]
-                    await update.message.reply_text("اختر طريقة إضافة الأدمن:", reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True))
-                    return
-                if text == EDIT_ADMIN_PERMS_BTN:
-                    await show_admins_list(update, context, 0, purpose="edit_perms")
-                    return
-                if text == DELETE_ADMIN_BTN:
-                    await show_admins_list(update, context, 0, purpose="delete_admin")
-                    return
-
-            # إضافة أدمن - الطرق المختلفة
-            if user_data.get("current_menu") == "super_add_admin_method":
-                if text == ADD_BY_ID_BTN:
-                    enter_menu(context, "super_add_admin_id")
-                    await update.message.reply_text("أدخل ID الأدمن الجديد (أرقام):", reply_markup=ReplyKeyboardMarkup([[KeyboardButton(BACK_BTN)], [KeyboardButton(MAIN_BTN)]], resize_keyboard=True))
-                    return
-                if text == ADD_BY_USERNAME_BTN:
-                    enter_menu(context, "super_add_admin_username")
-                    await update.message.reply_text("أدخل Username بدون @:", reply_markup=ReplyKeyboardMarkup([[KeyboardButton(BACK_BTN)], [KeyboardButton(MAIN_BTN)]], resize_keyboard=True))
-                    return
-                if text == ADD_BY_CONTACT_BTN:
-                    enter_menu(context, "super_add_admin_contact")
-                    kb = ReplyKeyboardMarkup([
-                        [KeyboardButton("📱 أرسل جهة الاتصال الآن", request_contact=True)],
-                        [KeyboardButton(BACK_BTN)],
-                        [KeyboardButton(MAIN_BTN)]
-                    ], resize_keyboard=True)
-                    await update.message.reply_text("أرسل جهة الاتصال الخاصة بالمرشح (إذا كان user_id متاحًا).", reply_markup=kb)
-                    return
+# --------- قائمة المحاضرات ---------
+@route(text="📚 المحاضرات")
+async def on_lectures(update, context, text):
+    await show_subjects_menu(update, context)
 
-            if user_data.get("current_menu") == "super_add_admin_id" and text not in {BACK_BTN, MAIN_BTN}:
-                if text.isdigit():
-                    new_id = int(text)
-                    if new_id == OWNER_ID:
-                        await update.message.reply_text("المستخدم هو المالك بالفعل.")
-                    else:
-                        _admins_set.add(new_id)
-                        save_admins()
-                        ensure_admin_perms_entry(new_id)
-                        await update.message.reply_text(f"✅ تم إضافة الأدمن: {admin_label(new_id)}")
-                    await show_manage_admins_menu(update, context)
-                else:
-                    await update.message.reply_text("❌ أدخل ID رقمي صالح.")
-                return
+@route(menu="view_subjects")
+async def on_view_subject(update, context, text):
+    selected_subject = text.strip()
+    bot_files = load_bot_files()
+    if selected_subject not in bot_files:
+        await update.message.reply_text("❌ هذه المادة غير موجودة!")
+        return
+    await show_lectures_menu(update, context, selected_subject)
 
-            if user_data.get("current_menu") == "super_add_admin_username" and text not in {BACK_BTN, MAIN_BTN}:
-                uid = find_user_id_by_username(text)
-                if uid:
-                    if uid == OWNER_ID:
-                        await update.message.reply_text("المستخدم هو المالك بالفعل.")
-                    else:
-                        _admins_set.add(uid)
-                        save_admins()
-                        ensure_admin_perms_entry(uid)
-                        await update.message.reply_text(f"✅ تم إضافة الأدمن: {admin_label(uid)}")
-                    await show_manage_admins_menu(update, context)
-                else:
-                    await update.message.reply_text("❌ لم يتم العثور على هذا المستخدم في سجل البوت. اطلب منه بدء محادثة مع البوت أو استخدم طريقة ID.")
-                return
+@route(menu="view_lectures")
+async def on_view_lecture(update, context, text):
+    selected_lecture = text.strip()
+    selected_subject = context.user_data.get("selected_subject")
+    bot_files = load_bot_files()
+    if (not selected_subject) or (selected_subject not in bot_files) or (selected_lecture not in bot_files[selected_subject]):
+        await update.message.reply_text("❌ هذه المحاضرة غير موجودة!")
+        return
+    await show_files_menu(update, context, selected_subject, selected_lecture)
 
-            if user_data.get("current_menu") == "super_add_admin_contact":
-                if msg and msg.contact:
-                    c = msg.contact
-                    cid = getattr(c, "user_id", None)
-                    if cid:
-                        if cid == OWNER_ID:
-                            await update.message.reply_text("المستخدم هو المالك بالفعل.")
-                        else:
-                            _admins_set.add(cid)
-                            save_admins()
-                            ensure_admin_perms_entry(cid)
-                            await update.message.reply_text(f"✅ تم إضافة الأدمن: {admin_label(cid)}")
-                        await show_manage_admins_menu(update, context)
-                    else:
-                        await update.message.reply_text("❌ هذه الجهة لا تحتوي user_id. اطلب من المرشح بدء محادثة مع البوت أو استخدم ID/Username.")
-                else:
-                    await update.message.reply_text("أرسل جهة اتصال صالحة أو ارجع للخلف.")
-                return
+@route(menu="view_files", text=SEND_ALL_FILES_BTN)
+async def on_view_all_files(update, context, text):
+    selected_subject = context.user_data.get("selected_subject")
+    selected_lecture = context.user_data.get("selected_lecture")
+    files = load_bot_files().get(selected_subject, {}).get(selected_lecture, {})
+    if not files:
+        await update.message.reply_text("❌ لا توجد ملفات في هذه المحاضرة.")
+        return
+    sent = []
+    try:
+        await send_lecture_bundle(update.message, dict(files), sent)
+    finally:
+        # ما وصل قبل أي خطأ يُحتسب
+        inc_download_counts(selected_subject, selected_lecture, sent)
 
-            # اختيار أدمن لتعديل صلاحياته
-            if user_data.get("current_menu") == "edit_admin_perms_select":
-                page = user_data.get("admins_page", 0)
-                if text == NEXT_BTN:
-                    await show_admins_list(update, context, page + 1, purpose="edit_perms")
-                    return
-                if text == PREV_BTN and page > 0:
-                    await show_admins_list(update, context, page - 1, purpose="edit_perms")
-                    return
-                aid = parse_admin_id_from_label(text)
-                if aid:
-                    if aid == OWNER_ID:
-                        await update.message.reply_text("❌ لا يمكن تعديل صلاحيات المالك.")
-                        return
-                    context.user_data["selected_admin_id"] = aid
-                    await show_edit_admin_perms_menu(update, context, aid)
-                return
+@route(menu="view_files")
+async def on_view_file(update, context, text):
+    selected_subject = context.user_data.get("selected_subject")
+    selected_lecture = context.user_data.get("selected_lecture")
+    bot_files = load_bot_files()
+    files = bot_files.get(selected_subject, {}).get(selected_lecture, {})
+    if text not in files:
+        await update.message.reply_text("❌ الملف غير موجود! اختر من القائمة.")
+        return
+    file_id = files[text]
+    await update.message.reply_document(document=file_id, filename=text)
+    inc_download_count(selected_subject, selected_lecture, text)
 
-            # تعديل الصلاحيات (التبديل)
-            if user_data.get("current_menu") == "edit_admin_perms":
-                aid = context.user_data.get("selected_admin_id")
-                if text in {BACK_BTN, MAIN_BTN}:
-                    await show_manage_admins_menu(update, context)
-                    return
-                key, new_val = toggle_perm_for_admin(aid, text)
-                if key is not None:
-                    await show_edit_admin_perms_menu(update, context, aid)
-                else:
-                    await update.message.reply_text("اختر أحد الأسطر لتبديل حالته.")
-                return
+# -------- خصائص الأدمن --------
+@route(text=ADMIN_PANEL_BTN, perm="admin")
+async def on_admin_panel(update, context, text):
+    await show_admin_panel(update, context)
 
-            # حذف أدمن
-            if user_data.get("current_menu") == "delete_admin_select":
-                page = user_data.get("admins_page", 0)
-                if text == NEXT_BTN:
-                    await show_admins_list(update, context, page + 1, purpose="delete_admin")
-                    return
-                if text == PREV_BTN and page > 0:
-                    await show_admins_list(update, context, page - 1, purpose="delete_admin")
-                    return
-                aid = parse_admin_id_from_label(text)
-                if aid:
-                    if aid == OWNER_ID:
-                        await update.message.reply_text("❌ لا يمكن حذف المالك.")
-                        return
-                    context.user_data["selected_admin_id"] = aid
-                    enter_menu(context, "delete_admin_confirm")
-                    keyboard = [[KeyboardButton(CONFIRM_DELETE_BTN)], [KeyboardButton(CANCEL_ACTION_BTN)], [KeyboardButton(BACK_BTN)], [KeyboardButton(MAIN_BTN)]]
-                    await update.message.reply_text(f"⚠️ حذف الأدمن:\n{admin_label(aid)}\nتأكيد؟", reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True))
-                return
-            if user_data.get("current_menu") == "delete_admin_confirm":
-                if text == CONFIRM_DELETE_BTN:
-                    aid = context.user_data.get("selected_admin_id")
-                    if aid and aid in _admins_set:
-                        _admins_set.discard(aid)
-                        save_admins()
-                        # إزالة صلاحياته
-                        if str(aid) in _admin_perms:
-                            _admin_perms.pop(str(aid), None)
-                            save_admin_perms()
-                    await update.message.reply_text("✅ تم حذف الأدمن.")
-                    await show_manage_admins_menu(update, context)
-                elif text == CANCEL_ACTION_BTN:
-                    await show_manage_admins_menu(update, context)
-                return
+# --------- إدارة الأدمنز (سوبر فقط) ---------
+@route(text=MANAGE_ADMINS_BTN, perm="super")
+async def on_manage_admins(update, context, text):
+    await show_manage_admins_menu(update, context)
 
-        # إدارة المحتوى (صلاحية content)
-        if text == "➕ إضافة مادة جديدة":
-            if not can_admin(user_id, "content"):
-                await update.message.reply_text("❌ ليس لديك صلاحية إدارة المحتوى.")
-                return
-            await show_add_subject_prompt(update, context)
-            return
+@route(menu="manage_admins", text=LIST_ADMINS_BTN, perm="super")
+async def on_list_admins(update, context, text):
+    await show_admins_list(update, context, 0)
 
-        if user_data.get("current_menu") == "add_subject" and text not in {BACK_BTN, MAIN_BTN}:
-            if not can_admin(user_id, "content"):
-                await update.message.reply_text("❌ ليس لديك صلاحية إدارة المحتوى.")
-                return
-            new_subject = text.strip()
-            if not new_subject:
-                await update.message.reply_text("❌ أدخل اسم مادة صالح.")
-                return
-            bot_files = load_bot_files()
-            if new_subject in bot_files:
-                await update.message.reply_text("❌ المادة موجودة بالفعل!")
-            else:
-                bot_files[new_subject] = {}
-                save_bot_files(bot_files)
-                await update.message.reply_text(f"✅ تم إضافة المادة: {new_subject}")
-            await show_admin_panel(update, context)
-            return
+@route(menu="manage_admins", text=ADD_ADMIN_BTN, perm="super")
+async def on_add_admin(update, context, text):
+    enter_menu(context, "super_add_admin_method")
+    keyboard = [
+        [KeyboardButton(ADD_BY_ID_BTN)],
+        [KeyboardButton(ADD_BY_USERNAME_BTN)],
+        [KeyboardButton(ADD_BY_CONTACT_BTN)],
+        [KeyboardButton(BACK_BTN)],
+        [KeyboardButton(MAIN_BTN)]
+    ]
+    await update.message.reply_text("اختر طريقة إضافة الأدمن:", reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True))
+
+@route(menu="manage_admins", text=EDIT_ADMIN_PERMS_BTN, perm="super")
+async def on_edit_admin_perms(update, context, text):
+    await show_admins_list(update, context, 0, purpose="edit_perms")
+
+@route(menu="manage_admins", text=DELETE_ADMIN_BTN, perm="super")
+async def on_delete_admin(update, context, text):
+    await show_admins_list(update, context, 0, purpose="delete_admin")
+
+# إضافة أدمن - الطرق المختلفة
+@route(menu="super_add_admin_method", text=ADD_BY_ID_BTN, perm="super")
+async def on_add_admin_by_id(update, context, text):
+    enter_menu(context, "super_add_admin_id")
+    await update.message.reply_text("أدخل ID الأدمن الجديد (أرقام):", reply_markup=nav_keyboard())
+
+@route(menu="super_add_admin_method", text=ADD_BY_USERNAME_BTN, perm="super")
+async def on_add_admin_by_username(update, context, text):
+    enter_menu(context, "super_add_admin_username")
+    await update.message.reply_text("أدخل Username بدون @:", reply_markup=nav_keyboard())
+
+@route(menu="super_add_admin_method", text=ADD_BY_CONTACT_BTN, perm="super")
+async def on_add_admin_by_contact(update, context, text):
+    enter_menu(context, "super_add_admin_contact")
+    kb = ReplyKeyboardMarkup([
+        [KeyboardButton("📱 أرسل جهة الاتصال الآن", request_contact=True)],
+        [KeyboardButton(BACK_BTN)],
+        [KeyboardButton(MAIN_BTN)]
+    ], resize_keyboard=True)
+    await update.message.reply_text("أرسل جهة الاتصال الخاصة بالمرشح (إذا كان user_id متاحًا).", reply_markup=kb)
 
-        if text == "➕ إضافة محاضرة جديدة":
-            if not can_admin(user_id, "content"):
-                await update.message.reply_text("❌ ليس لديك صلاحية إدارة المحتوى.")
-                return
-            await show_add_lecture_select_subject(update, context)
-            return
+async def add_admin_and_reply(update, context, new_id):
+    if new_id == OWNER_ID:
+        await update.message.reply_text("المستخدم هو المالك بالفعل.")
+    else:
+        _admins_set.add(new_id)
+        save_admins()
+        ensure_admin_perms_entry(new_id)
+        await update.message.reply_text(f"✅ تم إضافة الأدمن: {admin_label(new_id)}")
+    await show_manage_admins_menu(update, context)
+
+@route(menu="super_add_admin_id", perm="super")
+async def on_add_admin_id(update, context, text):
+    if text.isdigit():
+        await add_admin_and_reply(update, context, int(text))
+    else:
+        await update.message.reply_text("❌ أدخل ID رقمي صالح.")
 
-        if user_data.get("current_menu") == "add_lecture_subject" and text not in {BACK_BTN, MAIN_BTN}:
-            if not can_admin(user_id, "content"):
-                await update.message.reply_text("❌ ليس لديك صلاحية إدارة المحتوى.")
-                return
-            selected_subject = text.strip()
-            bot_files = load_bot_files()
-            if selected_subject not in bot_files:
-                await update.message.reply_text("❌ هذه المادة غير موجودة!")
-                return
-            await show_add_lecture_prompt_name(update, context, selected_subject)
-            return
+@route(menu="super_add_admin_username", perm="super")
+async def on_add_admin_username(update, context, text):
+    uid = find_user_id_by_username(text)
+    if uid:
+        await add_admin_and_reply(update, context, uid)
+    else:
+        await update.message.reply_text("❌ لم يتم العثور على هذا المستخدم في سجل البوت. اطلب منه بدء محادثة مع البوت أو استخدم طريقة ID.")
 
-        if user_data.get("current_menu") == "add_lecture_name" and text not in {BACK_BTN, MAIN_BTN}:
-            if not can_admin(user_id, "content"):
-                await update.message.reply_text("❌ ليس لديك صلاحية إدارة المحتوى.")
-                return
-            new_lecture = text.strip()
-            selected_subject = user_data.get("selected_subject")
-            bot_files = load_bot_files()
-            if not selected_subject or selected_subject not in bot_files:
-                await update.message.reply_text("❌ حدث خطأ. أعد المحاولة.")
-                await show_add_lecture_select_subject(update, context)
-                return
-            if not new_lecture:
-                await update.message.reply_text("❌ أدخل اسم محاضرة صالح.")
-                return
-            if new_lecture in bot_files[selected_subject]:
-                await update.message.reply_text("❌ المحاضرة موجودة بالفعل!")
-            else:
-                bot_files[selected_subject][new_lecture] = {}
-                save_bot_files(bot_files)
-                await update.message.reply_text(f"✅ تم إضافة المحاضرة: {new_lecture} في المادة: {selected_subject}")
-            await show_admin_panel(update, context)
-            return
+@route(menu="super_add_admin_contact", perm="super")
+async def on_add_admin_contact(update, context, text):
+    msg = update.message
+    if msg and msg.contact:
+        cid = getattr(msg.contact, "user_id", None)
+        if cid:
+            await add_admin_and_reply(update, context, cid)
+        else:
+            await update.message.reply_text("❌ هذه الجهة لا تحتوي user_id. اطلب من المرشح بدء محادثة مع البوت أو استخدم ID/Username.")
+    else:
+        await update.message.reply_text("أرسل جهة اتصال صالحة أو ارجع للخلف.")
 
-        if text == "➕ إضافة عنصر جديد":
-            if not can_admin(user_id, "content"):
-                await update.message.reply_text("❌ ليس لديك صلاحية إدارة المحتوى.")
-                return
-            await show_add_item_select_subject(update, context)
-            return
+# اختيار أدمن لتعديل صلاحياته
+@route(menu="edit_admin_perms_select", text=NEXT_BTN, perm="super")
+async def on_edit_perms_next(update, context, text):
+    await show_admins_list(update, context, context.user_data.get("admins_page", 0) + 1, purpose="edit_perms")
 
-        if user_data.get("current_menu") == "add_item_subject" and text not in {BACK_BTN, MAIN_BTN}:
-            if not can_admin(user_id, "content"):
-                await update.message.reply_text("❌ ليس لديك صلاحية إدارة المحتوى.")
-                return
-            selected_subject = text.strip()
-            bot_files = load_bot_files()
-            if selected_subject not in bot_files:
-                await update.message.reply_text("❌ هذه المادة غير موجودة!")
-                return
-            await show_add_item_select_lecture(update, context, selected_subject)
+@route(menu="edit_admin_perms_select", text=PREV_BTN, perm="super")
+async def on_edit_perms_prev(update, context, text):
+    page = context.user_data.get("admins_page", 0)
+    if page > 0:
+        await show_admins_list(update, context, page - 1, purpose="edit_perms")
+
+@route(menu="edit_admin_perms_select", perm="super")
+async def on_edit_perms_select(update, context, text):
+    aid = parse_admin_id_from_label(text)
+    if aid:
+        if aid == OWNER_ID:
+            await update.message.reply_text("❌ لا يمكن تعديل صلاحيات المالك.")
             return
+        context.user_data["selected_admin_id"] = aid
+        await show_edit_admin_perms_menu(update, context, aid)
+
+# تعديل الصلاحيات (التبديل)
+@route(menu="edit_admin_perms", text=[BACK_BTN, MAIN_BTN], perm="super")
+async def on_edit_perms_back(update, context, text):
+    await show_manage_admins_menu(update, context)
+
+@route(menu="edit_admin_perms", perm="super")
+async def on_toggle_perm(update, context, text):
+    aid = context.user_data.get("selected_admin_id")
+    key, new_val = toggle_perm_for_admin(aid, text)
+    if key is not None:
+        await show_edit_admin_perms_menu(update, context, aid)
+    else:
+        await update.message.reply_text("اختر أحد الأسطر لتبديل حالته.")
 
-        if user_data.get("current_menu") == "add_item_lecture" and text not in {BACK_BTN, MAIN_BTN}:
-            if not can_admin(user_id, "content"):
-                await update.message.reply_text("❌ ليس لديك صلاحية إدارة المحتوى.")
-                return
-            selected_lecture = text.strip()
-            selected_subject = user_data.get("selected_subject")
-            bot_files = load_bot_files()
-            if (not selected_subject) or (selected_subject not in bot_files) or (selected_lecture not in bot_files[selected_subject]):
-                await update.message.reply_text("❌ المحاضرة غير موجودة!")
-                return
-            await show_add_item_prompt_file(update, context, selected_subject, selected_lecture)
-            return
+# حذف أدمن
+@route(menu="delete_admin_select", text=NEXT_BTN, perm="super")
+async def on_delete_admin_next(update, context, text):
+    await show_admins_list(update, context, context.user_data.get("admins_page", 0) + 1, purpose="delete_admin")
 
-        if user_data.get("current_menu") == "add_item_file":
-            if not can_admin(user_id, "content"):
-                await update.message.reply_text("❌ ليس لديك صلاحية إدارة المحتوى.")
-                return
-            file_obj = None
-            if msg:
-                file_obj = msg.document or msg.audio or msg.video
-            if file_obj:
-                if not is_allowed_upload(file_obj):
-                    await update.message.reply_text("❌ نوع الملف أو حجمه غير مسموح. الأنواع: PDF/PPT/صوت/فيديو وحجم ≤ 50MB.")
-                    return
-                file_id = file_obj.file_id
-                if hasattr(file_obj, "file_name") and file_obj.file_name:
-                    file_name = file_obj.file_name
-                else:
-                    ss = user_data.get("selected_subject", "subject")
-                    sl = user_data.get("selected_lecture", "lecture")
-                    file_name = f"{ss}-{sl}-{file_id}"
-                selected_subject = user_data.get("selected_subject")
-                selected_lecture = user_data.get("selected_lecture")
-                bot_files = load_bot_files()
-                if selected_subject not in bot_files:
-                    bot_files[selected_subject] = {}
-                if selected_lecture not in bot_files[selected_subject]:
-                    bot_files[selected_subject][selected_lecture] = {}
-                if file_name in bot_files[selected_subject][selected_lecture]:
-                    await update.message.reply_text("❌ يوجد ملف بنفس الاسم بالفعل.")
-                    return
-                bot_files[selected_subject][selected_lecture][file_name] = file_id
-                save_bot_files(bot_files)
-                await update.message.reply_text(f"✅ تم رفع الملف: {file_name}")
-                await show_admin_panel(update, context)
-            else:
-                await update.message.reply_text("❌ لم يتم التعرف على أي ملف. أعد المحاولة أو استخدم زر إلغاء الرفع.")
+@route(menu="delete_admin_select", text=PREV_BTN, perm="super")
+async def on_delete_admin_prev(update, context, text):
+    page = context.user_data.get("admins_page", 0)
+    if page > 0:
+        await show_admins_list(update, context, page - 1, purpose="delete_admin")
+
+@route(menu="delete_admin_select", perm="super")
+async def on_delete_admin_select(update, context, text):
+    aid = parse_admin_id_from_label(text)
+    if aid:
+        if aid == OWNER_ID:
+            await update.message.reply_text("❌ لا يمكن حذف المالك.")
             return
+        context.user_data["selected_admin_id"] = aid
+        enter_menu(context, "delete_admin_confirm")
+        await update.message.reply_text(f"⚠️ حذف الأدمن:\n{admin_label(aid)}\nتأكيد؟", reply_markup=confirm_keyboard(CONFIRM_DELETE_BTN))
+
+@route(menu="delete_admin_confirm", text=CONFIRM_DELETE_BTN, perm="super")
+async def on_delete_admin_confirm(update, context, text):
+    aid = context.user_data.get("selected_admin_id")
+    if aid and aid in _admins_set:
+        _admins_set.discard(aid)
+        save_admins()
+        # إزالة صلاحياته
+        if str(aid) in _admin_perms:
+            _admin_perms.pop(str(aid), None)
+            save_admin_perms()
+    await update.message.reply_text("✅ تم حذف الأدمن.")
+    await show_manage_admins_menu(update, context)
+
+@route(menu="delete_admin_confirm", text=CANCEL_ACTION_BTN, perm="super")
+async def on_delete_admin_cancel(update, context, text):
+    await show_manage_admins_menu(update, context)
+
+# --------- إدارة المحتوى (صلاحية content) ---------
+@route(text="➕ إضافة مادة جديدة", perm="content")
+async def on_add_subject(update, context, text):
+    await show_add_subject_prompt(update, context)
+
+@route(menu="add_subject", perm="content")
+async def on_add_subject_name(update, context, text):
+    new_subject = text.strip()
+    if not new_subject:
+        await update.message.reply_text("❌ أدخل اسم مادة صالح.")
+        return
+    bot_files = load_bot_files()
+    if new_subject in bot_files:
+        await update.message.reply_text("❌ المادة موجودة بالفعل!")
+    else:
+        bot_files[new_subject] = {}
+        save_bot_files(bot_files)
+        await update.message.reply_text(f"✅ تم إضافة المادة: {new_subject}")
+    await show_admin_panel(update, context)
 
-        if text == RENAME_MENU_BTN:
-            if not can_admin(user_id, "content"):
-                await update.message.reply_text("❌ ليس لديك صلاحية إدارة المحتوى.")
-                return
-            enter_menu(context, "admin_rename_menu")
-            keyboard = [[KeyboardButton(RENAME_SUBJECT_BTN)], [KeyboardButton(RENAME_LECTURE_BTN)], [KeyboardButton(RENAME_FILE_BTN)], [KeyboardButton(BACK_BTN)], [KeyboardButton(MAIN_BTN)]]
-            await update.message.reply_text("اختر ما تريد إعادة تسميته:", reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True))
-            return
+@route(text="➕ إضافة محاضرة جديدة", perm="content")
+async def on_add_lecture(update, context, text):
+    await show_add_lecture_select_subject(update, context)
 
-        if text == RENAME_SUBJECT_BTN:
-            if not can_admin(user_id, "content"):
-                await update.message.reply_text("❌ ليس لديك صلاحية إدارة المحتوى.")
-                return
-            await rename_subject_start(update, context)
-            return
+@route(menu="add_lecture_subject", perm="content")
+async def on_add_lecture_subject(update, context, text):
+    selected_subject = text.strip()
+    bot_files = load_bot_files()
+    if selected_subject not in bot_files:
+        await update.message.reply_text("❌ هذه المادة غير موجودة!")
+        return
+    await show_add_lecture_prompt_name(update, context, selected_subject)
 
-        if user_data.get("current_menu") == "rename_subject_select" and text not in {BACK_BTN, MAIN_BTN}:
-            if not can_admin(user_id, "content"):
-                await update.message.reply_text("❌ ليس لديك صلاحية إدارة المحتوى.")
-                return
-            context.user_data["selected_subject"] = text.strip()
-            enter_menu(context, "rename_subject_newname")
-            await update.message.reply_text(f"✏️ أدخل الاسم الجديد للمادة '{text.strip()}':", reply_markup=ReplyKeyboardMarkup([[KeyboardButton(BACK_BTN)], [KeyboardButton(MAIN_BTN)]], resize_keyboard=True))
-            return
+@route(menu="add_lecture_name", perm="content")
+async def on_add_lecture_name(update, context, text):
+    new_lecture = text.strip()
+    selected_subject = context.user_data.get("selected_subject")
+    bot_files = load_bot_files()
+    if not selected_subject or selected_subject not in bot_files:
+        await update.message.reply_text("❌ حدث خطأ. أعد المحاولة.")
+        await show_add_lecture_select_subject(update, context)
+        return
+    if not new_lecture:
+        await update.message.reply_text("❌ أدخل اسم محاضرة صالح.")
+        return
+    if new_lecture in bot_files[selected_subject]:
+        await update.message.reply_text("❌ المحاضرة موجودة بالفعل!")
+    else:
+        bot_files[selected_subject][new_lecture] = {}
+        save_bot_files(bot_files)
+        await update.message.reply_text(f"✅ تم إضافة المحاضرة: {new_lecture} في المادة: {selected_subject}")
+    await show_admin_panel(update, context)
 
-        if user_data.get("current_menu") == "rename_subject_newname" and text not in {BACK_BTN, MAIN_BTN}:
-            if not can_admin(user_id, "content"):
-                await update.message.reply_text("❌ ليس لديك صلاحية إدارة المحتوى.")
-                return
-            await rename_subject_newname(update, context, context.user_data.get("selected_subject"), text)
-            return
+@route(text="➕ إضافة عنصر جديد", perm="content")
+async def on_add_item(update, context, text):
+    await show_add_item_select_subject(update, context)
 
-        if text == RENAME_LECTURE_BTN:
-            if not can_admin(user_id, "content"):
-                await update.message.reply_text("❌ ليس لديك صلاحية إدارة المحتوى.")
-                return
-            await rename_lecture_start(update, context)
-            return
+@route(menu="add_item_subject", perm="content")
+async def on_add_item_subject(update, context, text):
+    selected_subject = text.strip()
+    bot_files = load_bot_files()
+    if selected_subject not in bot_files:
+        await update.message.reply_text("❌ هذه المادة غير موجودة!")
+        return
+    await show_add_item_select_lecture(update, context, selected_subject)
 
-        if user_data.get("current_menu") == "rename_lecture_select_subject" and text not in {BACK_BTN, MAIN_BTN}:
-            if not can_admin(user_id, "content"):
-                await update.message.reply_text("❌ ليس لديك صلاحية إدارة المحتوى.")
-                return
-            await rename_lecture_select_lecture(update, context, text.strip())
-            return
+@route(menu="add_item_lecture", perm="content")
+async def on_add_item_lecture(update, context, text):
+    selected_lecture = text.strip()
+    selected_subject = context.user_data.get("selected_subject")
+    bot_files = load_bot_files()
+    if (not selected_subject) or (selected_subject not in bot_files) or (selected_lecture not in bot_files[selected_subject]):
+        await update.message.reply_text("❌ المحاضرة غير موجودة!")
+        return
+    await show_add_item_prompt_file(update, context, selected_subject, selected_lecture)
 
-        if user_data.get("current_menu") == "rename_lecture_select_lecture" and text not in {BACK_BTN, MAIN_BTN}:
-            if not can_admin(user_id, "content"):
-                await update.message.reply_text("❌ ليس لديك صلاحية إدارة المحتوى.")
-                return
-            context.user_data["selected_lecture"] = text.strip()
-            enter_menu(context, "rename_lecture_newname")
-            await update.message.reply_text(f"✏️ أدخل الاسم الجديد للمحاضرة '{text.strip()}':", reply_markup=ReplyKeyboardMarkup([[KeyboardButton(BACK_BTN)], [KeyboardButton(MAIN_BTN)]], resize_keyboard=True))
-            return
+@route(menu="add_item_file", text=LARGE_UPLOAD_BTN, perm="content")
+async def on_large_upload_menu(update, context, text):
+    await show_large_upload_menu(update, context)
 
-        if user_data.get("current_menu") == "rename_lecture_newname" and text not in {BACK_BTN, MAIN_BTN}:
-            if not can_admin(user_id, "content"):
-                await update.message.reply_text("❌ ليس لديك صلاحية إدارة المحتوى.")
-                return
-            await rename_lecture_newname(update, context, user_data.get("selected_subject"), user_data.get("selected_lecture"), text)
-            return
+@route(menu="add_item_large", perm="content")
+async def on_add_item_large(update, context, text):
+    name = text.strip()
+    if name not in list_large_uploads():
+        await update.message.reply_text("❌ اختر تسجيلاً من القائمة.")
+        return
+    selected_subject = context.user_data.get("selected_subject")
+    selected_lecture = context.user_data.get("selected_lecture")
+    if name in load_bot_files().get(selected_subject, {}).get(selected_lecture, {}):
+        await update.message.reply_text("❌ يوجد ملف بنفس الاسم بالفعل.")
+        return
+    task = _large_upload_tasks.get(name)
+    if task and not task.done():
+        await update.message.reply_text("⏳ هذا التسجيل قيد الرفع بالفعل.")
+        return
+    file_id = find_source_upload(large_upload_source(os.path.join(LARGE_UPLOAD_DIR, name)))
+    if file_id:
+        bot_files = load_bot_files()
+        bot_files.setdefault(selected_subject, {}).setdefault(selected_lecture, {})[name] = file_id
+        save_bot_files(bot_files)
+        await update.message.reply_text(f"🔗 هذا التسجيل مرفوع من قبل، تمت إضافته بدون إعادة رفع: {name}")
+        await show_admin_panel(update, context)
+        return
+    uploader = await get_mtproto_uploader()
+    if uploader is None:
+        await update.message.reply_text("❌ رفع التسجيلات الكبيرة غير مفعّل (يتطلب Telethon و TELEGRAM_API_ID و TELEGRAM_API_HASH).")
+        return
+    _large_upload_tasks[name] = asyncio.create_task(run_large_upload(
+        context.bot, uploader, update.effective_chat.id, selected_subject, selected_lecture, name))
+    await update.message.reply_text(f"⏳ بدأ رفع {name}، سيصلك إشعار عند الانتهاء.")
+    await show_admin_panel(update, context)
 
-        if text == RENAME_FILE_BTN:
-            if not can_admin(user_id, "content"):
-                await update.message.reply_text("❌ ليس لديك صلاحية إدارة المحتوى.")
-                return
-            await rename_file_start(update, context)
-            return
+@route(text=DUPLICATES_REPORT_BTN, perm="content")
+async def on_duplicates_report(update, context, text):
+    await update.message.reply_text(format_duplicates_report())
 
-        if user_data.get("current_menu") == "rename_file_select_subject" and text not in {BACK_BTN, MAIN_BTN}:
-            if not can_admin(user_id, "content"):
-                await update.message.reply_text("❌ ليس لديك صلاحية إدارة المحتوى.")
-                return
-            await rename_file_select_lecture(update, context, text.strip())
-            return
+@route(menu="add_item_file", text=TTS_SUMMARY_BTN, perm="content")
+async def on_tts_summary(update, context, text):
+    await show_tts_summary_prompt(update, context)
 
-        if user_data.get("current_menu") == "rename_file_select_lecture" and text not in {BACK_BTN, MAIN_BTN}:
-            if not can_admin(user_id, "content"):
-                await update.message.reply_text("❌ ليس لديك صلاحية إدارة المحتوى.")
-                return
-            await rename_file_select_file(update, context, user_data.get("selected_subject"), text.strip())
+@route(menu="add_item_tts", perm="content")
+async def on_add_item_tts(update, context, text):
+    document = update.message.document if update.message else None
+    if document:
+        if not (document.file_name or "").lower().endswith(".txt"):
+            await update.message.reply_text("❌ يرجى إرسال نص أو ملف .txt.")
             return
+        file = await document.get_file()
+        text = (await file.download_as_bytearray()).decode("utf-8-sig", errors="replace")
+    text = (text or "").strip()
+    if not text or len(text) > TTS_MAX_CHARS:
+        await update.message.reply_text(f"❌ النص فارغ أو أطول من {TTS_MAX_CHARS} حرف.")
+        return
+    selected_subject = context.user_data.get("selected_subject")
+    selected_lecture = context.user_data.get("selected_lecture")
+    name = tts_summary_name(selected_lecture)
+    await update.message.reply_text("⏳ جارٍ تحويل الملخص إلى صوت…")
+    try:
+        file_id, cached = await tts_summary_file_id(context.bot, update.effective_chat.id, text, name)
+    except Exception:
+        logger.exception("TTS summary for %s/%s failed", selected_subject, selected_lecture)
+        await update.message.reply_text("❌ تعذر إنشاء الملخص الصوتي، حاول لاحقاً.")
+        return
+    bot_files = load_bot_files()
+    bot_files.setdefault(selected_subject, {}).setdefault(selected_lecture, {})[name] = file_id
+    save_bot_files(bot_files)
+    note = " (نفس النص سبق تحويله، تم استخدام الملف المحفوظ)" if cached else ""
+    await update.message.reply_text(f"✅ تم نشر {name} في المحاضرة{note}")
+    await show_admin_panel(update, context)
 
-        if user_data.get("current_menu") == "rename_file_select_file" and text not in {BACK_BTN, MAIN_BTN}:
-            if not can_admin(user_id, "content"):
-                await update.message.reply_text("❌ ليس لديك صلاحية إدارة المحتوى.")
-                return
-            context.user_data["selected_file"] = text.strip()
-            enter_menu(context, "rename_file_newname")
-            await update.message.reply_text(f"✏️ أدخل الاسم الجديد للملف '{text.strip()}':", reply_markup=ReplyKeyboardMarkup([[KeyboardButton(BACK_BTN)], [KeyboardButton(MAIN_BTN)]], resize_keyboard=True))
-            return
+@route(menu="add_item_file", perm="content")
+async def on_add_item_file(update, context, text):
+    user_data = context.user_data
+    msg = update.message
+    file_obj = None
+    if msg:
+        file_obj = msg.document or msg.audio or msg.video
+    if file_obj:
+        # الملف يدخل دفعة الأدمن ويبقى في وضع الرفع لاستقبال باقي الملفات؛ الرد يصل مجمعاً
+        queue_ingest(context.bot, update.effective_chat.id, user_data.get("selected_subject"), user_data.get("selected_lecture"), file_obj)
+    else:
+        await update.message.reply_text("❌ لم يتم التعرف على أي ملف. أعد المحاولة أو استخدم زر إلغاء الرفع.")
+
+# إعادة التسمية
+@route(text=RENAME_MENU_BTN, perm="content")
+async def on_rename_menu(update, context, text):
+    enter_menu(context, "admin_rename_menu")
+    keyboard = [[KeyboardButton(RENAME_SUBJECT_BTN)], [KeyboardButton(RENAME_LECTURE_BTN)], [KeyboardButton(RENAME_FILE_BTN)], [KeyboardButton(BACK_BTN)], [KeyboardButton(MAIN_BTN)]]
+    await update.message.reply_text("اختر ما تريد إعادة تسميته:", reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True))
+
+@route(text=RENAME_SUBJECT_BTN, perm="content")
+async def on_rename_subject(update, context, text):
+    await rename_subject_start(update, context)
+
+@route(menu="rename_subject_select", perm="content")
+async def on_rename_subject_select(update, context, text):
+    context.user_data["selected_subject"] = text.strip()
+    enter_menu(context, "rename_subject_newname")
+    await update.message.reply_text(f"✏️ أدخل الاسم الجديد للمادة '{text.strip()}':", reply_markup=nav_keyboard())
+
+@route(menu="rename_subject_newname", perm="content")
+async def on_rename_subject_newname(update, context, text):
+    await rename_subject_newname(update, context, context.user_data.get("selected_subject"), text)
+
+@route(text=RENAME_LECTURE_BTN, perm="content")
+async def on_rename_lecture(update, context, text):
+    await rename_lecture_start(update, context)
+
+@route(menu="rename_lecture_select_subject", perm="content")
+async def on_rename_lecture_subject(update, context, text):
+    await rename_lecture_select_lecture(update, context, text.strip())
+
+@route(menu="rename_lecture_select_lecture", perm="content")
+async def on_rename_lecture_select(update, context, text):
+    context.user_data["selected_lecture"] = text.strip()
+    enter_menu(context, "rename_lecture_newname")
+    await update.message.reply_text(f"✏️ أدخل الاسم الجديد للمحاضرة '{text.strip()}':", reply_markup=nav_keyboard())
+
+@route(menu="rename_lecture_newname", perm="content")
+async def on_rename_lecture_newname(update, context, text):
+    await rename_lecture_newname(update, context, context.user_data.get("selected_subject"), context.user_data.get("selected_lecture"), text)
+
+@route(text=RENAME_FILE_BTN, perm="content")
+async def on_rename_file(update, context, text):
+    await rename_file_start(update, context)
+
+@route(menu="rename_file_select_subject", perm="content")
+async def on_rename_file_subject(update, context, text):
+    await rename_file_select_lecture(update, context, text.strip())
+
+@route(menu="rename_file_select_lecture", perm="content")
+async def on_rename_file_lecture(update, context, text):
+    await rename_file_select_file(update, context, context.user_data.get("selected_subject"), text.strip())
+
+@route(menu="rename_file_select_file", perm="content")
+async def on_rename_file_select(update, context, text):
+    context.user_data["selected_file"] = text.strip()
+    enter_menu(context, "rename_file_newname")
+    await update.message.reply_text(f"✏️ أدخل الاسم الجديد للملف '{text.strip()}':", reply_markup=nav_keyboard())
+
+@route(menu="rename_file_newname", perm="content")
+async def on_rename_file_newname(update, context, text):
+    user_data = context.user_data
+    await rename_file_newname(update, context, user_data.get("selected_subject"), user_data.get("selected_lecture"), user_data.get("selected_file"), text)
+
+# الحذف
+@route(text=DELETE_MENU_BTN, perm="content")
+async def on_delete_menu(update, context, text):
+    enter_menu(context, "admin_delete_menu")
+    keyboard = [[KeyboardButton(DELETE_SUBJECT_BTN)], [KeyboardButton(DELETE_LECTURE_BTN)], [KeyboardButton(DELETE_FILE_BTN)], [KeyboardButton(BACK_BTN)], [KeyboardButton(MAIN_BTN)]]
+    await update.message.reply_text("اختر ما تريد حذفه:", reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True))
+
+@route(text=DELETE_SUBJECT_BTN, perm="content")
+async def on_delete_subject(update, context, text):
+    await delete_subject_start(update, context)
+
+@route(menu="delete_subject_select", perm="content")
+async def on_delete_subject_select(update, context, text):
+    await delete_subject_confirm(update, context, text.strip())
+
+@route(menu="delete_subject_confirm", text=CONFIRM_DELETE_BTN, perm="content")
+async def on_delete_subject_confirm(update, context, text):
+    selected_subject = context.user_data.get("selected_subject")
+    bot_files = load_bot_files()
+    if selected_subject in bot_files:
+        lectures = bot_files.pop(selected_subject, None)
+        save_bot_files(bot_files)
+        prune_file_meta(fid for files in lectures.values() for fid in files.values())
+    await update.message.reply_text("✅ تم الحذف.")
+    await show_admin_panel(update, context)
 
-        if user_data.get("current_menu") == "rename_file_newname" and text not in {BACK_BTN, MAIN_BTN}:
-            if not can_admin(user_id, "content"):
-                await update.message.reply_text("❌ ليس لديك صلاحية إدارة المحتوى.")
-                return
-            await rename_file_newname(update, context, user_data.get("selected_subject"), user_data.get("selected_lecture"), user_data.get("selected_file"), text)
-            return
+@route(text=DELETE_LECTURE_BTN, perm="content")
+async def on_delete_lecture(update, context, text):
+    await delete_lecture_start(update, context)
 
-        # الحذف
-        if text == DELETE_MENU_BTN:
-            if not can_admin(user_id, "content"):
-                await update.message.reply_text("❌ ليس لديك صلاحية إدارة المحتوى.")
-                return
-            enter_menu(context, "admin_delete_menu")
-            keyboard = [[KeyboardButton(DELETE_SUBJECT_BTN)], [KeyboardButton(DELETE_LECTURE_BTN)], [KeyboardButton(DELETE_FILE_BTN)], [KeyboardButton(BACK_BTN)], [KeyboardButton(MAIN_BTN)]]
-            await update.message.reply_text("اختر ما تريد حذفه:", reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True))
-            return
+@route(menu="delete_lecture_select_subject", perm="content")
+async def on_delete_lecture_subject(update, context, text):
+    await delete_lecture_select_lecture(update, context, text.strip())
 
-        if text == DELETE_SUBJECT_BTN:
-            if not can_admin(user_id, "content"):
-                await update.message.reply_text("❌ ليس لديك صلاحية إدارة المحتوى.")
-                return
-            await delete_subject_start(update, context)
-            return
+@route(menu="delete_lecture_select_lecture", perm="content")
+async def on_delete_lecture_select(update, context, text):
+    await delete_lecture_confirm(update, context, context.user_data.get("selected_subject"), text.strip())
 
-        if user_data.get("current_menu") == "delete_subject_select" and text not in {BACK_BTN, MAIN_BTN}:
-            if not can_admin(user_id, "content"):
-                await update.message.reply_text("❌ ليس لديك صلاحية إدارة المحتوى.")
-                return
-            await delete_subject_confirm(update, context, text.strip())
-            return
+@route(menu="delete_lecture_confirm", text=CONFIRM_DELETE_BTN, perm="content")
+async def on_delete_lecture_confirm(update, context, text):
+    ss = context.user_data.get("selected_subject")
+    sl = context.user_data.get("selected_lecture")
+    bot_files = load_bot_files()
+    if ss in bot_files and sl in bot_files[ss]:
+        files = bot_files[ss].pop(sl, None)
+        save_bot_files(bot_files)
+        prune_file_meta(files.values())
+    await update.message.reply_text("✅ تم الحذف.")
+    await show_admin_panel(update, context)
 
-        if user_data.get("current_menu") == "delete_subject_confirm":
-            if not can_admin(user_id, "content"):
-                await update.message.reply_text("❌ ليس لديك صلاحية إدارة المحتوى.")
-                return
-            if text == CONFIRM_DELETE_BTN:
-                selected_subject = user_data.get("selected_subject")
-                bot_files = load_bot_files()
-                if selected_subject in bot_files:
-                    bot_files.pop(selected_subject, None)
-                    save_bot_files(bot_files)
-                await update.message.reply_text("✅ تم الحذف.")
-                await show_admin_panel(update, context)
-            elif text == CANCEL_ACTION_BTN:
-                await show_admin_panel(update, context)
-            return
+@route(text=DELETE_FILE_BTN, perm="content")
+async def on_delete_file(update, context, text):
+    await delete_file_start(update, context)
 
-        if text == DELETE_LECTURE_BTN:
-            if not can_admin(user_id, "content"):
-                await update.message.reply_text("❌ ليس لديك صلاحية إدارة المحتوى.")
-                return
-            await delete_lecture_start(update, context)
-            return
+@route(menu="delete_file_select_subject", perm="content")
+async def on_delete_file_subject(update, context, text):
+    await delete_file_select_lecture(update, context, text.strip())
 
-        if user_data.get("current_menu") == "delete_lecture_select_subject" and text not in {BACK_BTN, MAIN_BTN}:
-            if not can_admin(user_id, "content"):
-                await update.message.reply_text("❌ ليس لديك صلاحية إدارة المحتوى.")
-                return
-            await delete_lecture_select_lecture(update, context, text.strip())
-            return
+@route(menu="delete_file_select_lecture", perm="content")
+async def on_delete_file_lecture(update, context, text):
+    await delete_file_select_file(update, context, context.user_data.get("selected_subject"), text.strip())
 
-        if user_data.get("current_menu") == "delete_lecture_select_lecture" and text not in {BACK_BTN, MAIN_BTN}:
-            if not can_admin(user_id, "content"):
-                await update.message.reply_text("❌ ليس لديك صلاحية إدارة المحتوى.")
-                return
-            await delete_lecture_confirm(update, context, user_data.get("selected_subject"), text.strip())
-            return
+@route(menu="delete_file_select_file", perm="content")
+async def on_delete_file_select(update, context, text):
+    await delete_file_confirm(update, context, context.user_data.get("selected_subject"), context.user_data.get("selected_lecture"), text.strip())
 
-        if user_data.get("current_menu") == "delete_lecture_confirm":
-            if not can_admin(user_id, "content"):
-                await update.message.reply_text("❌ ليس لديك صلاحية إدارة المحتوى.")
-                return
-            if text == CONFIRM_DELETE_BTN:
-                ss = user_data.get("selected_subject")
-                sl = user_data.get("selected_lecture")
-                bot_files = load_bot_files()
-                if ss in bot_files and sl in bot_files[ss]:
-                    bot_files[ss].pop(sl, None)
-                    save_bot_files(bot_files)
-                await update.message.reply_text("✅ تم الحذف.")
-                await show_admin_panel(update, context)
-            elif text == CANCEL_ACTION_BTN:
-                await show_admin_panel(update, context)
-            return
+@route(menu="delete_file_confirm", text=CONFIRM_DELETE_BTN, perm="content")
+async def on_delete_file_confirm(update, context, text):
+    ss = context.user_data.get("selected_subject")
+    sl = context.user_data.get("selected_lecture")
+    sf = context.user_data.get("selected_file")
+    bot_files = load_bot_files()
+    if ss in bot_files and sl in bot_files[ss] and sf in bot_files[ss][sl]:
+        file_id = bot_files[ss][sl].pop(sf, None)
+        save_bot_files(bot_files)
+        prune_file_meta([file_id])
+    await update.message.reply_text("✅ تم الحذف.")
+    await show_admin_panel(update, context)
 
-        if text == DELETE_FILE_BTN:
-            if not can_admin(user_id, "content"):
-                await update.message.reply_text("❌ ليس لديك صلاحية إدارة المحتوى.")
-                return
-            await delete_file_start(update, context)
-            return
+@route(menu="delete_subject_confirm", text=CANCEL_ACTION_BTN, perm="content")
+@route(menu="delete_lecture_confirm", text=CANCEL_ACTION_BTN, perm="content")
+@route(menu="delete_file_confirm", text=CANCEL_ACTION_BTN, perm="content")
+async def on_delete_content_cancel(update, context, text):
+    await show_admin_panel(update, context)
 
-        if user_data.get("current_menu") == "delete_file_select_subject" and text not in {BACK_BTN, MAIN_BTN}:
-            if not can_admin(user_id, "content"):
-                await update.message.reply_text("❌ ليس لديك صلاحية إدارة المحتوى.")
-                return
-            await delete_file_select_lecture(update, context, text.strip())
-            return
+# --------- إدارة الطلاب: إضافة ---------
+@route(text=ADMIN_ADD_STUDENT_BTN, perm="student_add_delete")
+async def on_add_student(update, context, text):
+    enter_menu(context, "admin_add_student_code")
+    await update.message.reply_text("🔢 أدخل كود الطالب:", reply_markup=nav_keyboard())
+
+@route(menu="admin_add_student_code", perm="student_add_delete")
+async def on_add_student_code(update, context, text):
+    code = normalize_code(text)
+    if not code:
+        await update.message.reply_text("❌ أدخل كود رقمي صالح.")
+        return
+    code_map = get_code_map()
+    if code in code_map:
+        await update.message.reply_text("❌ هذا الكود موجود بالفعل.")
+        return
+    context.user_data["new_student_code"] = code
+    enter_menu(context, "admin_add_student_name")
+    await update.message.reply_text("📝 أدخل اسم الطالب:", reply_markup=nav_keyboard())
+
+@route(menu="admin_add_student_name", perm="student_add_delete")
+async def on_add_student_name(update, context, text):
+    name = text.strip()
+    if not name:
+        await update.message.reply_text("❌ أدخل اسم صالح.")
+        return
+    code = context.user_data.get("new_student_code")
+    codes = load_codes()
+    codes.append({"code": code, "name": name})
+    save_codes(codes)
+    context.user_data.pop("new_student_code", None)
+    await update.message.reply_text(f"✅ تم إضافة الطالب: {name} (كود: {code})")
+    await show_admin_panel(update, context)
 
-        if user_data.get("current_menu") == "delete_file_select_lecture" and text not in {BACK_BTN, MAIN_BTN}:
-            if not can_admin(user_id, "content"):
-                await update.message.reply_text("❌ ليس لديك صلاحية إدارة المحتوى.")
-                return
-            await delete_file_select_file(update, context, user_data.get("selected_subject"), text.strip())
-            return
+# --------- حذف طالب ---------
+async def select_student_for_delete(update, context, code):
+    code_map = get_code_map()
+    if code not in code_map:
+        await update.message.reply_text("❌ لم يتم العثور على الطالب.")
+        return
+    context.user_data["selected_student_code"] = code
+    enter_menu(context, "admin_delete_student_confirm")
+    await update.message.reply_text(f"⚠️ حذف الطالب '{code_map[code]}' (كود: {code}). تأكيد؟", reply_markup=confirm_keyboard(CONFIRM_DELETE_BTN))
+
+@route(text=ADMIN_DELETE_STUDENT_BTN, perm="student_add_delete")
+async def on_delete_student(update, context, text):
+    enter_menu(context, "admin_delete_student_method")
+    await update.message.reply_text("اختر طريقة حذف الطالب:", reply_markup=student_method_keyboard())
+
+@route(menu="admin_delete_student_method", text=SELECT_BY_CODE_BTN, perm="student_add_delete")
+async def on_delete_student_by_code(update, context, text):
+    enter_menu(context, "admin_delete_student_enter_code")
+    await update.message.reply_text("🔢 أدخل كود الطالب المراد حذفه:", reply_markup=nav_keyboard())
+
+@route(menu="admin_delete_student_method", text=SELECT_FROM_LIST_BTN, perm="student_add_delete")
+async def on_delete_student_from_list(update, context, text):
+    await show_students_list_for_delete(update, context, 0)
+
+@route(menu="admin_delete_student_enter_code", perm="student_add_delete")
+async def on_delete_student_code(update, context, text):
+    code = normalize_code(text)
+    if code not in get_code_map():
+        await update.message.reply_text("❌ الكود غير موجود.")
+        return
+    await select_student_for_delete(update, context, code)
 
-        if user_data.get("current_menu") == "delete_file_select_file" and text not in {BACK_BTN, MAIN_BTN}:
-            if not can_admin(user_id, "content"):
-                await update.message.reply_text("❌ ليس لديك صلاحية إدارة المحتوى.")
-                return
-            await delete_file_confirm(update, context, user_data.get("selected_subject"), user_data.get("selected_lecture"), text.strip())
-            return
+@route(menu="delete_student_list", text=NEXT_BTN, perm="student_add_delete")
+async def on_delete_student_next(update, context, text):
+    await show_students_list_for_delete(update, context, context.user_data.get("students_page", 0) + 1)
 
-        if user_data.get("current_menu") == "delete_file_confirm":
-            if not can_admin(user_id, "content"):
-                await update.message.reply_text("❌ ليس لديك صلاحية إدارة المحتوى.")
-                return
-            if text == CONFIRM_DELETE_BTN:
-                ss = user_data.get("selected_subject")
-                sl = user_data.get("selected_lecture")
-                sf = user_data.get("selected_file")
-                bot_files = load_bot_files()
-                if ss in bot_files and sl in bot_files[ss] and sf in bot_files[ss][sl]:
-                    bot_files[ss][sl].pop(sf, None)
-                    save_bot_files(bot_files)
-                await update.message.reply_text("✅ تم الحذف.")
-                await show_admin_panel(update, context)
-            elif text == CANCEL_ACTION_BTN:
-                await show_admin_panel(update, context)
-            return
+@route(menu="delete_student_list", text=PREV_BTN, perm="student_add_delete")
+async def on_delete_student_prev(update, context, text):
+    page = context.user_data.get("students_page", 0)
+    if page > 0:
+        await show_students_list_for_delete(update, context, page - 1)
 
-        # إدارة الطلاب: إضافة
-        if text == ADMIN_ADD_STUDENT_BTN:
-            if not can_admin(user_id, "student_add_delete"):
-                await update.message.reply_text("❌ ليس لديك صلاحية إضافة/حذف الطلاب.")
-                return
-            enter_menu(context, "admin_add_student_code")
-            await update.message.reply_text("🔢 أدخل كود الطالب:", reply_markup=ReplyKeyboardMarkup([[KeyboardButton(BACK_BTN)], [KeyboardButton(MAIN_BTN)]], resize_keyboard=True))
-            return
+@route(menu="delete_student_list", perm="student_add_delete")
+async def on_delete_student_pick(update, context, text):
+    code = parse_code_from_label(text)
+    if code:
+        await select_student_for_delete(update, context, code)
 
-        if user_data.get("current_menu") == "admin_add_student_code" and text not in {BACK_BTN, MAIN_BTN}:
-            if not can_admin(user_id, "student_add_delete"):
-                await update.message.reply_text("❌ ليس لديك صلاحية إضافة/حذف الطلاب.")
-                return
-            code = normalize_code(text)
-            if not code:
-                await update.message.reply_text("❌ أدخل كود رقمي صالح.")
-                return
-            code_map = get_code_map()
-            if code in code_map:
-                await update.message.reply_text("❌ هذا الكود موجود بالفعل.")
-                return
-            context.user_data["new_student_code"] = code
-            enter_menu(context, "admin_add_student_name")
-            await update.message.reply_text("📝 أدخل اسم الطالب:", reply_markup=ReplyKeyboardMarkup([[KeyboardButton(BACK_BTN)], [KeyboardButton(MAIN_BTN)]], resize_keyboard=True))
-            return
+@route(menu="admin_delete_student_confirm", text=CONFIRM_DELETE_BTN, perm="student_add_delete")
+async def on_delete_student_confirm(update, context, text):
+    code = context.user_data.get("selected_student_code")
+    codes = load_codes()
+    codes = [c for c in codes if normalize_code(str(c.get("code", ""))) != code]
+    save_codes(codes)
+    await update.message.reply_text("✅ تم حذف الطالب.")
+    await show_admin_panel(update, context)
 
-        if user_data.get("current_menu") == "admin_add_student_name" and text not in {BACK_BTN, MAIN_BTN}:
-            if not can_admin(user_id, "student_add_delete"):
-                await update.message.reply_text("❌ ليس لديك صلاحية إضافة/حذف الطلاب.")
-                return
-            name = text.strip()
-            if not name:
-                await update.message.reply_text("❌ أدخل اسم صالح.")
-                return
-            code = context.user_data.get("new_student_code")
-            codes = load_codes()
-            codes.append({"code": code, "name": name})
-            save_codes(codes)
-            context.user_data.pop("new_student_code", None)
-            await update.message.reply_text(f"✅ تم إضافة الطالب: {name} (كود: {code})")
-            await show_admin_panel(update, context)
-            return
+@route(menu="admin_delete_student_confirm", text=CANCEL_ACTION_BTN, perm="student_add_delete")
+async def on_delete_student_cancel(update, context, text):
+    await show_admin_panel(update, context)
 
-        # حذف طالب
-        if text == ADMIN_DELETE_STUDENT_BTN:
-            if not can_admin(user_id, "student_add_delete"):
-                await update.message.reply_text("❌ ليس لديك صلاحية إضافة/حذف الطلاب.")
-                return
-            enter_menu(context, "admin_delete_student_method")
-            keyboard = [[KeyboardButton(SELECT_BY_CODE_BTN)], [KeyboardButton(SELECT_FROM_LIST_BTN)], [KeyboardButton(BACK_BTN)], [KeyboardButton(MAIN_BTN)]]
-            await update.message.reply_text("اختر طريقة حذف الطالب:", reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True))
-            return
+# --------- تعديل طالب ---------
+async def select_student_for_edit(update, context, code):
+    if code not in get_code_map():
+        await update.message.reply_text("❌ لم يتم العثور على الطالب.")
+        return
+    context.user_data["selected_student_code"] = code
+    enter_menu(context, "admin_edit_student_choose_field")
+    keyboard = [[KeyboardButton(EDIT_NAME_BTN)], [KeyboardButton(EDIT_CODE_BTN)], [KeyboardButton(BACK_BTN)], [KeyboardButton(MAIN_BTN)]]
+    await update.message.reply_text("اختر ما تريد تعديله:", reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True))
+
+@route(text=ADMIN_EDIT_STUDENT_BTN, perm="student_edit")
+async def on_edit_student(update, context, text):
+    enter_menu(context, "admin_edit_student_method")
+    await update.message.reply_text("اختر طريقة تعديل الطالب:", reply_markup=student_method_keyboard())
+
+@route(menu="admin_edit_student_method", text=SELECT_BY_CODE_BTN, perm="student_edit")
+async def on_edit_student_by_code(update, context, text):
+    enter_menu(context, "admin_edit_student_enter_code")
+    await update.message.reply_text("🔢 أدخل كود الطالب:", reply_markup=nav_keyboard())
+
+@route(menu="admin_edit_student_method", text=SELECT_FROM_LIST_BTN, perm="student_edit")
+async def on_edit_student_from_list(update, context, text):
+    await show_students_list_for_edit(update, context, 0)
+
+@route(menu="admin_edit_student_enter_code", perm="student_edit")
+async def on_edit_student_code(update, context, text):
+    code = normalize_code(text)
+    if code not in get_code_map():
+        await update.message.reply_text("❌ الكود غير موجود.")
+        return
+    await select_student_for_edit(update, context, code)
 
-        if user_data.get("current_menu") == "admin_delete_student_method":
-            if not can_admin(user_id, "student_add_delete"):
-                await update.message.reply_text("❌ ليس لديك صلاحية إضافة/حذف الطلاب.")
-                return
-            if text == SELECT_BY_CODE_BTN:
-                enter_menu(context, "admin_delete_student_enter_code")
-                await update.message.reply_text("🔢 أدخل كود الطالب المراد حذفه:", reply_markup=ReplyKeyboardMarkup([[KeyboardButton(BACK_BTN)], [KeyboardButton(MAIN_BTN)]], resize_keyboard=True))
-            elif text == SELECT_FROM_LIST_BTN:
-                await show_students_list_for_delete(update, context, 0)
-            return
+@route(menu="edit_student_list", text=NEXT_BTN, perm="student_edit")
+async def on_edit_student_next(update, context, text):
+    await show_students_list_for_edit(update, context, context.user_data.get("students_page", 0) + 1)
 
-        if user_data.get("current_menu") == "admin_delete_student_enter_code" and text not in {BACK_BTN, MAIN_BTN}:
-            if not can_admin(user_id, "student_add_delete"):
-                await update.message.reply_text("❌ ليس لديك صلاحية إضافة/حذف الطلاب.")
-                return
-            code = normalize_code(text)
-            code_map = get_code_map()
-            if code not in code_map:
-                await update.message.reply_text("❌ الكود غير موجود.")
-                return
-            context.user_data["selected_student_code"] = code
-            enter_menu(context, "admin_delete_student_confirm")
-            keyboard = [[KeyboardButton(CONFIRM_DELETE_BTN)], [KeyboardButton(CANCEL_ACTION_BTN)], [KeyboardButton(BACK_BTN)], [KeyboardButton(MAIN_BTN)]]
-            await update.message.reply_text(f"⚠️ حذف الطالب '{code_map[code]}' (كود: {code}). تأكيد؟", reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True))
-            return
+@route(menu="edit_student_list", text=PREV_BTN, perm="student_edit")
+async def on_edit_student_prev(update, context, text):
+    page = context.user_data.get("students_page", 0)
+    if page > 0:
+        await show_students_list_for_edit(update, context, page - 1)
+
+@route(menu="edit_student_list", perm="student_edit")
+async def on_edit_student_pick(update, context, text):
+    code = parse_code_from_label(text)
+    if code:
+        await select_student_for_edit(update, context, code)
+
+@route(menu="admin_edit_student_choose_field", text=EDIT_NAME_BTN, perm="student_edit")
+async def on_edit_student_name_field(update, context, text):
+    enter_menu(context, "admin_edit_student_new_name")
+    await update.message.reply_text("📝 أدخل الاسم الجديد:", reply_markup=nav_keyboard())
+
+@route(menu="admin_edit_student_choose_field", text=EDIT_CODE_BTN, perm="student_edit")
+async def on_edit_student_code_field(update, context, text):
+    enter_menu(context, "admin_edit_student_new_code")
+    await update.message.reply_text("🔢 أدخل الكود الجديد:", reply_markup=nav_keyboard())
+
+@route(menu="admin_edit_student_new_name", perm="student_edit")
+async def on_edit_student_new_name(update, context, text):
+    new_name = text.strip()
+    if not new_name:
+        await update.message.reply_text("❌ اسم غير صالح.")
+        return
+    code = context.user_data.get("selected_student_code")
+    codes = load_codes()
+    updated = False
+    for it in codes:
+        if normalize_code(str(it.get("code", ""))) == code:
+            it["name"] = new_name
+            updated = True
+            break
+    if updated:
+        save_codes(codes)
+        await update.message.reply_text("✅ تم تحديث الاسم.")
+    else:
+        await update.message.reply_text("❌ لم يتم العثور على الطالب.")
+    await show_admin_panel(update, context)
 
-        if user_data.get("current_menu") == "delete_student_list":
-            if not can_admin(user_id, "student_add_delete"):
-                await update.message.reply_text("❌ ليس لديك صلاحية إضافة/حذف الطلاب.")
-                return
-            page = user_data.get("students_page", 0)
-            if text == NEXT_BTN:
-                await show_students_list_for_delete(update, context, page + 1)
-                return
-            if text == PREV_BTN and page > 0:
-                await show_students_list_for_delete(update, context, page - 1)
-                return
-            code = parse_code_from_label(text)
-            if code:
-                code_map = get_code_map()
-                if code in code_map:
-                    context.user_data["selected_student_code"] = code
-                    enter_menu(context, "admin_delete_student_confirm")
-                    keyboard = [[KeyboardButton(CONFIRM_DELETE_BTN)], [KeyboardButton(CANCEL_ACTION_BTN)], [KeyboardButton(BACK_BTN)], [KeyboardButton(MAIN_BTN)]]
-                    await update.message.reply_text(f"⚠️ حذف الطالب '{code_map[code]}' (كود: {code}). تأكيد؟", reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True))
-                else:
-                    await update.message.reply_text("❌ لم يتم العثور على الطالب.")
-            return
+@route(menu="admin_edit_student_new_code", perm="student_edit")
+async def on_edit_student_new_code(update, context, text):
+    new_code = normalize_code(text)
+    if not new_code:
+        await update.message.reply_text("❌ كود غير صالح.")
+        return
+    if new_code in get_code_map():
+        await update.message.reply_text("❌ الكود الجديد مستخدم بالفعل.")
+        return
+    old_code = context.user_data.get("selected_student_code")
+    codes = load_codes()
+    updated = False
+    for it in codes:
+        if normalize_code(str(it.get("code", ""))) == old_code:
+            it["code"] = new_code
+            updated = True
+            break
+    if updated:
+        save_codes(codes)
+        await update.message.reply_text(f"✅ تم تحديث الكود من {old_code} إلى {new_code}.")
+    else:
+        await update.message.reply_text("❌ لم يتم العثور على الطالب.")
+    await show_admin_panel(update, context)
 
-        if user_data.get("current_menu") == "admin_delete_student_confirm":
-            if not can_admin(user_id, "student_add_delete"):
-                await update.message.reply_text("❌ ليس لديك صلاحية إضافة/حذف الطلاب.")
-                return
-            if text == CONFIRM_DELETE_BTN:
-                code = user_data.get("selected_student_code")
-                codes = load_codes()
-                codes = [c for c in codes if normalize_code(str(c.get("code", ""))) != code]
-                save_codes(codes)
-                await update.message.reply_text("✅ تم حذف الطالب.")
-                await show_admin_panel(update, context)
-            elif text == CANCEL_ACTION_BTN:
-                await show_admin_panel(update, context)
-            return
+# --------- إيقاف/إلغاء إيقاف ---------
+async def select_student_for_suspend(update, context, code):
+    if code not in get_code_map():
+        await update.message.reply_text("❌ لم يتم العثور على الطالب.")
+        return
+    context.user_data["selected_student_code"] = code
+    susp = is_code_suspended(code)
+    if susp:
+        enter_menu(context, "admin_unsuspend_confirm")
+        keyboard = [[KeyboardButton(UNSUSPEND_BTN)], [KeyboardButton(BACK_BTN)], [KeyboardButton(MAIN_BTN)]]
+        await update.message.reply_text(f"الحساب موقوف حالياً.\nالسبب: {susp.get('reason','')}\nهل تريد إلغاء الإيقاف؟", reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True))
+    else:
+        enter_menu(context, "admin_suspend_reason")
+        await update.message.reply_text("✍️ أدخل سبب الإيقاف المؤقت:", reply_markup=nav_keyboard())
+
+@route(text=ADMIN_SUSPEND_STUDENT_BTN, perm="suspend")
+async def on_suspend_student(update, context, text):
+    enter_menu(context, "admin_suspend_method")
+    await update.message.reply_text("اختر طريقة اختيار الطالب:", reply_markup=student_method_keyboard())
+
+@route(menu="admin_suspend_method", text=SELECT_BY_CODE_BTN, perm="suspend")
+async def on_suspend_by_code(update, context, text):
+    enter_menu(context, "admin_suspend_enter_code")
+    await update.message.reply_text("🔢 أدخل كود الطالب:", reply_markup=nav_keyboard())
+
+@route(menu="admin_suspend_method", text=SELECT_FROM_LIST_BTN, perm="suspend")
+async def on_suspend_from_list(update, context, text):
+    await show_students_list_for_suspend(update, context, 0)
+
+@route(menu="admin_suspend_enter_code", perm="suspend")
+async def on_suspend_code(update, context, text):
+    code = normalize_code(text)
+    if code not in get_code_map():
+        await update.message.reply_text("❌ الكود غير موجود.")
+        return
+    await select_student_for_suspend(update, context, code)
 
-        # تعديل طالب
-        if text == ADMIN_EDIT_STUDENT_BTN:
-            if not can_admin(user_id, "student_edit"):
-                await update.message.reply_text("❌ ليس لديك صلاحية تعديل بيانات الطالب.")
-                return
-            enter_menu(context, "admin_edit_student_method")
-            keyboard = [[KeyboardButton(SELECT_BY_CODE_BTN)], [KeyboardButton(SELECT_FROM_LIST_BTN)], [KeyboardButton(BACK_BTN)], [KeyboardButton(MAIN_BTN)]]
-            await update.message.reply_text("اختر طريقة تعديل الطالب:", reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True))
-            return
+@route(menu="suspend_student_list", text=NEXT_BTN, perm="suspend")
+async def on_suspend_next(update, context, text):
+    await show_students_list_for_suspend(update, context, context.user_data.get("students_page", 0) + 1)
 
-        if user_data.get("current_menu") == "admin_edit_student_method":
-            if not can_admin(user_id, "student_edit"):
-                await update.message.reply_text("❌ ليس لديك صلاحية تعديل بيانات الطالب.")
-                return
-            if text == SELECT_BY_CODE_BTN:
-                enter_menu(context, "admin_edit_student_enter_code")
-                await update.message.reply_text("🔢 أدخل كود الطالب:", reply_markup=ReplyKeyboardMarkup([[KeyboardButton(BACK_BTN)], [KeyboardButton(MAIN_BTN)]], resize_keyboard=True))
-            elif text == SELECT_FROM_LIST_BTN:
-                await show_students_list_for_edit(update, context, 0)
-            return
+@route(menu="suspend_student_list", text=PREV_BTN, perm="suspend")
+async def on_suspend_prev(update, context, text):
+    page = context.user_data.get("students_page", 0)
+    if page > 0:
+        await show_students_list_for_suspend(update, context, page - 1)
+
+@route(menu="suspend_student_list", perm="suspend")
+async def on_suspend_pick(update, context, text):
+    code = parse_code_from_label(text)
+    if code:
+        await select_student_for_suspend(update, context, code)
+
+@route(menu="admin_suspend_reason", perm="suspend")
+async def on_suspend_reason(update, context, text):
+    reason = text.strip()
+    if not reason:
+        await update.message.reply_text("❌ يرجى كتابة سبب.")
+        return
+    code = context.user_data.get("selected_student_code")
+    suspend_code(code, reason, update.effective_user.id)
+    await update.message.reply_text("✅ تم إيقاف الحساب مؤقتًا.")
+    await show_admin_panel(update, context)
 
-        if user_data.get("current_menu") == "admin_edit_student_enter_code" and text not in {BACK_BTN, MAIN_BTN}:
-            if not can_admin(user_id, "student_edit"):
-                await update.message.reply_text("❌ ليس لديك صلاحية تعديل بيانات الطالب.")
-                return
-            code = normalize_code(text)
-            code_map = get_code_map()
-            if code not in code_map:
-                await update.message.reply_text("❌ الكود غير موجود.")
-                return
-            context.user_data["selected_student_code"] = code
-            enter_menu(context, "admin_edit_student_choose_field")
-            keyboard = [[KeyboardButton(EDIT_NAME_BTN)], [KeyboardButton(EDIT_CODE_BTN)], [KeyboardButton(BACK_BTN)], [KeyboardButton(MAIN_BTN)]]
-            await update.message.reply_text("اختر ما تريد تعديله:", reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True))
-            return
+@route(menu="admin_unsuspend_confirm", text=UNSUSPEND_BTN, perm="suspend")
+async def on_unsuspend(update, context, text):
+    code = context.user_data.get("selected_student_code")
+    unsuspend_code(code)
+    await update.message.reply_text("✅ تم إلغاء الإيقاف.")
+    await show_admin_panel(update, context)
 
-        if user_data.get("current_menu") == "edit_student_list":
-            if not can_admin(user_id, "student_edit"):
-                await update.message.reply_text("❌ ليس لديك صلاحية تعديل بيانات الطالب.")
-                return
-            page = user_data.get("students_page", 0)
-            if text == NEXT_BTN:
-                await show_students_list_for_edit(update, context, page + 1)
-                return
-            if text == PREV_BTN and page > 0:
-                await show_students_list_for_edit(update, context, page - 1)
-                return
-            code = parse_code_from_label(text)
-            if code:
-                code_map = get_code_map()
-                if code in code_map:
-                    context.user_data["selected_student_code"] = code
-                    enter_menu(context, "admin_edit_student_choose_field")
-                    keyboard = [[KeyboardButton(EDIT_NAME_BTN)], [KeyboardButton(EDIT_CODE_BTN)], [KeyboardButton(BACK_BTN)], [KeyboardButton(MAIN_BTN)]]
-                    await update.message.reply_text("اختر ما تريد تعديله:", reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True))
-                else:
-                    await update.message.reply_text("❌ لم يتم العثور على الطالب.")
-            return
+# --------- البحث عن طالب (لكل من الحذف/التعديل/الإيقاف) ---------
+async def show_student_search_prompt(update, context, menu):
+    enter_menu(context, menu)
+    await update.message.reply_text("🔍 اكتب جزءاً من الكود أو من اسم الطالب:", reply_markup=nav_keyboard())
 
-        if user_data.get("current_menu") == "admin_edit_student_choose_field":
-            if not can_admin(user_id, "student_edit"):
-                await update.message.reply_text("❌ ليس لديك صلاحية تعديل بيانات الطالب.")
-                return
-            if text == EDIT_NAME_BTN:
-                enter_menu(context, "admin_edit_student_new_name")
-                await update.message.reply_text("📝 أدخل الاسم الجديد:", reply_markup=ReplyKeyboardMarkup([[KeyboardButton(BACK_BTN)], [KeyboardButton(MAIN_BTN)]], resize_keyboard=True))
-            elif text == EDIT_CODE_BTN:
-                enter_menu(context, "admin_edit_student_new_code")
-                await update.message.reply_text("🔢 أدخل الكود الجديد:", reply_markup=ReplyKeyboardMarkup([[KeyboardButton(BACK_BTN)], [KeyboardButton(MAIN_BTN)]], resize_keyboard=True))
-            return
+async def handle_student_search(update, context, text, select):
+    # الضغط على نتيجة يختار الطالب، وأي نص آخر يُعتبر بحثاً جديداً
+    code = get_roster()["label_to_code"].get(text)
+    if code:
+        await select(update, context, code)
+        return
+    labels, total = search_students(text)
+    if not labels:
+        await update.message.reply_text("❌ لا توجد نتائج. جرّب كلمة أخرى.")
+        return
+    keyboard = [[KeyboardButton(x)] for x in labels]
+    keyboard.append([KeyboardButton(BACK_BTN)])
+    keyboard.append([KeyboardButton(MAIN_BTN)])
+    more = f" (أول {len(labels)} من {total})" if total > len(labels) else ""
+    await update.message.reply_text(f"🔍 نتائج البحث{more}: اختر الطالب أو اكتب بحثاً آخر.", reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True))
 
-        if user_data.get("current_menu") == "admin_edit_student_new_name" and text not in {BACK_BTN, MAIN_BTN}:
-            if not can_admin(user_id, "student_edit"):
-                await update.message.reply_text("❌ ليس لديك صلاحية تعديل بيانات الطالب.")
-                return
-            new_name = text.strip()
-            if not new_name:
-                await update.message.reply_text("❌ اسم غير صالح.")
-                return
-            code = user_data.get("selected_student_code")
-            codes = load_codes()
-            updated = False
-            for it in codes:
-                if normalize_code(str(it.get("code", ""))) == code:
-                    it["name"] = new_name
-                    updated = True
-                    break
-            if updated:
-                save_codes(codes)
-                await update.message.reply_text("✅ تم تحديث الاسم.")
-            else:
-                await update.message.reply_text("❌ لم يتم العثور على الطالب.")
-            await show_admin_panel(update, context)
-            return
+@route(menu="admin_delete_student_method", text=SEARCH_STUDENT_BTN, perm="student_add_delete")
+async def on_delete_student_search(update, context, text):
+    await show_student_search_prompt(update, context, "delete_student_search")
 
-        if user_data.get("current_menu") == "admin_edit_student_new_code" and text not in {BACK_BTN, MAIN_BTN}:
-            if not can_admin(user_id, "student_edit"):
-                await update.message.reply_text("❌ ليس لديك صلاحية تعديل بيانات الطالب.")
-                return
-            new_code = normalize_code(text)
-            if not new_code:
-                await update.message.reply_text("❌ كود غير صالح.")
-                return
-            codes_map = get_code_map()
-            if new_code in codes_map:
-                await update.message.reply_text("❌ الكود الجديد مستخدم بالفعل.")
-                return
-            old_code = user_data.get("selected_student_code")
-            codes = load_codes()
-            updated = False
-            for it in codes:
-                if normalize_code(str(it.get("code", ""))) == old_code:
-                    it["code"] = new_code
-                    updated = True
-                    break
-            if updated:
-                save_codes(codes)
-                await update.message.reply_text(f"✅ تم تحديث الكود من {old_code} إلى {new_code}.")
-            else:
-                await update.message.reply_text("❌ لم يتم العثور على الطالب.")
-            await show_admin_panel(update, context)
-            return
+@route(menu="delete_student_search", perm="student_add_delete")
+async def on_delete_student_search_text(update, context, text):
+    await handle_student_search(update, context, text, select_student_for_delete)
 
-        # إيقاف/إلغاء إيقاف
-        if text == ADMIN_SUSPEND_STUDENT_BTN:
-            if not can_admin(user_id, "suspend"):
-                await update.message.reply_text("❌ ليس لديك صلاحية الإيقاف/الإلغاء.")
-                return
-            enter_menu(context, "admin_suspend_method")
-            keyboard = [[KeyboardButton(SELECT_BY_CODE_BTN)], [KeyboardButton(SELECT_FROM_LIST_BTN)], [KeyboardButton(BACK_BTN)], [KeyboardButton(MAIN_BTN)]]
-            await update.message.reply_text("اختر طريقة اختيار الطالب:", reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True))
-            return
+@route(menu="admin_edit_student_method", text=SEARCH_STUDENT_BTN, perm="student_edit")
+async def on_edit_student_search(update, context, text):
+    await show_student_search_prompt(update, context, "edit_student_search")
 
-        if user_data.get("current_menu") == "admin_suspend_method":
-            if not can_admin(user_id, "suspend"):
-                await update.message.reply_text("❌ ليس لديك صلاحية الإيقاف/الإلغاء.")
-                return
-            if text == SELECT_BY_CODE_BTN:
-                enter_menu(context, "admin_suspend_enter_code")
-                await update.message.reply_text("🔢 أدخل كود الطالب:", reply_markup=ReplyKeyboardMarkup([[KeyboardButton(BACK_BTN)], [KeyboardButton(MAIN_BTN)]], resize_keyboard=True))
-            elif text == SELECT_FROM_LIST_BTN:
-                await show_students_list_for_suspend(update, context, 0)
-            return
+@route(menu="edit_student_search", perm="student_edit")
+async def on_edit_student_search_text(update, context, text):
+    await handle_student_search(update, context, text, select_student_for_edit)
 
-        if user_data.get("current_menu") == "admin_suspend_enter_code" and text not in {BACK_BTN, MAIN_BTN}:
-            if not can_admin(user_id, "suspend"):
-                await update.message.reply_text("❌ ليس لديك صلاحية الإيقاف/الإلغاء.")
-                return
-            code = normalize_code(text)
-            code_map = get_code_map()
-            if code not in code_map:
-                await update.message.reply_text("❌ الكود غير موجود.")
-                return
-            context.user_data["selected_student_code"] = code
-            susp = is_code_suspended(code)
-            if susp:
-                enter_menu(context, "admin_unsuspend_confirm")
-                keyboard = [[KeyboardButton(UNSUSPEND_BTN)], [KeyboardButton(BACK_BTN)], [KeyboardButton(MAIN_BTN)]]
-                await update.message.reply_text(f"الحساب موقوف حالياً.\nالسبب: {susp.get('reason','')}\nهل تريد إلغاء الإيقاف؟", reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True))
-            else:
-                enter_menu(context, "admin_suspend_reason")
-                await update.message.reply_text("✍️ أدخل سبب الإيقاف المؤقت:", reply_markup=ReplyKeyboardMarkup([[KeyboardButton(BACK_BTN)], [KeyboardButton(MAIN_BTN)]], resize_keyboard=True))
-            return
+@route(menu="admin_suspend_method", text=SEARCH_STUDENT_BTN, perm="suspend")
+async def on_suspend_search(update, context, text):
+    await show_student_search_prompt(update, context, "suspend_student_search")
 
-        if user_data.get("current_menu") == "suspend_student_list":
-            if not can_admin(user_id, "suspend"):
-                await update.message.reply_text("❌ ليس لديك صلاحية الإيقاف/الإلغاء.")
-                return
-            page = user_data.get("students_page", 0)
-            if text == NEXT_BTN:
-                await show_students_list_for_suspend(update, context, page + 1)
-                return
-            if text == PREV_BTN and page > 0:
-                await show_students_list_for_suspend(update, context, page - 1)
-                return
-            code = parse_code_from_label(text)
-            if code:
-                code_map = get_code_map()
-                if code in code_map:
-                    context.user_data["selected_student_code"] = code
-                    susp = is_code_suspended(code)
-                    if susp:
-                        enter_menu(context, "admin_unsuspend_confirm")
-                        keyboard = [[KeyboardButton(UNSUSPEND_BTN)], [KeyboardButton(BACK_BTN)], [KeyboardButton(MAIN_BTN)]]
-                        await update.message.reply_text(f"الحساب موقوف حالياً.\nالسبب: {susp.get('reason','')}\nهل تريد إلغاء الإيقاف؟", reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True))
-                    else:
-                        enter_menu(context, "admin_suspend_reason")
-                        await update.message.reply_text("✍️ أدخل سبب الإيقاف المؤقت:", reply_markup=ReplyKeyboardMarkup([[KeyboardButton(BACK_BTN)], [KeyboardButton(MAIN_BTN)]], resize_keyboard=True))
-                else:
-                    await update.message.reply_text("❌ لم يتم العثور على الطالب.")
-            return
+@route(menu="suspend_student_search", perm="suspend")
+async def on_suspend_search_text(update, context, text):
+    await handle_student_search(update, context, text, select_student_for_suspend)
 
-        if user_data.get("current_menu") == "admin_suspend_reason" and text not in {BACK_BTN, MAIN_BTN}:
-            if not can_admin(user_id, "suspend"):
-                await update.message.reply_text("❌ ليس لديك صلاحية الإيقاف/الإلغاء.")
-                return
-            reason = text.strip()
-            if not reason:
-                await update.message.reply_text("❌ يرجى كتابة سبب.")
-                return
-            code = user_data.get("selected_student_code")
-            suspend_code(code, reason, user_id)
-            await update.message.reply_text("✅ تم إيقاف الحساب مؤقتًا.")
-            await show_admin_panel(update, context)
-            return
+# --------- استيراد أكواد ---------
+@route(text=IMPORT_CODES_BTN, perm="student_add_delete")
+async def on_import_codes(update, context, text):
+    await import_codes_prompt(update, context)
 
-        if user_data.get("current_menu") == "admin_unsuspend_confirm" and text == UNSUSPEND_BTN:
-            if not can_admin(user_id, "suspend"):
-                await update.message.reply_text("❌ ليس لديك صلاحية الإيقاف/الإلغاء.")
-                return
-            code = user_data.get("selected_student_code")
-            unsuspend_code(code)
-            await update.message.reply_text("✅ تم إلغاء الإيقاف.")
-            await show_admin_panel(update, context)
-            return
+@route(menu="import_codes_wait_file", perm="student_add_delete")
+async def on_import_codes_file(update, context, text):
+    msg = update.message
+    if msg and msg.document:
+        await handle_import_codes_file(update, context, msg.document)
+    else:
+        await update.message.reply_text("📄 أرسل ملف CSV الآن أو ارجع للخلف.")
 
-        # استيراد أكواد
-        if text == IMPORT_CODES_BTN:
-            if not can_admin(user_id, "student_add_delete"):
-                await update.message.reply_text("❌ ليس لديك صلاحية إضافة/حذف الطلاب.")
-                return
-            await import_codes_prompt(update, context)
-            return
+# --------- الشكاوى (عرض) ---------
+@route(text=ADMIN_VIEW_COMPLAINTS_BTN, perm="complaints")
+async def on_view_complaints(update, context, text):
+    await show_admin_complaints_list(update, context, 0)
 
-        if user_data.get("current_menu") == "import_codes_wait_file":
-            if not can_admin(user_id, "student_add_delete"):
-                await update.message.reply_text("❌ ليس لديك صلاحية إضافة/حذف الطلاب.")
-                return
-            if msg and msg.document:
-                await handle_import_codes_file(update, context, msg.document)
-            else:
-                await update.message.reply_text("📄 أرسل ملف CSV الآن أو ارجع للخلف.")
-            return
+@route(menu="admin_complaints_list", text=NEXT_BTN, perm="complaints")
+async def on_complaints_next(update, context, text):
+    await show_admin_complaints_list(update, context, context.user_data.get("complaints_page", 0) + 1)
 
-        # الشكاوى (عرض)
-        if text == ADMIN_VIEW_COMPLAINTS_BTN:
-            if not can_admin(user_id, "complaints"):
-                await update.message.reply_text("❌ ليس لديك صلاحية عرض الشكاوى.")
-                return
-            await show_admin_complaints_list(update, context, 0)
-            return
+@route(menu="admin_complaints_list", text=PREV_BTN, perm="complaints")
+async def on_complaints_prev(update, context, text):
+    page = context.user_data.get("complaints_page", 0)
+    if page > 0:
+        await show_admin_complaints_list(update, context, page - 1)
+    else:
+        await reply_default(update)
 
-        if user_data.get("current_menu") == "admin_complaints_list":
-            if not can_admin(user_id, "complaints"):
-                await update.message.reply_text("❌ ليس لديك صلاحية عرض الشكاوى.")
-                return
-            page = user_data.get("complaints_page", 0)
-            if text == NEXT_BTN:
-                await show_admin_complaints_list(update, context, page + 1)
-                return
-            if text == PREV_BTN and page > 0:
-                await show_admin_complaints_list(update, context, page - 1)
-                return
-            m = re.match(r"^شكوى/اقتراح\s+#(\d+)$", text)
-            if m:
-                await show_admin_complaint_detail(update, context, int(m.group(1)))
-                return
+@route(menu="admin_complaints_list", perm="complaints")
+async def on_complaint_pick(update, context, text):
+    m = re.match(r"^شكوى/اقتراح\s+#(\d+)$", text)
+    if m:
+        await show_admin_complaint_detail(update, context, int(m.group(1)))
+    else:
+        await reply_default(update)
 
-        # بث
-        if text == BROADCAST_BTN:
-            await admin_broadcast_start(update, context)
-            return
+# --------- بث ---------
+@route(text=BROADCAST_BTN, perm="broadcast")
+async def on_broadcast(update, context, text):
+    await admin_broadcast_start(update, context)
 
-        if user_data.get("current_menu") == "admin_broadcast_prompt":
-            if not can_admin(user_id, "broadcast"):
-                await update.message.reply_text("❌ ليس لديك صلاحية بث الإشعارات.")
-                return
-            if msg and (msg.text or msg.caption or msg.photo or msg.video):
-                await admin_broadcast_collect(update, context, msg)
-            else:
-                await update.message.reply_text("أرسل نصًا أو صورة/فيديو مع كابشن.")
-            return
+@route(menu="admin_broadcast_prompt", perm="broadcast")
+async def on_broadcast_content(update, context, text):
+    msg = update.message
+    if msg and (msg.text or msg.caption or msg.photo or msg.video):
+        await admin_broadcast_collect(update, context, msg)
+    else:
+        await update.message.reply_text("أرسل نصًا أو صورة/فيديو مع كابشن.")
 
-        if user_data.get("current_menu") == "admin_broadcast_confirm":
-            if not can_admin(user_id, "broadcast"):
-                await update.message.reply_text("❌ ليس لديك صلاحية بث الإشعارات.")
-                return
-            if text == CONFIRM_SEND_BTN:
-                await admin_broadcast_send(update, context)
-            elif text == CANCEL_ACTION_BTN:
-                for k in ["broadcast_type", "broadcast_text", "broadcast_photo_id", "broadcast_video_id"]:
-                    user_data.pop(k, None)
-                await show_admin_panel(update, context)
-            return
+@route(menu="admin_broadcast_audience", text=AUDIENCE_ALL_BTN, perm="broadcast")
+async def on_broadcast_audience_all(update, context, text):
+    await show_broadcast_confirm(update, context, {"kind": "all"})
 
-        # إحصائيات
-        if text == STATS_BTN:
-            if not can_admin(user_id, "stats"):
-                await update.message.reply_text("❌ ليس لديك صلاحية الإحصائيات.")
-                return
-            s = get_stats_summary()
-            lines = [
-                "📊 إحصائيات البوت:",
-                f"- إجمالي المستخدمين: {s['total_users']}",
-                f"- المستخدمون النشطون آخر 7 أيام: {s['active_7d']}",
-                f"- إجمالي مرات التحميل: {s['downloads_total']}",
-                f"- عدد الملفات التي تم تحميلها (مرة واحدة على الأقل): {s['files_with_downloads']}",
-            ]
-            if s["top_lines"]:
-                lines.append("🏆 أكثر الملفات تحميلاً:")
-                lines.extend(s["top_lines"])
-            await update.message.reply_text("\n".join(lines))
-            return
+@route(menu="admin_broadcast_audience", text=AUDIENCE_LOGGED_IN_BTN, perm="broadcast")
+async def on_broadcast_audience_logged_in(update, context, text):
+    await show_broadcast_confirm(update, context, {"kind": "logged_in"})
 
-    # رد افتراضي
-    await update.message.reply_text("من فضلك اختر من القوائم المتاحة أو استخدم أزرار التنقل.")
+@route(menu="admin_broadcast_audience", text=AUDIENCE_CODE_PREFIX_BTN, perm="broadcast")
+async def on_broadcast_audience_prefix(update, context, text):
+    await show_broadcast_prefix_prompt(update, context)
 
-# ------------------ أوامر سريعة ------------------
-async def cmd_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_admin(update.effective_user.id) or not can_admin(update.effective_user.id, "broadcast"):
+@route(menu="admin_broadcast_code_prefix", perm="broadcast")
+async def on_broadcast_code_prefix_text(update, context, text):
+    prefix = normalize_code(text)
+    if not prefix:
+        await update.message.reply_text("❌ اكتب أرقاماً فقط.")
         return
-    await admin_broadcast_start(update, context)
+    await show_broadcast_confirm(update, context, {"kind": "code_prefix", "value": prefix})
 
-async def cmd_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_admin(update.effective_user.id) or not can_admin(update.effective_user.id, "stats"):
+@route(menu="admin_broadcast_audience", text=AUDIENCE_ACTIVE_BTN, perm="broadcast")
+async def on_broadcast_audience_active(update, context, text):
+    await show_broadcast_days_prompt(update, context)
+
+@route(menu="admin_broadcast_active_days", perm="broadcast")
+async def on_broadcast_active_days_text(update, context, text):
+    days = normalize_code(text)
+    if not days or not (1 <= int(days) <= 365):
+        await update.message.reply_text("❌ اكتب رقماً بين 1 و 365.")
         return
+    await show_broadcast_confirm(update, context, {"kind": "active_days", "value": int(days)})
+
+@route(menu="admin_broadcast_confirm", text=CONFIRM_SEND_BTN, perm="broadcast")
+async def on_broadcast_confirm(update, context, text):
+    await admin_broadcast_send(update, context)
+
+@route(menu="admin_broadcast_prompt", text=CANCEL_ACTION_BTN, perm="broadcast")
+@route(menu="admin_broadcast_audience", text=CANCEL_ACTION_BTN, perm="broadcast")
+@route(menu="admin_broadcast_confirm", text=CANCEL_ACTION_BTN, perm="broadcast")
+async def on_broadcast_cancel(update, context, text):
+    for k in ["broadcast_type", "broadcast_text", "broadcast_photo_id", "broadcast_video_id", "broadcast_audience"]:
+        context.user_data.pop(k, None)
+    await show_admin_panel(update, context)
+
+@route(text=BROADCAST_JOBS_BTN, perm="broadcast")
+async def on_broadcast_jobs(update, context, text):
+    await show_broadcast_jobs(update, context)
+
+@route(menu="broadcast_jobs", perm="broadcast")
+async def on_broadcast_job_selected(update, context, text):
+    m = re.match(r"^📢 #(\d+)", text)
+    job = get_broadcast_job(m.group(1)) if m else None
+    if job:
+        await show_broadcast_job(update, context, job)
+    else:
+        await reply_default(update)
+
+async def current_broadcast_job(update, context):
+    job = get_broadcast_job(context.user_data.get("selected_broadcast_job"))
+    if not job:
+        await update.message.reply_text("❌ المهمة غير موجودة.")
+        await show_broadcast_jobs(update, context)
+    return job
+
+@route(menu="broadcast_job", text=PAUSE_BROADCAST_BTN, perm="broadcast")
+async def on_broadcast_pause(update, context, text):
+    job = await current_broadcast_job(update, context)
+    if job and job["status"] == "running":
+        # المرسلون يتوقفون بعد الرسالة الجارية، والمؤشر محفوظ
+        job["status"] = "paused"
+        save_broadcast_jobs(load_broadcast_jobs())
+        await update.message.reply_text(f"⏸ تم إيقاف البث #{job['id']} مؤقتاً.")
+    if job:
+        await show_broadcast_job(update, context, job)
+
+@route(menu="broadcast_job", text=RESUME_BROADCAST_BTN, perm="broadcast")
+async def on_broadcast_resume(update, context, text):
+    job = await current_broadcast_job(update, context)
+    if job and job["status"] == "paused":
+        start_broadcast_job(context.application, job)
+        await update.message.reply_text(f"▶️ تم استئناف البث #{job['id']}.")
+    if job:
+        await show_broadcast_job(update, context, job)
+
+@route(menu="broadcast_job", text=CANCEL_BROADCAST_BTN, perm="broadcast")
+async def on_broadcast_job_cancel(update, context, text):
+    job = await current_broadcast_job(update, context)
+    if job and job["status"] in ("running", "paused"):
+        job["status"] = "cancelled"
+        save_broadcast_jobs(load_broadcast_jobs())
+        await update.message.reply_text(f"🛑 تم إلغاء البث #{job['id']}.")
+    if job:
+        await show_broadcast_job(update, context, job)
+
+# --------- إحصائيات ---------
+def format_stats_summary():
     s = get_stats_summary()
     lines = [
         "📊 إحصائيات البوت:",
         f"- إجمالي المستخدمين: {s['total_users']}",
+        f"- مستخدمون لا يمكن الوصول إليهم (حظروا البوت/حذفوا الحساب): {s['unreachable_users']}",
         f"- المستخدمون النشطون آخر 7 أيام: {s['active_7d']}",
         f"- إجمالي مرات التحميل: {s['downloads_total']}",
         f"- عدد الملفات التي تم تحميلها (مرة واحدة على الأقل): {s['files_with_downloads']}",
@@ -2431,7 +4779,27 @@ async def cmd_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if s["top_lines"]:
         lines.append("🏆 أكثر الملفات تحميلاً:")
         lines.extend(s["top_lines"])
-    await update.message.reply_text("\n".join(lines))
+    return "\n".join(lines)
+
+@route(text=STATS_BTN, perm="stats")
+async def on_stats(update, context, text):
+    await update.message.reply_text(format_stats_summary())
+
+# ------------------ أوامر سريعة ------------------
+async def cmd_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id) or not can_admin(update.effective_user.id, "broadcast"):
+        return
+    await admin_broadcast_start(update, context)
+
+async def cmd_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id) or not can_admin(update.effective_user.id, "stats"):
+        return
+    await update.message.reply_text(format_stats_summary())
+
+async def cmd_perf(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id) or not can_admin(update.effective_user.id, "stats"):
+        return
+    await update.message.reply_text(perf_report())
 
 # ------------------ معالجة الأخطاء ------------------
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -2443,24 +4811,389 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
     except Exception:
         pass
 
+# ------------------ معالجة التحديثات بالتوازي ------------------
+# تحديثات المستخدمين المختلفين تُعالج بالتوازي (حتى MAX_CONCURRENT_UPDATES)، أما
+# تحديثات نفس المستخدم فتُنفذ بالترتيب حتى لا تتسابق على menu_stack في user_data.
+# ترتيب المستخدم يسبق الحد العام: تحديثات مستخدم يُغرق البوت تنتظر دورها بدون أن تحجز
+# أماكن من MAX_CONCURRENT_UPDATES، فلا يتأخر باقي المستخدمين.
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "64"))
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self._user_locks = {}  # user_id -> [asyncio.Lock, عدد المنتظرين]
+
+    async def process_update(self, update, coroutine):
+        # BaseUpdateProcessor.process_update يأخذ الحد العام ثم يستدعي do_process_update؛
+        # نأخذ قفل المستخدم قبله
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            await super().process_update(update, coroutine)
+            return
+        entry = self._user_locks.get(user.id)
+        if entry is None:
+            entry = self._user_locks[user.id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            started = time.perf_counter()
+            async with entry[0]:
+                perf_record("lock.user", time.perf_counter() - started)
+                await super().process_update(update, coroutine)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                self._user_locks.pop(user.id, None)
+
+    async def do_process_update(self, update, coroutine):
+        metric_inc("bot_updates_total")
+        with perf_timer("update"):
+            await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+# ------------------ نقطة المقاييس (Prometheus) ------------------
+# METRICS_PORT يفعّل خادم HTTP صغير داخل نفس الـ event loop: GET /metrics
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0") or 0)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+
+# بادئة مفتاح القياس -> (اسم المقياس، اسم الـ label)
+PERF_METRICS = {
+    "route": ("bot_handler_seconds", "route"),
+    "storage": ("bot_storage_seconds", "op"),
+    "api": ("bot_api_seconds", "method"),
+    "lock": ("bot_lock_wait_seconds", "lock"),
+    "flush": ("bot_flush_seconds", "kind"),
+    "update": ("bot_update_seconds", None),
+    "tts": ("bot_tts_seconds", "op"),
+}
+
+def _metric_labels(labels):
+    if not labels:
+        return ""
+    esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in labels) + "}"
+
+def render_metrics(app=None):
+    lines = []
+    # العدادات
+    seen = set()
+    for (name, labels), value in sorted(_metric_counters.items()):
+        if name not in seen:
+            lines.append(f"# TYPE {name} counter")
+            seen.add(name)
+        lines.append(f"{name}{_metric_labels(labels)} {value}")
+    # الـ histograms
+    by_metric = {}
+    for key in sorted(_perf_hist):
+        prefix, _, rest = key.partition(".")
+        name, label = PERF_METRICS.get(prefix, ("bot_other_seconds", "key"))
+        labels = ((label, rest or key),) if label else ()
+        by_metric.setdefault(name, []).append((labels, _perf_hist[key]))
+    for name, series in by_metric.items():
+        lines.append(f"# TYPE {name} histogram")
+        for labels, hist in series:
+            cumulative = 0
+            for le, cnt in zip(PERF_BUCKETS + ("+Inf",), hist[:-1]):
+                cumulative += cnt
+                lines.append(f"{name}_bucket{_metric_labels(labels + (('le', le),))} {cumulative}")
+            lines.append(f"{name}_sum{_metric_labels(labels)} {hist[-1]:.6f}")
+            lines.append(f"{name}_count{_metric_labels(labels)} {cumulative}")
+    # أعماق الطوابير والحالات المعلقة
+    gauges = [
+        ("bot_state_dirty", (), len(_state_dirty)),
+        ("bot_user_data_dirty", (), len(_user_data_dirty)),
+        ("bot_audience_pending", (), len(_audience_added) + len(_audience_status)),
+        ("bot_stats_pending", (), len(_pending_downloads) + len(_pending_activity)),
+        ("bot_audience_size", (), len(get_audience())),
+        ("bot_audience_unreachable", (), len(_audience_unreachable)),
+    ]
+    if app is not None:
+        gauges.append(("bot_update_queue_depth", (), app.update_queue.qsize()))
+    for job in unfinished_broadcast_jobs():
+        job_labels = (("job", job["id"]), ("status", job["status"]))
+        gauges.append(("bot_broadcast_recipients", job_labels, job.get("total", len(job.get("recipients", ())))))
+        for outcome, cnt in job["counts"].items():
+            gauges.append(("bot_broadcast_processed", job_labels + (("outcome", outcome),), cnt))
+    seen = set()
+    for name, labels, value in gauges:
+        if name not in seen:
+            lines.append(f"# TYPE {name} gauge")
+            seen.add(name)
+        lines.append(f"{name}{_metric_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+async def read_http_request(reader, max_body=1 << 20, timeout=10.0):
+    # ترجع (method, path, headers, body) أو None إذا كان الطلب غير صالح
+    request_line = await asyncio.wait_for(reader.readline(), timeout)
+    parts = request_line.decode("latin-1").split()
+    if len(parts) < 2:
+        return None
+    headers = {}
+    while True:
+        line = await asyncio.wait_for(reader.readline(), timeout)
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get("content-length") or 0)
+    if length > max_body:
+        return None
+    body = await asyncio.wait_for(reader.readexactly(length), timeout) if length else b""
+    return parts[0].upper(), parts[1].split("?", 1)[0], headers, body
+
+def write_http_response(writer, status, body=b"", content_type="text/plain; charset=utf-8"):
+    writer.write((f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                  f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n").encode("latin-1") + body)
+
+async def start_metrics_server(app, host=METRICS_HOST, port=METRICS_PORT):
+    async def handle(reader, writer):
+        try:
+            req = await read_http_request(reader, max_body=0)
+            if req and req[0] == "GET" and req[1] == "/metrics":
+                write_http_response(writer, "200 OK", render_metrics(app).encode("utf-8"),
+                                    "text/plain; version=0.0.4; charset=utf-8")
+            else:
+                write_http_response(writer, "404 Not Found", b"not found\n")
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        except Exception:
+            logger.exception("Metrics request failed")
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    logger.info("Metrics endpoint on http://%s:%s/metrics", host, port)
+    return server
+
+# ------------------ وضع الـ Webhook ------------------
+# BOT_MODE=webhook: بدلاً من run_polling يستقبل البوت التحديثات على WEBHOOK_PATH مباشرة.
+# كل طلب يُتحقق من X-Telegram-Bot-Api-Secret-Token ثم يوضع في app.update_queue؛
+# إذا امتلأ الطابور (WEBHOOK_MAX_QUEUE) نرد 503 فيعيد تيليجرام الإرسال لاحقاً.
+BOT_MODE = os.getenv("BOT_MODE", "polling").strip().lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # إذا حُدد يتم استدعاء setWebhook عند التشغيل
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT") or os.getenv("PORT") or 8443)
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_MAX_QUEUE = int(os.getenv("WEBHOOK_MAX_QUEUE", "1000"))
+
+async def start_webhook_server(app, secret, host=WEBHOOK_HOST, port=WEBHOOK_PORT, path=WEBHOOK_PATH,
+                               max_queue=WEBHOOK_MAX_QUEUE):
+    expected = secret.encode("utf-8")
+
+    async def respond(reader):
+        req = await read_http_request(reader)
+        if req is None:
+            return "400 Bad Request"
+        method, req_path, headers, body = req
+        token = headers.get("x-telegram-bot-api-secret-token", "").encode("utf-8")
+        if req_path != path:
+            return "404 Not Found"
+        if method != "POST":
+            return "405 Method Not Allowed"
+        if not hmac.compare_digest(token, expected):
+            metric_inc("bot_webhook_rejected_total", (("reason", "secret"),))
+            return "403 Forbidden"
+        if app.update_queue.qsize() >= max_queue:
+            metric_inc("bot_webhook_rejected_total", (("reason", "queue_full"),))
+            return "503 Service Unavailable"
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return "400 Bad Request"
+        update = Update.de_json(data, app.bot)
+        app.update_queue.put_nowait(update)
+        return "200 OK"
+
+    async def handle(reader, writer):
+        # كل طلب قُرئ يأخذ رداً: بدونه يعيد تيليجرام إرسال نفس التحديث مراراً
+        try:
+            try:
+                status = await respond(reader)
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                return
+            except ValueError:
+                status = "400 Bad Request"
+            except Exception:
+                logger.exception("Webhook request failed")
+                status = "500 Internal Server Error"
+            write_http_response(writer, status)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    logger.info("Webhook listener on http://%s:%s%s", host, port, path)
+    return server
+
+async def run_webhook(app):
+    secret = WEBHOOK_SECRET
+    if not secret:
+        if not WEBHOOK_URL:
+            raise RuntimeError("BOT_MODE=webhook requires WEBHOOK_SECRET (or WEBHOOK_URL to register one)")
+        secret = secrets.token_urlsafe(32)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+
+    await app.initialize()
+    if app.post_init:
+        await app.post_init(app)
+    if WEBHOOK_URL:
+        await app.bot.set_webhook(url=WEBHOOK_URL, secret_token=secret, allowed_updates=Update.ALL_TYPES)
+    server = await start_webhook_server(app, secret)
+    await app.start()
+    try:
+        await stop.wait()
+    finally:
+        server.close()
+        await app.stop()
+        await app.shutdown()
+        if app.post_shutdown:
+            await app.post_shutdown(app)
+
+# ------------------ المزامنة بين أكثر من worker ------------------
+# مع STORAGE_BACKEND=sqlite على ملف مشترك (volume) يمكن تشغيل أكثر من worker خلف نفس
+# الـ webhook. كل كتابة تزيد generation البيانات المكتوبة، وكل worker يقارنها مع كل دورة
+# لـ state_flusher (استعلام واحد صغير) ويعيد تحميل ما غيّرته العمليات الأخرى، ثم يبطل
+# الكاش المرتبط به. الإحصائيات تُكتب كزيادات فلا تضيع زيادات أي worker.
+# مع JSON نفس الآلية تعمل بمقارنة mtime لملفات الإعدادات (JSON_WATCHED_FILES)، فأي تعديل
+# خارجي على الأدمنز/الصلاحيات يُلتقط خلال STATE_FLUSH_INTERVAL بدون أي قراءة مع كل رسالة.
+WORKER_ID = os.getenv("WORKER_ID") or os.getenv("DYNO") or "main"
+
+def _reset_activity_index(old):
+    global _activity_day, _activity_buckets
+    _activity_day = _activity_buckets = None
+
+# name -> دالة تُستدعى بعد إعادة التحميل (تستقبل البيانات القديمة)
+STATE_RELOAD_HOOKS = {
+    "admins": lambda old: load_admins(),
+    "admin_perms": lambda old: load_admin_perms(),
+    "codes": lambda old: invalidate_roster(),
+    "bot_files": lambda old: invalidate_dedupe_index(),
+    "file_meta": lambda old: invalidate_dedupe_index(),
+    "users": lambda old: invalidate_code_index(),
+    "stats": _reset_activity_index,
+    "broadcast_jobs": merge_reloaded_broadcast_jobs,
+}
+
+async def sync_state():
+    storage = get_storage()
+    # تحت _flush_lock: لا تتداخل إعادة التحميل مع كتابة جارية لنفس البيانات
+    async with _flush_lock:
+        # ما لدينا تغييرات لم تُكتب بعد يؤجل للدورة التالية (كتابتنا أولاً)
+        busy = set(_state_dirty)
+        if _audience_added or _audience_status:
+            busy.add("audience")
+        if _sessions_dirty:
+            busy.add("sessions")
+        changed = await asyncio.to_thread(storage.changed_names, busy)
+        for name in changed:
+            if name == "sessions":
+                load_sessions()
+            elif name == "audience":
+                load_audience()
+            elif name in STATE_FILES:
+                try:
+                    data, token = await asyncio.to_thread(storage.read, name)
+                except ValueError:
+                    logger.warning("Ignoring invalid %s changed outside the bot; keeping the loaded copy", name)
+                    continue
+                if name in _state_dirty:
+                    # عدّله handler أثناء القراءة: لا نستبدل تعديله، ويبقى التغيير الخارجي
+                    # مكتشَفاً (لم نعتمد نسخته) فيُعاد تحميله بعد أن نكتب
+                    continue
+                storage.adopt(name, data, token)
+                old = _state.get(name)
+                _state[name] = data
+                hook = STATE_RELOAD_HOOKS.get(name)
+                if hook:
+                    hook(old)
+            logger.info("Reloaded %s changed outside this process", name)
+
+# ------------------ دورة حياة التطبيق ------------------
+_background_tasks = []
+_servers = []
+
+async def on_startup(app):
+    await compact_sessions()
+    _background_tasks.append(asyncio.create_task(state_flusher()))
+    if METRICS_PORT:
+        _servers.append(await start_metrics_server(app))
+    # استئناف أي بث انقطع بسبب إعادة التشغيل
+    resume_broadcast_jobs(app)
+
+async def on_shutdown(app):
+    for task in _background_tasks:
+        task.cancel()
+    _background_tasks.clear()
+    for server in _servers:
+        server.close()
+    _servers.clear()
+    # البث الجاري يبقى "running" في المهمة المحفوظة ويُستأنف عند التشغيل التالي
+    for task in _broadcast_tasks.values():
+        task.cancel()
+    _broadcast_tasks.clear()
+    # الأجزاء المرفوعة محفوظة، وإعادة اختيار التسجيل تكمل الرفع
+    for task in _large_upload_tasks.values():
+        task.cancel()
+    _large_upload_tasks.clear()
+    if _mtproto_uploader is not None:
+        await _mtproto_uploader.close()
+    if _tts_executor is not None:
+        _tts_executor.shutdown(wait=False, cancel_futures=True)
+    # كتابة أي تغييرات متبقية قبل الإغلاق
+    commit_pending_ingests()
+    merge_pending_stats()
+    await flush_state()
+    await flush_user_data()
+    await flush_audience()
+    await flush_sessions()
+
 # ------------------ تشغيل ------------------
 if __name__ == "__main__":
-    # تحميل الأدمن والصلاحيات + إصلاح سجل الدخول
+    # تحميل الأدمن والصلاحيات + فهرس الجلسات + تحميل البيانات في الذاكرة
     load_admins()
     load_admin_perms()
-    fix_logged_file()
+    load_sessions()
+    load_audience()
+    load_state()
 
     # يمكنك استخدام متغير بيئة للتوكن
     token_env = os.getenv("BOT_TOKEN")
     bot_token = token_env if token_env else TOKEN
 
-    app = ApplicationBuilder().token(bot_token).build()
+    app = (
+        ApplicationBuilder()
+        .token(bot_token)
+        .request(TimedRequest(connection_pool_size=256))
+        .concurrent_updates(PerUserUpdateProcessor(MAX_CONCURRENT_UPDATES))
+        .persistence(StoragePersistence())
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("broadcast", cmd_broadcast))
     app.add_handler(CommandHandler("stats", cmd_stats))
+    app.add_handler(CommandHandler("perf", cmd_perf))
     app.add_handler(MessageHandler(filters.ALL, handle_message))
     app.add_error_handler(error_handler)
 
     print("🤖 البوت يعمل الآن …")
 
-    app.run_polling()
+    if BOT_MODE == "webhook":
+        asyncio.run(run_webhook(app))
+    else:
+        app.run_polling()
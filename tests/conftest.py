@@ -0,0 +1,21 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot  # noqa: E402
+
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    # كل اختبار يعمل في مجلد بيانات فارغ بحالة ذاكرة جديدة
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(bot, "_storage", None)
+    monkeypatch.setattr(bot, "_state", {})
+    monkeypatch.setattr(bot, "_state_dirty", set())
+    monkeypatch.setattr(bot, "_dedupe_index", None)
+    monkeypatch.setattr(bot, "_large_uploads", None)
+    monkeypatch.setattr(bot, "_broadcast_tasks", {})
+    return tmp_path
@@ -0,0 +1,57 @@
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot  # noqa: E402
+
+
+class FakeBot:
+    def __init__(self):
+        self.delivered = []
+
+    async def send_message(self, chat_id, text=None, **kwargs):
+        if chat_id != 0:
+            await asyncio.sleep(0.002)
+            self.delivered.append(chat_id)
+
+
+def test_unsaved_outcomes_stay_within_one_batch(data_dir, monkeypatch):
+    monkeypatch.setattr(bot, "_broadcast_bucket", bot.TokenBucket(2000))
+    monkeypatch.setattr(bot, "BROADCAST_PROGRESS_INTERVAL", 60)
+
+    async def run():
+        fake = FakeBot()
+        job = await bot.create_broadcast_job(0, {"type": "text", "text": "hi"}, range(1, 301))
+        task = asyncio.create_task(bot.run_broadcast(fake, job))
+        worst = 0
+        while not task.done():
+            await asyncio.sleep(0.01)
+            _, outcomes = await bot.get_storage().load_broadcast_progress(job["id"])
+            # ما وصل ولم تُحفظ نتيجته هو ما سيُعاد إرساله لو قُتلت العملية الآن
+            worst = max(worst, len(fake.delivered) - sum(1 for o in outcomes if o))
+        await task
+        return fake, job, worst
+
+    fake, job, worst = asyncio.run(run())
+    assert sorted(fake.delivered) == list(range(1, 301))
+    assert job["status"] == "done"
+    assert worst <= bot.BROADCAST_OUTCOME_BATCH + bot.BROADCAST_WORKERS
+
+
+def test_job_document_is_saved_only_on_status_changes(data_dir, monkeypatch):
+    monkeypatch.setattr(bot, "_broadcast_bucket", bot.TokenBucket(2000))
+    saves = []
+    original = bot.save_broadcast_jobs
+    monkeypatch.setattr(bot, "save_broadcast_jobs", lambda jobs: (saves.append(1), original(jobs)))
+
+    async def run():
+        job = await bot.create_broadcast_job(0, {"type": "text", "text": "hi"}, range(1, 101))
+        saves.clear()
+        await bot.run_broadcast(FakeBot(), job)
+        return job
+
+    job = asyncio.run(run())
+    assert job["status"] == "done"
+    assert len(saves) == 1
@@ -0,0 +1,56 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot  # noqa: E402
+
+
+@pytest.mark.skipif(bot.fcntl is None, reason="flock is not available")
+def test_cancelled_waiter_does_not_leak_the_lock(tmp_path):
+    path = str(tmp_path / "data.json")
+
+    async def run():
+        # قفل خارجي (عملية أخرى مثلاً) يجعل المنتظر ينتظر داخل الـ thread
+        held = bot._acquire_flock(path + ".lock", 1)
+
+        async def waiter():
+            async with bot.file_lock(path, timeout=5):
+                pass
+
+        task = asyncio.create_task(waiter())
+        await asyncio.sleep(0.2)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        bot._release_flock(held)
+        # الـ thread المتروك يأخذ القفل بعد تحريره ثم يُحرر تلقائياً
+        await asyncio.sleep(0.3)
+        async with bot.file_lock(path, timeout=1):
+            return True
+
+    assert asyncio.run(run())
+
+
+def test_file_lock_serializes_writers(tmp_path):
+    path = str(tmp_path / "counter.txt")
+    with open(path, "w") as f:
+        f.write("0")
+
+    async def bump():
+        async with bot.file_lock(path):
+            with open(path) as f:
+                value = int(f.read())
+            await asyncio.sleep(0.001)
+            with open(path, "w") as f:
+                f.write(str(value + 1))
+
+    async def run():
+        await asyncio.gather(*(bump() for _ in range(20)))
+
+    asyncio.run(run())
+    with open(path) as f:
+        assert f.read() == "20"
@@ -0,0 +1,65 @@
+import asyncio
+import os
+import sys
+import types
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot  # noqa: E402
+
+
+class FakeBot:
+    def __init__(self):
+        self.texts = []
+
+    async def send_message(self, chat_id, text):
+        self.texts.append(text)
+
+
+def upload(n):
+    return types.SimpleNamespace(file_id="ID" + n, file_unique_id="U" + n, file_name=n + ".pdf",
+                                 file_size=10, mime_type="application/pdf")
+
+
+@pytest.fixture
+def ingest(data_dir, monkeypatch):
+    monkeypatch.setattr(bot, "INGEST_DEBOUNCE", 0.05)
+    monkeypatch.setattr(bot, "_ingest_batches", {})
+    bot.save_bot_files({"Math": {"L1": {}}})
+    return data_dir
+
+
+def test_batch_is_written_after_the_quiet_period(ingest):
+    fake = FakeBot()
+
+    async def run():
+        bot.queue_ingest(fake, 9, "Math", "L1", upload("a"))
+        bot.queue_ingest(fake, 9, "Math", "L1", upload("b"))
+        await asyncio.sleep(0.2)
+
+    asyncio.run(run())
+    assert bot.load_bot_files()["Math"]["L1"] == {"a.pdf": "IDa", "b.pdf": "IDb"}
+    assert len(fake.texts) == 1 and "✅ أضيف 2" in fake.texts[0]
+
+
+@pytest.mark.parametrize("deleted", ["subject", "lecture"])
+def test_batch_for_a_deleted_lecture_is_dropped(ingest, deleted):
+    fake = FakeBot()
+
+    async def run():
+        bot.queue_ingest(fake, 9, "Math", "L1", upload("a"))
+        # أدمن آخر يحذف المادة/المحاضرة قبل انتهاء مهلة الهدوء
+        bot_files = bot.load_bot_files()
+        if deleted == "subject":
+            del bot_files["Math"]
+        else:
+            del bot_files["Math"]["L1"]
+        bot.save_bot_files(bot_files)
+        await asyncio.sleep(0.2)
+
+    asyncio.run(run())
+    assert bot.load_bot_files() == ({} if deleted == "subject" else {"Math": {}})
+    assert "IDa" not in bot.load_file_meta()
+    assert len(fake.texts) == 1 and fake.texts[0].startswith("❌ حُذفت Math > L1")
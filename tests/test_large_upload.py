@@ -0,0 +1,110 @@
+import asyncio
+import os
+import sys
+import types
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot  # noqa: E402
+
+
+class StubUploader:
+    # بديل Telethon: يسجل الأجزاء المرفوعة ويفشل عند جزء محدد
+    def __init__(self, fail_at=None):
+        self.fail_at = fail_at
+        self.parts = []
+        self.sent = []
+
+    async def save_part(self, upload_id, index, total, data, big):
+        if index == self.fail_at:
+            raise RuntimeError("connection lost")
+        self.parts.append((upload_id, index))
+
+    async def send(self, chat_id, upload_id, total, name, big, caption):
+        self.sent.append((upload_id, total, name))
+        return 42
+
+
+@pytest.fixture
+def small_parts(data_dir, monkeypatch):
+    monkeypatch.setattr(bot, "LARGE_UPLOAD_PART_SIZE", 1024)
+    monkeypatch.setattr(bot, "LARGE_UPLOAD_SAVE_EVERY", 4)
+    monkeypatch.setattr(bot, "LARGE_UPLOAD_RETRIES", 1)
+    monkeypatch.setattr(bot, "LARGE_UPLOAD_WORKERS", 1)
+    monkeypatch.setattr(bot, "_mtproto_uploader", None)
+    os.makedirs(bot.LARGE_UPLOAD_DIR)
+    return data_dir
+
+
+def make_file(name, size):
+    path = os.path.join(bot.LARGE_UPLOAD_DIR, name)
+    with open(path, "wb") as f:
+        f.write(os.urandom(size))
+    return path
+
+
+def test_resume_uploads_only_missing_parts(small_parts):
+    path = make_file("lecture.mp4", 20 * 1024)
+    first = StubUploader(fail_at=10)
+    with pytest.raises(RuntimeError):
+        asyncio.run(bot.upload_large_file(first, path, 1))
+    assert [i for _, i in first.parts] == list(range(10))
+    # الحالة على القرص تكفي للاستئناف بعد إعادة التشغيل
+    bot._large_uploads = None
+
+    second = StubUploader()
+    assert asyncio.run(bot.upload_large_file(second, path, 1)) == 42
+    assert [i for _, i in second.parts] == list(range(10, 20))
+    assert {u for u, _ in first.parts + second.parts} == {second.sent[0][0]}
+    assert second.sent[0][1:] == (20, "lecture.mp4")
+    assert bot.load_large_uploads() == {}
+
+
+def test_part_cap_is_enforced(small_parts, monkeypatch):
+    monkeypatch.setattr(bot, "LARGE_UPLOAD_MAX_PARTS", 4)
+    path = make_file("huge.mp4", 4 * 1024 + 1)
+    uploader = StubUploader()
+    with pytest.raises(ValueError):
+        asyncio.run(bot.upload_large_file(uploader, path, 1))
+    assert uploader.parts == []
+
+
+class FakeBot:
+    def __init__(self):
+        self.texts = []
+
+    async def send_message(self, chat_id, text):
+        self.texts.append(text)
+
+    async def forward_message(self, chat_id, from_chat_id, message_id):
+        video = types.SimpleNamespace(file_id="F1", file_unique_id="U1", file_size=2048, mime_type="video/mp4")
+        return types.SimpleNamespace(message_id=7, video=video, audio=None, document=None)
+
+    async def delete_message(self, chat_id, message_id):
+        pass
+
+
+def test_name_conflict_does_not_record_the_source(small_parts):
+    make_file("rec.mp4", 2048)
+    bot.save_bot_files({"Math": {"L1": {"rec.mp4": "OLD"}}})
+    bot.set_mtproto_uploader(StubUploader())
+
+    async def run():
+        uploader = await bot.get_mtproto_uploader()
+        await bot.run_large_upload(FakeBot(), uploader, 1, "Math", "L1", "rec.mp4")
+
+    asyncio.run(run())
+    assert bot.load_bot_files()["Math"]["L1"]["rec.mp4"] == "OLD"
+    # وإلا لأضاف اختيار التسجيل لاحقاً file_id لم يدخل الكتالوج أبداً
+    assert bot.find_source_upload(bot.large_upload_source(os.path.join(bot.LARGE_UPLOAD_DIR, "rec.mp4"))) is None
+
+
+def test_upload_records_file_and_source(small_parts):
+    make_file("rec.mp4", 2048)
+    fake = FakeBot()
+    asyncio.run(bot.run_large_upload(fake, StubUploader(), 1, "Math", "L1", "rec.mp4"))
+    assert bot.load_bot_files()["Math"]["L1"]["rec.mp4"] == "F1"
+    assert bot.load_file_meta()["F1"]["src"] == "rec.mp4|2048"
+    assert fake.texts[-1] == "✅ تم رفع الملف: rec.mp4"
@@ -0,0 +1,51 @@
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot  # noqa: E402
+from telegram.error import BadRequest  # noqa: E402
+
+
+def test_kind_comes_from_meta_then_extension():
+    meta = {"A1": {"mime": "audio/mpeg"}, "D1": {"mime": "application/pdf"}}
+    assert bot.file_kind("record", "A1", meta) == "audio"
+    assert bot.file_kind("notes.mp3", "D1", meta) == "document"
+    assert bot.file_kind("lecture.mp4", "OLD", meta) == "video"
+    assert bot.file_kind("old-file-id", "OLD", meta) == "document"
+
+
+def test_plan_groups_by_family():
+    files = {f"p{i}.pdf": f"P{i}" for i in range(12)}
+    files.update({"a.mp3": "A", "v.mp4": "V"})
+    plan = bot.plan_lecture_bundle(files, {})
+    assert [(family, len(items)) for family, items in plan] == [("document", 10), ("document", 2), (None, 1), (None, 1)]
+    assert [items[0][2] for family, items in plan[2:]] == ["audio", "video"]
+
+
+class FakeMessage:
+    def __init__(self):
+        self.calls = []
+
+    async def reply_media_group(self, media):
+        self.calls.append(("group", len(media)))
+        raise BadRequest("Wrong file identifier/http url specified")
+
+    async def reply_audio(self, audio, caption):
+        self.calls.append(("audio", audio))
+        if audio == "DOC":
+            raise BadRequest("Can't use file of type document as audio")
+
+    async def reply_document(self, document, caption):
+        self.calls.append(("document", document))
+
+
+def test_wrong_guess_falls_back_to_single_documents(data_dir):
+    # mp3 أُرسل كمستند: الـ mime صوتي لكن file_id مستند
+    files = {"one.mp3": "DOC", "two.mp3": "AUD"}
+    message = FakeMessage()
+    sent = []
+    asyncio.run(bot.send_lecture_bundle(message, files, sent))
+    assert message.calls == [("group", 2), ("audio", "DOC"), ("document", "DOC"), ("audio", "AUD")]
+    assert sent == ["one.mp3", "two.mp3"]
@@ -0,0 +1,164 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot  # noqa: E402
+
+# كل (القائمة، النص) التي كانت سلسلة if في handle_message القديمة تفحصها؛ None للنص = إدخال حر
+# في تلك القائمة (أي نص آخر)، و None للقائمة = زر عام من أي قائمة.
+BASELINE_PAIRS = [
+    (None, "⏸️ إيقاف/إلغاء إيقاف حساب"),
+    (None, "✏️ إعادة تسمية"),
+    (None, "✏️ إعادة تسمية مادة"),
+    (None, "✏️ إعادة تسمية محاضرة"),
+    (None, "✏️ إعادة تسمية ملف"),
+    (None, "✏️ تعديل طالب"),
+    (None, "➕ إضافة طالب"),
+    (None, "➕ إضافة عنصر جديد"),
+    (None, "➕ إضافة مادة جديدة"),
+    (None, "➕ إضافة محاضرة جديدة"),
+    (None, "⬅️ رجوع للخلف"),
+    (None, "⬅️ رجوع للقائمة الرئيسية"),
+    (None, "🏠 القائمة الرئيسية"),
+    (None, "👑 إدارة الأدمنز"),
+    (None, "👤 بياناتي"),
+    (None, "📊 إحصائيات البوت"),
+    (None, "📚 المحاضرات"),
+    (None, "📝 ارسال مقترح او شكوي لادارة الكلية"),
+    (None, "📢 بث إشعار"),
+    (None, "📥 استيراد أكواد CSV"),
+    (None, "📬 عرض المقترحات والشكاوي"),
+    (None, "🗑️ حذف"),
+    (None, "🗑️ حذف طالب"),
+    (None, "🗑️ حذف مادة"),
+    (None, "🗑️ حذف محاضرة"),
+    (None, "🗑️ حذف ملف"),
+    (None, "🚪 تسجيل الخروج"),
+    (None, "🛠️ خصائص الأدمن"),
+    ("add_item_file", None),
+    ("add_item_file", "❌ إلغاء الرفع"),
+    ("add_item_lecture", None),
+    ("add_item_subject", None),
+    ("add_lecture_name", None),
+    ("add_lecture_subject", None),
+    ("add_subject", None),
+    ("admin_add_student_code", None),
+    ("admin_add_student_name", None),
+    ("admin_broadcast_confirm", None),
+    ("admin_broadcast_confirm", "✅ تأكيد الإرسال"),
+    ("admin_broadcast_confirm", "❌ إلغاء الأمر"),
+    ("admin_broadcast_prompt", None),
+    ("admin_complaints_list", None),
+    ("admin_complaints_list", "▶️ التالي"),
+    ("admin_complaints_list", "◀️ السابق"),
+    ("admin_delete_student_confirm", None),
+    ("admin_delete_student_confirm", "✅ تأكيد الحذف"),
+    ("admin_delete_student_confirm", "❌ إلغاء الأمر"),
+    ("admin_delete_student_enter_code", None),
+    ("admin_delete_student_method", None),
+    ("admin_delete_student_method", "📋 عرض جميع الطلاب"),
+    ("admin_delete_student_method", "🔢 إدخال الكود"),
+    ("admin_edit_student_choose_field", None),
+    ("admin_edit_student_choose_field", "✏️ تعديل الاسم"),
+    ("admin_edit_student_choose_field", "🔢 تعديل الكود"),
+    ("admin_edit_student_enter_code", None),
+    ("admin_edit_student_method", None),
+    ("admin_edit_student_method", "📋 عرض جميع الطلاب"),
+    ("admin_edit_student_method", "🔢 إدخال الكود"),
+    ("admin_edit_student_new_code", None),
+    ("admin_edit_student_new_name", None),
+    ("admin_suspend_enter_code", None),
+    ("admin_suspend_method", None),
+    ("admin_suspend_method", "📋 عرض جميع الطلاب"),
+    ("admin_suspend_method", "🔢 إدخال الكود"),
+    ("admin_suspend_reason", None),
+    ("admin_unsuspend_confirm", "✅ إلغاء الإيقاف"),
+    ("delete_admin_confirm", None),
+    ("delete_admin_confirm", "✅ تأكيد الحذف"),
+    ("delete_admin_confirm", "❌ إلغاء الأمر"),
+    ("delete_admin_select", None),
+    ("delete_admin_select", "▶️ التالي"),
+    ("delete_admin_select", "◀️ السابق"),
+    ("delete_file_confirm", None),
+    ("delete_file_confirm", "✅ تأكيد الحذف"),
+    ("delete_file_confirm", "❌ إلغاء الأمر"),
+    ("delete_file_select_file", None),
+    ("delete_file_select_lecture", None),
+    ("delete_file_select_subject", None),
+    ("delete_lecture_confirm", None),
+    ("delete_lecture_confirm", "✅ تأكيد الحذف"),
+    ("delete_lecture_confirm", "❌ إلغاء الأمر"),
+    ("delete_lecture_select_lecture", None),
+    ("delete_lecture_select_subject", None),
+    ("delete_student_list", None),
+    ("delete_student_list", "▶️ التالي"),
+    ("delete_student_list", "◀️ السابق"),
+    ("delete_subject_confirm", None),
+    ("delete_subject_confirm", "✅ تأكيد الحذف"),
+    ("delete_subject_confirm", "❌ إلغاء الأمر"),
+    ("delete_subject_select", None),
+    ("edit_admin_perms", None),
+    ("edit_admin_perms", "⬅️ رجوع للخلف"),
+    ("edit_admin_perms", "🏠 القائمة الرئيسية"),
+    ("edit_admin_perms_select", None),
+    ("edit_admin_perms_select", "▶️ التالي"),
+    ("edit_admin_perms_select", "◀️ السابق"),
+    ("edit_student_list", None),
+    ("edit_student_list", "▶️ التالي"),
+    ("edit_student_list", "◀️ السابق"),
+    ("import_codes_wait_file", None),
+    ("manage_admins", "✏️ تعديل صلاحيات الأدمن"),
+    ("manage_admins", "➕ إضافة أدمن"),
+    ("manage_admins", "📋 عرض الأدمنز"),
+    ("manage_admins", "🗑️ حذف أدمن"),
+    ("my_data", None),
+    ("my_data", "📆 الجدول الدراسي"),
+    ("my_data", "🕒 الغياب والحضور"),
+    ("rename_file_newname", None),
+    ("rename_file_select_file", None),
+    ("rename_file_select_lecture", None),
+    ("rename_file_select_subject", None),
+    ("rename_lecture_newname", None),
+    ("rename_lecture_select_lecture", None),
+    ("rename_lecture_select_subject", None),
+    ("rename_subject_newname", None),
+    ("rename_subject_select", None),
+    ("super_add_admin_contact", None),
+    ("super_add_admin_id", None),
+    ("super_add_admin_method", "📱 إضافة عبر جهة اتصال"),
+    ("super_add_admin_method", "🔢 إضافة عبر ID"),
+    ("super_add_admin_method", "🔤 إضافة عبر Username"),
+    ("super_add_admin_username", None),
+    ("suspend_student_list", None),
+    ("suspend_student_list", "▶️ التالي"),
+    ("suspend_student_list", "◀️ السابق"),
+    ("user_suggest_confirm", None),
+    ("user_suggest_confirm", "✅ تأكيد الإرسال"),
+    ("user_suggest_confirm", "❌ إلغاء الأمر"),
+    ("user_suggest_text", None),
+    ("view_files", None),
+    ("view_lectures", None),
+    ("view_subjects", None),
+]
+
+
+def test_baseline_pairs_are_routed():
+    routes = {key: fn for key, fn, _ in bot.iter_routes()}
+    missing = [pair for pair in BASELINE_PAIRS if pair not in routes]
+    assert not missing
+
+
+def test_edit_admin_perms_navigation_returns_to_manage_admins():
+    routes = {key: fn for key, fn, _ in bot.iter_routes()}
+    for text in (bot.BACK_BTN, bot.MAIN_BTN):
+        assert routes[("edit_admin_perms", text)] is bot.on_edit_perms_back
+    assert routes[("edit_admin_perms", None)] is bot.on_toggle_perm
+
+
+def test_menu_buttons_win_over_free_input():
+    owner = bot.OWNER_ID
+    fn, _ = bot.resolve_route(owner, "delete_file_confirm", bot.CONFIRM_DELETE_BTN)
+    assert fn is bot.on_delete_file_confirm
+    fn, _ = bot.resolve_route(owner, "delete_file_confirm", "نص آخر")
+    assert fn is bot.on_buttons_only_menu
@@ -0,0 +1,49 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot  # noqa: E402
+
+
+def test_reads_do_not_wait_for_a_writer(data_dir):
+    storage = bot.SqliteStorage(str(data_dir / "bot.db"))
+    asyncio.run(storage.save_sessions({"5": "Ali"}))
+    # transaction طويلة في thread آخر (إنشاء مستلمي بث كبير مثلاً) تمسك قفل الكتابة
+    storage._db_lock.acquire()
+    try:
+        started = time.perf_counter()
+        result = []
+        reader = threading.Thread(target=lambda: result.append(storage.get_session(5)))
+        reader.start()
+        assert storage.get_session(5) == "Ali"
+        assert storage.read("admins")[0] == []
+        reader.join(1)
+        assert result == ["Ali"]
+        assert time.perf_counter() - started < 0.5
+    finally:
+        storage._db_lock.release()
+
+
+def test_broadcast_ids_are_unique_across_workers(data_dir):
+    path = str(data_dir / "bot.db")
+    first, second = bot.SqliteStorage(path), bot.SqliteStorage(path)
+
+    async def run():
+        # كلا الـ workerين لم يرَ مهمة الآخر في الذاكرة بعد
+        return await asyncio.gather(*[s.allocate_broadcast_id(0) for s in (first, second) for _ in range(5)])
+
+    ids = asyncio.run(run())
+    assert sorted(ids) == list(range(1, 11))
+
+
+def test_json_broadcast_ids_are_unique(data_dir):
+    storage = bot.JsonStorage()
+
+    async def run():
+        return await asyncio.gather(*[storage.allocate_broadcast_id(3) for _ in range(5)])
+
+    assert sorted(asyncio.run(run())) == [4, 5, 6, 7, 8]
@@ -0,0 +1,84 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+import types
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot  # noqa: E402
+
+
+class CountingBackend:
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def __call__(self, text, lang):
+        with self._lock:
+            self.calls.append((text, lang))
+        time.sleep(self.delay)
+        return b"ID3 fake mp3"
+
+
+class FakeBot:
+    def __init__(self):
+        self.uploads = 0
+
+    async def send_audio(self, chat_id, audio, filename, title):
+        self.uploads += 1
+        file_id = f"AUDIO{self.uploads}"
+        return types.SimpleNamespace(audio=types.SimpleNamespace(file_id=file_id, file_unique_id="U" + file_id,
+                                                                 file_size=len(audio), mime_type="audio/mpeg"))
+
+
+@pytest.fixture
+def tts(data_dir, monkeypatch):
+    monkeypatch.setattr(bot, "_tts_backend", None)
+    monkeypatch.setattr(bot, "_tts_executor", None)
+    monkeypatch.setattr(bot, "_tts_inflight", {})
+    return data_dir
+
+
+def test_same_text_is_served_from_the_cache(tts):
+    backend = CountingBackend()
+    bot.set_tts_backend(backend)
+    fake = FakeBot()
+
+    async def run():
+        first = await bot.tts_summary_file_id(fake, 1, "ملخص  المحاضرة\nالأولى", "L1")
+        # نفس النص بمسافات مختلفة له نفس البصمة
+        second = await bot.tts_summary_file_id(fake, 1, "ملخص المحاضرة الأولى", "L1")
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert first == ("AUDIO1", False)
+    assert second == ("AUDIO1", True)
+    assert len(backend.calls) == 1 and fake.uploads == 1
+    key = bot.tts_text_hash("ملخص المحاضرة الأولى", bot.TTS_LANG)
+    assert bot.load_tts_cache()[key]["file_id"] == "AUDIO1"
+    assert bot.load_file_meta()["AUDIO1"]["mime"] == "audio/mpeg"
+
+
+def test_concurrent_requests_share_one_synthesis(tts):
+    backend = CountingBackend(delay=0.2)
+    bot.set_tts_backend(backend)
+    fake = FakeBot()
+
+    async def run():
+        requests = [asyncio.create_task(bot.tts_summary_file_id(fake, 1, "نص واحد", "L1")) for _ in range(5)]
+        await asyncio.sleep(0.05)
+        assert len(bot._tts_inflight) == 1
+        # إلغاء أحد الطالبين لا يلغي التحويل المشترك
+        requests[0].cancel()
+        results = await asyncio.gather(*requests[1:])
+        return results
+
+    results = asyncio.run(run())
+    assert results == [("AUDIO1", False)] * 4
+    assert len(backend.calls) == 1 and fake.uploads == 1
+    assert bot._tts_inflight == {}
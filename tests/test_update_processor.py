@@ -0,0 +1,95 @@
+import asyncio
+import os
+import sys
+import time
+from datetime import datetime, timezone
+
+from telegram import Chat, Message, Update, User
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot  # noqa: E402
+
+HANDLER_SECONDS = 0.05
+FLOOD_UPDATES = 64
+OTHER_USERS = 20
+MAX_CONCURRENT = 8
+
+
+def make_update(update_id, user_id):
+    user = User(id=user_id, first_name=f"u{user_id}", is_bot=False)
+    chat = Chat(id=user_id, type=Chat.PRIVATE)
+    message = Message(message_id=update_id, date=datetime.now(timezone.utc), chat=chat, from_user=user, text="x")
+    return Update(update_id=update_id, message=message)
+
+
+async def handler(log, user_id, seq):
+    log.append((user_id, seq))
+    await asyncio.sleep(HANDLER_SECONDS)
+
+
+def test_flooding_user_does_not_stall_others():
+    async def run():
+        processor = bot.PerUserUpdateProcessor(MAX_CONCURRENT)
+        log = []
+        latencies = {}
+
+        async def submit(update_id, user_id, seq):
+            started = time.perf_counter()
+            await processor.process_update(make_update(update_id, user_id), handler(log, user_id, seq))
+            if user_id != 1:
+                latencies[user_id] = time.perf_counter() - started
+
+        tasks = [asyncio.create_task(submit(i, 1, i)) for i in range(FLOOD_UPDATES)]
+        await asyncio.sleep(0)
+        tasks += [asyncio.create_task(submit(1000 + u, u, 0)) for u in range(2, OTHER_USERS + 2)]
+        await asyncio.gather(*tasks)
+        return log, latencies
+
+    log, latencies = asyncio.run(run())
+
+    # الـ flood وحده يحتاج FLOOD_UPDATES * HANDLER_SECONDS (3.2s) لأنه مرتب؛ باقي المستخدمين لا ينتظرونه
+    assert len(latencies) == OTHER_USERS
+    assert max(latencies.values()) < FLOOD_UPDATES * HANDLER_SECONDS / 4
+    # ترتيب تحديثات نفس المستخدم محفوظ
+    assert [seq for uid, seq in log if uid == 1] == list(range(FLOOD_UPDATES))
+
+
+def test_global_limit_still_applies():
+    async def run():
+        processor = bot.PerUserUpdateProcessor(MAX_CONCURRENT)
+        running = peak = 0
+
+        async def work():
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+
+        await asyncio.gather(*(processor.process_update(make_update(u, u), work()) for u in range(1, 50)))
+        return peak
+
+    assert asyncio.run(run()) == MAX_CONCURRENT
+
+
+def test_throughput_scales_with_users():
+    users, per_user = 20, 5
+
+    async def run():
+        processor = bot.PerUserUpdateProcessor(64)
+        log = []
+        started = time.perf_counter()
+        await asyncio.gather(*(
+            processor.process_update(make_update(u * 100 + seq, u), handler(log, u, seq))
+            for seq in range(per_user) for u in range(1, users + 1)
+        ))
+        return log, time.perf_counter() - started
+
+    log, elapsed = asyncio.run(run())
+
+    # المستخدمون يعملون بالتوازي: الزمن ~ per_user * HANDLER_SECONDS (0.25s) وليس users * per_user (5s)
+    assert len(log) == users * per_user
+    assert elapsed < per_user * HANDLER_SECONDS * 2
+    for u in range(1, users + 1):
+        assert [seq for uid, seq in log if uid == u] == list(range(per_user))
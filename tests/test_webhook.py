@@ -0,0 +1,109 @@
+import asyncio
+import json
+import os
+import sys
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot  # noqa: E402
+
+SECRET = "s3cret"
+UPDATE = {"update_id": 7, "message": {"message_id": 1, "date": 0,
+                                      "chat": {"id": 1, "type": "private"}, "text": "hi"}}
+
+
+def fake_app():
+    # بديل عن Application: الخادم يحتاج فقط update_queue و bot
+    return types.SimpleNamespace(update_queue=asyncio.Queue(), bot=None)
+
+
+async def post(port, body, secret=SECRET, path=bot.WEBHOOK_PATH, method="POST"):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write((f"{method} {path} HTTP/1.1\r\nHost: x\r\n"
+                  f"X-Telegram-Bot-Api-Secret-Token: {secret}\r\n"
+                  f"Content-Length: {len(body)}\r\n\r\n").encode("latin-1") + body)
+    await writer.drain()
+    response = await asyncio.wait_for(reader.read(), 5)
+    writer.close()
+    return response.split(b"\r\n", 1)[0].decode("latin-1")
+
+
+def serve(app, check, max_queue=10):
+    async def run():
+        server = await bot.start_webhook_server(app, SECRET, host="127.0.0.1", port=0, max_queue=max_queue)
+        try:
+            return await check(server.sockets[0].getsockname()[1])
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    return asyncio.run(run())
+
+
+def test_valid_update_is_queued():
+    app = fake_app()
+
+    async def check(port):
+        status = await post(port, json.dumps(UPDATE).encode())
+        return status, app.update_queue.get_nowait()
+
+    status, update = serve(app, check)
+    assert status == "HTTP/1.1 200 OK"
+    assert update.update_id == 7
+
+
+def test_wrong_secret_is_rejected():
+    app = fake_app()
+
+    async def check(port):
+        return await post(port, json.dumps(UPDATE).encode(), secret="nope")
+
+    assert serve(app, check) == "HTTP/1.1 403 Forbidden"
+    assert app.update_queue.empty()
+
+
+def test_wrong_path_and_method():
+    app = fake_app()
+
+    async def check(port):
+        return (await post(port, b"{}", path="/other"),
+                await post(port, b"", method="GET"))
+
+    assert serve(app, check) == ("HTTP/1.1 404 Not Found", "HTTP/1.1 405 Method Not Allowed")
+
+
+def test_full_queue_returns_503():
+    app = fake_app()
+    app.update_queue.put_nowait(object())
+
+    async def check(port):
+        return await post(port, json.dumps(UPDATE).encode())
+
+    assert serve(app, check, max_queue=1) == "HTTP/1.1 503 Service Unavailable"
+    assert app.update_queue.qsize() == 1
+
+
+def test_malformed_body_returns_400():
+    app = fake_app()
+
+    async def check(port):
+        return await post(port, b"{not json")
+
+    assert serve(app, check) == "HTTP/1.1 400 Bad Request"
+    assert app.update_queue.empty()
+
+
+def test_unexpected_error_still_answers(monkeypatch):
+    app = fake_app()
+
+    def broken(data, bot_=None):
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(bot.Update, "de_json", broken)
+
+    async def check(port):
+        return await post(port, json.dumps(UPDATE).encode())
+
+    assert serve(app, check) == "HTTP/1.1 500 Internal Server Error"
+    assert app.update_queue.empty()